@@ -0,0 +1,420 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from openai import AsyncOpenAI
+from PIL import Image, ImageDraw
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aigolfcaddie import utils
+from aigolfcaddie.cache import TieredCache
+from aigolfcaddie.imaging import LLM_UPLOAD, SAM_UPLOAD, MapImage
+from aigolfcaddie.planner import plan_hole
+from aigolfcaddie.prompt import compact_sections, section_tokens
+from aigolfcaddie.sam_client import SamClient
+from aigolfcaddie.simulator import SAMPLES, HazardMap, simulate_shot
+from aigolfcaddie.transport import pack_sam_polygons, parse_geojson_polygons, unpack_sam_polygons
+from standin import StandinServer, geojson_polygons, synthetic_polygons
+
+"""
+End-to-end benchmarks of the analysis pipeline, stage by stage, on synthetic holes. SAM and
+ChatGPT are played by the local stand-in server (see standin.py), so no GPU or API key is needed
+and the numbers only measure the client.
+
+Each stage is timed over several runs and reported with its p50 and p95 latency, its throughput
+and the peak memory it allocates. Results are written as JSON so that a later run can be compared
+against them:
+
+    PYTHONPATH=src python benchmarks/bench_pipeline.py --output benchmarks/results/base.json
+    PYTHONPATH=src python benchmarks/bench_pipeline.py --baseline benchmarks/results/base.json
+"""
+
+# The synthetic holes: how many polygons SAM returns, and how many features the user clicked.
+POLYGON_COUNTS = [100, 1000, 10000]
+CLICK_COUNTS = [1, 10, 50]
+QUICK_POLYGON_COUNTS = [100, 1000]
+QUICK_CLICK_COUNTS = [1, 10]
+
+# Vertices of each synthetic polygon, and the size of the synthetic map in pixels.
+VERTICES_PER_POLYGON = 100
+MAP_SIZE = (3000, 2000)
+
+# The golf features clicked, in turn.
+FEATURE_TYPES = ["tee", "fairway", "green", "bunker"]
+
+# A stage is a regression when its p50 grows by more than this fraction over the baseline.
+REGRESSION_THRESHOLD = 0.2
+
+
+def synthetic_map(path: str, size: Tuple[int, int] = MAP_SIZE, seed: int = 0) -> None:
+    """
+    Draw a golf map like image: grass with fairway, green and bunker blobs, and some noise so that
+    it does not compress unrealistically well.
+    """
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 24, size=(size[1], size[0], 3), dtype=np.uint8)
+    image = Image.fromarray(noise + np.array([40, 110, 40], dtype=np.uint8))
+    draw = ImageDraw.Draw(image)
+    colors = [(90, 170, 70), (120, 200, 90), (225, 210, 160)]
+    for ring in synthetic_polygons(*size, 60, 40, rng):
+        draw.polygon([tuple(point) for point in ring], fill=colors[rng.integers(len(colors))])
+    image.save(path)
+
+
+def synthetic_hole(
+    polygons: int, clicks: int, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray, Dict]:
+    """
+    The SAM polygons of a synthetic hole, and course data with clicks at the centers of some of
+    them.
+
+    Returns:
+        vertices, offsets: the packed polygons, in pixels.
+        course_data: the clicks of each feature type and the scale, like the app builds.
+    """
+    rng = np.random.default_rng(seed)
+    rings = synthetic_polygons(*MAP_SIZE, polygons, VERTICES_PER_POLYGON, rng)
+    vertices = np.concatenate(rings)
+    offsets = np.arange(polygons + 1) * VERTICES_PER_POLYGON
+    course_data = {name: [] for name in FEATURE_TYPES}
+    course_data["scale"] = 0.5
+    for i, polygon in enumerate(rng.choice(polygons, size=clicks, replace=clicks > polygons)):
+        u, v = rings[polygon].mean(axis=0)
+        click = {"u": float(u), "v": float(v)}
+        name = FEATURE_TYPES[i % len(FEATURE_TYPES)]
+        if name == "tee":
+            click["color"] = "black"
+        course_data[name].append(click)
+    return vertices, offsets, course_data
+
+
+def measure(run: Callable[[], object], repeats: int, items: int = 1) -> Dict:
+    """
+    Time a stage.
+
+    Args:
+        run: runs the stage once.
+        repeats: how many timed runs, after one warm up run.
+        items: how many items (polygons, tokens, ...) one run processes, for the throughput.
+
+    Returns:
+        result: the p50 and p95 latency in milliseconds, the items per second at the p50, and the
+            peak memory allocated by one run in kilobytes, measured on a separate run since
+            tracing allocations slows Python down.
+    """
+    run()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    p50 = statistics.median(times)
+    p95 = float(np.percentile(times, 95))
+    return {
+        "runs": repeats,
+        "p50_ms": round(p50 * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "throughput": round(items / p50, 1) if p50 else None,
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def benchmark_image(image_path: str, repeats: int) -> List[Dict]:
+    """
+    Decoding the map and preparing its SAM upload, and then both of the uploads of a message.
+    """
+    def both_uploads():
+        map_image = MapImage(image_path)
+        return map_image.upload(**SAM_UPLOAD), map_image.upload(**LLM_UPLOAD)
+
+    return [
+        {"stage": "encode_image", **measure(
+            lambda: MapImage(image_path).upload(**SAM_UPLOAD), repeats
+        )},
+        {"stage": "encode_image_both", **measure(both_uploads, repeats)},
+    ]
+
+
+def benchmark_transport(polygons: int, b64str_img: str, repeats: int) -> List[Dict]:
+    """
+    call_sam_polygons against the stand-in replaying a recorded response, in both formats,
+    and decoding each format on its own.
+    """
+    vertices, offsets, _ = synthetic_hole(polygons, 1)
+    geojson = geojson_polygons(np.split(vertices, offsets[1:-1]))
+    packed = pack_sam_polygons(vertices, offsets)
+    results = [
+        {"stage": "json_parse", **measure(
+            lambda: parse_geojson_polygons(geojson), repeats, polygons
+        )},
+        {"stage": "packed_decode", **measure(
+            lambda: unpack_sam_polygons(packed), repeats, polygons
+        )},
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "hole.json"), "wb") as file:
+            file.write(geojson)
+        with StandinServer(replay=directory) as server:
+            client = SamClient(server.address, retries=0)
+            original = utils.sam_client, utils.sam_cache, utils.SAM_PACKED_RESPONSES
+            # Every call goes to the server.
+            utils.sam_client, utils.sam_cache = client, TieredCache(0, None, 0)
+            try:
+                for stage, packed_responses in [("sam_transport_packed", True),
+                                                ("sam_transport_geojson", False)]:
+                    utils.SAM_PACKED_RESPONSES = packed_responses
+                    results.append({"stage": stage, **measure(
+                        lambda: utils.call_sam_polygons(b64str_img, []), repeats, polygons
+                    )})
+            finally:
+                utils.sam_client, utils.sam_cache, utils.SAM_PACKED_RESPONSES = original
+                client.close()
+    for result in results:
+        result["polygons"] = polygons
+    return results
+
+
+def prompt_assembly(metrics: List[Dict], distances: List[Dict]) -> List[Dict]:
+    """
+    Format the ChatGPT input and build its messages, as the app does.
+    """
+    prefix, message = utils.llm_input(utils.setup_info(), metrics, distances)
+    return utils.gpt_messages(message, None, prefix)
+
+
+def benchmark_analysis(polygons: int, clicks: int, repeats: int) -> List[Dict]:
+    """
+    Matching the clicks to the polygons, then grouping, measuring and formatting the features.
+    """
+    vertices, offsets, course_data = synthetic_hole(polygons, clicks)
+    metrics = utils.analyze_polygons(vertices, offsets, course_data)
+    features = utils.feature_organization(metrics)
+    distances = utils.feature_analysis(features)
+    llm_metrics = [
+        {key: value for key, value in metric.items() if key != "coordinates"} for metric in metrics
+    ]
+    results = [
+        {"stage": "analyze_polygons", **measure(
+            lambda: utils.analyze_polygons(vertices, offsets, course_data), repeats, polygons
+        )},
+        {"stage": "feature_organization", **measure(
+            lambda: utils.feature_organization(metrics), repeats, len(metrics)
+        )},
+        {"stage": "feature_analysis", **measure(
+            lambda: utils.feature_analysis(features), repeats, len(metrics)
+        )},
+        {"stage": "prompt_assembly", **measure(
+            lambda: prompt_assembly(llm_metrics, distances), repeats
+        ), "prompt_tokens": section_tokens(
+            compact_sections(utils.setup_info(), llm_metrics, distances)
+        )},
+    ]
+    for result in results:
+        result["polygons"] = polygons
+        result["clicks"] = clicks
+    return results
+
+
+def benchmark_planning(repeats: int, polygons: int = 1000, clicks: int = 10) -> List[Dict]:
+    """
+    Painting the hazard map of a hole, simulating a shot over it, and planning the hole with
+    and without the simulation.
+    """
+    vertices, offsets, course_data = synthetic_hole(polygons, clicks)
+    index, matches = utils.match_features(vertices, offsets, course_data)
+    metrics = utils.analyze_polygons(vertices, offsets, course_data)
+    hazards = HazardMap.from_matches(index, matches)
+    setup = utils.setup_info()
+    tee = metrics[0]["feature_center_yards"]
+    aim = metrics[-1]["feature_center_yards"]
+    rng = np.random.default_rng(0)
+    results = [
+        {"stage": "hazard_map", **measure(
+            lambda: HazardMap.from_matches(index, matches), repeats
+        )},
+        {"stage": "simulate_shot", **measure(
+            lambda: simulate_shot(hazards, tee, aim, 270, setup["level_error"], SAMPLES, rng),
+            repeats, SAMPLES
+        )},
+        {"stage": "plan_hole", **measure(lambda: plan_hole(setup, metrics), repeats)},
+        {"stage": "plan_hole_simulated", **measure(
+            lambda: plan_hole(setup, metrics, hazards), repeats
+        )},
+    ]
+    for result in results:
+        result["polygons"] = polygons
+        result["clicks"] = clicks
+    return results
+
+
+def benchmark_gpt(repeats: int, token_latency: float) -> List[Dict]:
+    """
+    Streaming a strategy from the stand-in chat completions endpoint, then answering the same
+    input from the strategy cache.
+    """
+    with StandinServer(token_latency=token_latency) as server:
+        original_client, original_cache = utils.async_client, utils.strategy_cache
+        utils.async_client = AsyncOpenAI(api_key="standin", base_url=server.openai_base_url)
+        utils.strategy_cache = TieredCache(0, None, 0)
+        loop = asyncio.new_event_loop()
+        try:
+            response = loop.run_until_complete(utils.get_gpt_response_async("benchmark"))
+            chunks = -(-len(response) // 4)
+            results = [{"stage": "gpt_streaming", **measure(
+                lambda: loop.run_until_complete(utils.get_gpt_response_async("benchmark")),
+                repeats, chunks
+            )}]
+            utils.strategy_cache = TieredCache(4, None, 0, ttl=utils.STRATEGY_CACHE_TTL)
+            loop.run_until_complete(utils.get_gpt_response_async("benchmark"))
+            results.append({"stage": "gpt_cached", **measure(
+                lambda: loop.run_until_complete(utils.get_gpt_response_async("benchmark")),
+                repeats, chunks
+            )})
+            return results
+        finally:
+            loop.run_until_complete(utils.async_client.close())
+            loop.close()
+            utils.async_client, utils.strategy_cache = original_client, original_cache
+
+
+def environment() -> Dict:
+    """
+    Describe where the benchmarks ran, to tell apart results from different machines or commits.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def row_key(result: Dict) -> Tuple:
+    return (result["stage"], result.get("polygons"), result.get("clicks"))
+
+
+def compare(results: List[Dict], baseline: List[Dict], threshold: float) -> List[Dict]:
+    """
+    Compare the p50 of each stage with the baseline.
+
+    Returns:
+        regressions: the results slower than the baseline by more than threshold, with their
+            "baseline_p50_ms" and "ratio".
+    """
+    before = {row_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = before.get(row_key(result))
+        if old is None or not old["p50_ms"]:
+            continue
+        result["baseline_p50_ms"] = old["p50_ms"]
+        result["ratio"] = round(result["p50_ms"] / old["p50_ms"], 3)
+        if result["ratio"] > 1 + threshold:
+            regressions.append(result)
+    return regressions
+
+
+def report(results: List[Dict]) -> str:
+    """
+    Format the results as a table.
+    """
+    header = f"{'stage':<24}{'polygons':>9}{'clicks':>7}{'p50 ms':>11}{'p95 ms':>11}" \
+             f"{'items/s':>12}{'peak KB':>11}{'vs base':>9}"
+    lines = [header, "-" * len(header)]
+    for result in results:
+        ratio = f"{result['ratio']:.2f}x" if "ratio" in result else ""
+        lines.append(
+            f"{result['stage']:<24}{result.get('polygons') or '':>9}{result.get('clicks') or '':>7}"
+            f"{result['p50_ms']:>11.3f}{result['p95_ms']:>11.3f}"
+            f"{result['throughput'] or 0:>12.1f}{result['peak_kb']:>11.1f}{ratio:>9}"
+        )
+    return "\n".join(lines)
+
+
+def run(quick: bool = False, repeats: int = 10, token_latency: float = 0.0) -> List[Dict]:
+    """
+    Run every benchmark.
+
+    Args:
+        quick: only benchmark the smaller holes, for a fast check.
+        repeats: the timed runs of each stage.
+        token_latency: the seconds between the chunks streamed by the stand-in ChatGPT.
+    """
+    polygon_counts = QUICK_POLYGON_COUNTS if quick else POLYGON_COUNTS
+    click_counts = QUICK_CLICK_COUNTS if quick else CLICK_COUNTS
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        image_path = os.path.join(directory, "map.png")
+        synthetic_map(image_path)
+        results += benchmark_image(image_path, repeats)
+        b64str_img = MapImage(image_path).upload(**SAM_UPLOAD).b64
+    for polygons in polygon_counts:
+        results += benchmark_transport(polygons, b64str_img, repeats)
+        for clicks in click_counts:
+            results += benchmark_analysis(polygons, clicks, repeats)
+    results += benchmark_planning(repeats)
+    results += benchmark_gpt(repeats, token_latency)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the AI Golf Caddie pipeline.")
+    parser.add_argument("--quick", action="store_true", help="only the smaller holes")
+    parser.add_argument("--repeats", type=int, default=10, help="timed runs per stage")
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="seconds between streamed ChatGPT chunks")
+    parser.add_argument("--output", help="where to write the results as JSON")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="p50 growth over the baseline reported as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.quick, args.repeats, args.token_latency)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)["results"], args.threshold)
+    print(report(results))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump({"environment": environment(), "results": results}, file, indent=4)
+    for result in regressions:
+        hole = ", ".join(
+            f"{result[key]} {key}" for key in ("polygons", "clicks") if key in result
+        )
+        print(f"Regression: {result['stage']} {f'({hole}) ' if hole else ''}"
+              f"{result['baseline_p50_ms']} -> {result['p50_ms']} ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
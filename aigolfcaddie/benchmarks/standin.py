@@ -0,0 +1,420 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import argparse
+import base64
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from typing import Dict, List, Optional, Tuple, Union
+
+from aigolfcaddie.transport import (
+    PACKED_CONTENT_TYPE, PACKED_MAGIC, pack_sam_polygons, parse_geojson_polygons,
+    unpack_sam_polygons
+)
+
+"""
+A local stand-in for the SAM server, to develop and benchmark the client without a GPU. It speaks
+the same protocol (see sam_client.py): /sam/version/, /sam/automask/, /sam/prompts/ and /sam/.
+
+Automask answers either replay recorded responses in turn, samapi GeoJSON files or the packed
+files of the client SAM cache (see utils.SAM_CACHE_DIR), or are synthetic
+polygons with a chosen count and vertex density scattered over the uploaded image. Prompt answers
+are a synthetic polygon around each point. Every answer can be delayed to mimic the GPU, and is
+sent in the compact polygon format and gzip compressed when the request accepts them.
+
+It also serves an OpenAI compatible /v1/chat/completions endpoint that streams STANDIN_STRATEGY,
+a few characters per chunk, to time the ChatGPT side of the pipeline. Its usage reports the prompt
+tokens shared with the previous request as cached, like the OpenAI prompt cache.
+
+Run it from the command line, then point the SAM_API_ADDR environment variable at it:
+    PYTHONPATH=src python benchmarks/standin.py --port 3000 --count 300 --vertices 200 --latency 2
+"""
+
+STANDIN_VERSION = "standin"
+
+# The strategy streamed by the stand-in chat completions endpoint, following FORMATTED.
+STANDIN_STRATEGY = {
+    "strategy": [
+        {"club": "driver", "distance hit": 250, "estimated location": "center of the fairway",
+         "distance_from_hole": 150},
+        {"club": "7-iron", "distance hit": 140, "estimated location": "front of the green",
+         "distance_from_hole": 10},
+        {"club": "putter", "distance hit": 10, "estimated location": "in the hole",
+         "distance_from_hole": 0},
+    ],
+    "expected_outcome": {
+        "explanation_of_strategy": "Stay left of the fairway bunker, then attack the green.",
+        "stroke_count": 4,
+        "fairway_shape": "Straight and wide, narrowing near the green.",
+        "location_of_all_obstacles": [
+            {"obstacle_type": "bunker", "distance_from_tee": 230,
+             "left_right_or_center_from_fairway": "right"},
+        ],
+    },
+}
+
+# Like OpenAI, prompts are cached from this many tokens on, in blocks of PROMPT_CACHE_BLOCK tokens.
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_BLOCK = 128
+
+
+def synthetic_polygons(
+    width: int, height: int, count: int, vertices: int, rng: np.random.Generator
+) -> List[np.ndarray]:
+    """
+    Generate count random star shaped polygons of the given number of vertices within an image,
+    from fairway sized to bunker sized.
+
+    Returns:
+        rings: a list of (vertices, 2) arrays of (u,v) pixel coordinates.
+    """
+    centers = rng.uniform((0, 0), (width, height), size=(count, 2))
+    radii = min(width, height) * rng.uniform(0.01, 0.15, size=count)
+    rings = star_polygons(centers, radii, vertices, rng)
+    return list(np.clip(rings, 0, (width, height)).round(1))
+
+
+def star_polygons(
+    centers: np.ndarray, radii: np.ndarray, vertices: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Generate a random star shaped polygon around each center.
+
+    Returns:
+        rings: a (count, vertices, 2) array of (u,v) pixel coordinates.
+    """
+    count = len(centers)
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    # A smooth bumpy outline: each polygon gets a few random harmonics.
+    harmonics = rng.uniform(-0.1, 0.1, size=(count, 3, 1)) * np.cos(
+        np.arange(2, 5)[None, :, None] * angles[None, None, :]
+        + rng.uniform(0, 2 * np.pi, size=(count, 3, 1))
+    )
+    distances = radii[:, None] * (1 + harmonics.sum(axis=1))
+    return centers[:, None, :] + distances[:, :, None] * np.stack(
+        [np.cos(angles), np.sin(angles)], axis=-1
+    )[None]
+
+
+def geojson_polygons(rings: List[np.ndarray]) -> bytes:
+    """
+    Encode rings as a samapi GeoJSON response.
+    """
+    return json.dumps([
+        {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [ring.tolist() + [ring[0].tolist()]]},
+            "properties": {"object_type": "annotation"},
+        }
+        for ring in rings
+    ]).encode()
+
+
+class StandinServer:
+    """
+    The stand-in SAM server, served from a background thread.
+    """
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        count: int = 300,
+        vertices: int = 200,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        replay: Optional[str] = None,
+        seed: int = 0,
+        first_token_latency: float = 0.0,
+        token_latency: float = 0.0,
+    ):
+        """
+        Args:
+            host: the interface to listen on.
+            port: the port to listen on, 0 picks a free one.
+            count: the number of synthetic polygons per automask answer.
+            vertices: the number of vertices of each synthetic polygon.
+            latency: the seconds to wait before each segmentation answer.
+            jitter: the standard deviation of the latency, in seconds.
+            replay: a recorded samapi GeoJSON response or packed cache file, or a directory of
+                them, to replay in turn instead of synthetic automask polygons.
+            seed: the seed of the synthetic polygons, so runs are repeatable.
+            first_token_latency: the seconds before the first chat completion chunk.
+            token_latency: the seconds between chat completion chunks.
+        """
+        self.count = count
+        self.vertices = vertices
+        self.latency = latency
+        self.jitter = jitter
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.replays = self._load_replays(replay) if replay else []
+        self.encoded = {}
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.last_prompt = ""
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @staticmethod
+    def _load_replays(path: str) -> List[bytes]:
+        paths = [path]
+        if os.path.isdir(path):
+            paths = sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if not name.endswith(".tmp")
+            )
+        replays = []
+        for file_path in paths:
+            with open(file_path, "rb") as file:
+                replays.append(file.read())
+        return replays
+
+    @property
+    def address(self) -> str:
+        """
+        The SAM_API_ADDR of the server.
+        """
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/sam/"
+
+    @property
+    def openai_base_url(self) -> str:
+        """
+        The base_url of an OpenAI client talking to the stand-in.
+        """
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StandinServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "StandinServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def wait(self) -> None:
+        """
+        Sleep for the configured latency.
+        """
+        with self.lock:
+            delay = self.latency + (self.rng.normal(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def automask(self, body: Dict) -> Union[List[np.ndarray], int]:
+        """
+        The synthetic polygons of an automask answer, or the index of the replay to send.
+        """
+        if not self.replays:
+            width, height = image_size(body["b64img"])
+        with self.lock:
+            index = self.requests
+            self.requests += 1
+            if not self.replays:
+                return synthetic_polygons(width, height, self.count, self.vertices, self.rng)
+        return index % len(self.replays)
+
+    def encode_replay(self, index: int, packed: bool) -> Tuple[bytes, str]:
+        """
+        A replay in the requested format. Converted replays are kept, so that replaying measures
+        the client rather than the stand-in.
+        """
+        key = (index, packed)
+        if key not in self.encoded:
+            replay = self.replays[index]
+            is_packed = replay.startswith(PACKED_MAGIC)
+            if is_packed == packed:
+                encoded = replay
+            else:
+                vertices, offsets = (
+                    unpack_sam_polygons(replay) if is_packed else parse_geojson_polygons(replay)
+                )
+                encoded = (
+                    pack_sam_polygons(vertices, offsets) if packed
+                    else geojson_polygons(np.split(vertices, offsets[1:-1]))
+                )
+            self.encoded[key] = encoded
+        return self.encoded[key], PACKED_CONTENT_TYPE if packed else "application/json"
+
+    def prompts(self, prompts: List[Dict]) -> List[np.ndarray]:
+        # A bunker sized polygon around each point.
+        centers = np.array([prompt["point_coords"][0] for prompt in prompts], dtype=float)
+        with self.lock:
+            self.requests += 1
+            rings = star_polygons(
+                centers.reshape(-1, 2), np.full(len(centers), 20.0), self.vertices, self.rng
+            )
+        return list(rings.round(1))
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, do not let Nagle hold the body back.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if self.path.rstrip("/") != "/sam/version":
+                    return self.send_body(404, b"", "text/plain")
+                self.send_body(200, STANDIN_VERSION.encode(), "text/plain")
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                path = self.path.rstrip("/")
+                if path == "/v1/chat/completions":
+                    return self.stream_completion(body)
+                if path == "/sam/automask":
+                    rings = server.automask(body)
+                elif path == "/sam/prompts":
+                    rings = server.prompts(body["prompts"])
+                elif path == "/sam":
+                    rings = server.prompts([body])
+                else:
+                    return self.send_body(404, b"", "text/plain")
+                server.wait()
+                packed = PACKED_CONTENT_TYPE in self.headers.get("Accept", "")
+                if isinstance(rings, int):
+                    # A replay index rather than polygons.
+                    self.send_body(200, *server.encode_replay(rings, packed))
+                elif packed:
+                    vertices = np.concatenate(rings) if rings else np.zeros((0, 2))
+                    offsets = np.cumsum([0] + [len(ring) for ring in rings])
+                    self.send_body(200, pack_sam_polygons(vertices, offsets), PACKED_CONTENT_TYPE)
+                else:
+                    self.send_body(200, geojson_polygons(rings), "application/json")
+
+            def stream_completion(self, body: Dict):
+                """
+                Stream STANDIN_STRATEGY as server-sent chat completion chunks, then the usage
+                when the request asks for it. Tokens are counted as 4 characters, and those of
+                the prefix shared with the previous prompt are reported as cached.
+                """
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                text = json.dumps(STANDIN_STRATEGY)
+                time.sleep(server.first_token_latency)
+                for start in range(0, len(text), 4):
+                    if start:
+                        time.sleep(server.token_latency)
+                    self.send_chunk(text[start:start + 4], None)
+                self.send_chunk("", "stop")
+                if body.get("stream_options", {}).get("include_usage"):
+                    prompt = json.dumps(body["messages"])
+                    prompt_tokens = len(prompt) // 4
+                    completion_tokens = -(-len(text) // 4)
+                    with server.lock:
+                        shared = len(os.path.commonprefix([server.last_prompt, prompt])) // 4
+                        server.last_prompt = prompt
+                    cached_tokens = shared // PROMPT_CACHE_BLOCK * PROMPT_CACHE_BLOCK
+                    if cached_tokens < PROMPT_CACHE_MIN_TOKENS:
+                        cached_tokens = 0
+                    self.write_event({
+                        "id": "chatcmpl-standin",
+                        "object": "chat.completion.chunk",
+                        "created": 0,
+                        "model": "gpt-4o",
+                        "choices": [],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens,
+                            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                        },
+                    })
+                self.write_chunk(b"data: [DONE]\n\n")
+                self.write_chunk(b"")
+
+            def send_chunk(self, content: str, finish_reason: Optional[str]):
+                chunk = {
+                    "id": "chatcmpl-standin",
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": "gpt-4o",
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": content} if content else {},
+                        "finish_reason": finish_reason,
+                    }],
+                }
+                self.write_event(chunk)
+
+            def write_event(self, data: Dict):
+                self.write_chunk(f"data: {json.dumps(data)}\n\n".encode())
+
+            def write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def send_body(self, status: int, payload: bytes, content_type: str):
+                gzipped = "gzip" in self.headers.get("Accept-Encoding", "") and len(payload) > 1024
+                if gzipped:
+                    payload = gzip.compress(payload, 6)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                if gzipped:
+                    self.send_header("Content-Encoding", "gzip")
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def image_size(b64str_img: str) -> Tuple[int, int]:
+    """
+    The (width, height) of a base64 encoded image, reading only its header.
+    """
+    with Image.open(io.BytesIO(base64.b64decode(b64str_img))) as image:
+        return image.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A local stand-in for the SAM server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--count", type=int, default=300, help="synthetic polygons per answer")
+    parser.add_argument("--vertices", type=int, default=200, help="vertices per polygon")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="latency deviation")
+    parser.add_argument("--replay", help="a recorded GeoJSON response, or a directory of them")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--first-token-latency", type=float, default=0.0,
+                        help="seconds before the first chat completion chunk")
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="seconds between chat completion chunks")
+    args = parser.parse_args()
+    server = StandinServer(**vars(args))
+    print(f"Stand-in SAM server listening at {server.address}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
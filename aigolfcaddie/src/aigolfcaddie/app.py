@@ -12,9 +12,16 @@ from PIL import Image
 import json
 import base64
 import io
+import asyncio
 import cv2
+import httpx
 from typing import List, Dict
 
+from aigolfcaddie import tracing
+from aigolfcaddie.imaging import LLM_UPLOAD, SAM_UPLOAD, MapImage
+from aigolfcaddie.planner import plan_hole
+from aigolfcaddie.streaming import StrategyParser, describe_shot
+from aigolfcaddie.transport import SamResponseError
 from aigolfcaddie.utils import *
 
 """
@@ -130,6 +137,9 @@ class AIGolfCaddie(toga.App):
 
         self.chat_area = toga.MultilineTextInput(readonly=True, style=Pack(flex=1, padding=5))
 
+        # The shots of the strategy, listed as they stream in.
+        self.shots_area = toga.MultilineTextInput(readonly=True, style=Pack(padding=5))
+
         self.input_box = toga.TextInput(placeholder="Type your message here...", 
                                         style=Pack(flex=1, padding=5))
 
@@ -152,12 +162,14 @@ class AIGolfCaddie(toga.App):
         input_row.add(upload_button)
 
         main_box.add(self.chat_area)
+        main_box.add(self.shots_area)
         main_box.add(self.image_view)
         main_box.add(input_row)
         main_box.add(display_data_button)
         main_box.add(back_button)
 
         self.selected_image_path = None
+        self.map_image = None
         return main_box
 
     def show_main_menu(self, widget):
@@ -228,59 +240,127 @@ class AIGolfCaddie(toga.App):
         }
         self.update_json_display()
 
-    def send_message(self, widget):
+    async def send_message(self, widget):
         """
-        Send the user's input into SAM and pipe the output into ChatGPT send to user
+        Send the user's input into SAM and pipe the output into ChatGPT send to user. The SAM and
+        ChatGPT calls are awaited and the image encoding and geometry run in an executor, so the
+        app stays responsive for the whole round trip.
         """
         # Get the user's input
         user_message = self.input_box.value
 
         if user_message:
             self.chat_area.value += f"You: {user_message}\n"
+            # Ignore further presses until this message has been answered.
+            widget.enabled = False
+            try:
+                with tracing.span("send_message", message_chars=len(user_message)):
+                    await self.answer_message()
+            finally:
+                widget.enabled = True
+
+    async def answer_message(self):
+        """
+        Build the three part ChatGPT input from SAM and the course data, and display the answer.
+        """
+        loop = asyncio.get_running_loop()
+
+        # Prepare the map for SAM and start segmenting it right away.
+        if SAM_SEGMENTATION_MODE == "tiled":
+            # Tiles are segmented at full resolution.
+            sam_factor = 1.0
+            sam_task = asyncio.ensure_future(call_sam_tiled_async(self.map_image))
+        else:
+            sam_upload = await loop.run_in_executor(
+                None, lambda: self.map_image.upload(**SAM_UPLOAD)
+            )
+            sam_factor = sam_upload.factor
+            if SAM_SEGMENTATION_MODE == "prompt":
+                points = click_points(self.course_data, sam_factor)
+                sam_task = asyncio.ensure_future(call_sam_prompts_async(sam_upload.b64, points))
+            else:
+                sam_task = asyncio.ensure_future(call_sam_polygons_async(sam_upload.b64,[]))
+
+        # Prepare the map for ChatGPT while SAM runs.
+        llm_upload = await loop.run_in_executor(None, lambda: self.map_image.upload(**LLM_UPLOAD))
+
+        # Part 2: Physical Features
+        try:
+            vertices, offsets = await sam_task
+        except httpx.HTTPError as e:
+            self.chat_area.value += f"Error: the SAM request failed ({e})\n"
+            return
+        except SamResponseError as e:
+            self.chat_area.value += f"Error: the SAM response could not be read ({e})\n"
+            return
 
-            user_input = ""
-
-            # Part 1: Setup Information
-            user_input += "The following are the 3 input parts described previously:\n"
-            user_input += "## Setup Information\n"
-            user_input += json.dumps(setup_info(),indent = 4) + '\n'
-
-            # Part 2: Physical Features
-            # Analyze inputted image using SAM
-            image = Image.open(self.selected_image_path)
-            image_bytes = io.BytesIO()
-            image.save(image_bytes, format='PNG')
-            image_bytes = base64.b64encode(image_bytes.getvalue()).decode()
-            sam_response = call_sam(image_bytes,[])
-
-            metrics = analyze_result(sam_response, self.course_data) # Physical Features
-            # Temporarily remove coordinates for formatted input into ChatGPT
-            coord_metrics = []
-            for metric in metrics:
-                coord_metrics.append(metric["coordinates"])
-                del metric["coordinates"]
-
-            user_input += "## Physical Features\n"
-            user_input += json.dumps(metrics,indent = 4)+ "\n"
-
-            # Add back coordinates to update image to visualize SAM output
-            for metric in range(len(metrics)):
-                metrics[metric]["coordinates"] = coord_metrics[metric]
-            metrics = feature_organization(metrics)
-            self.visualize_detections(metrics)
-
-            # Remove coordinates again for formatted input into ChatGPT
-            for feature in metrics.keys():
-                for metric in metrics[feature]:
-                    del metric["coordinates"]
-
-            # Part 3: Inter-Feature Distance
-            metrics = feature_analysis(metrics) # Inter-Feature Distance
-            user_input += "## Inter-Feature Distance\n"
-            user_input += json.dumps(metrics,indent = 4)+ "\n"
-            gpt_response = get_gpt_response(user_input, self.selected_image_path)
-            self.chat_area.value += f"GPT-4: {json.dumps(json.loads(gpt_response), indent = 4)}\n"
+        metrics = await loop.run_in_executor(None, tracing.bind(
+            analyze_polygons, vertices, offsets, self.course_data, sam_factor
+        )) # Physical Features
+        features = feature_organization(metrics)
+        self.visualize_detections(features)
+
+        # Plan locally while the bunker outlines are still known.
+        plan = plan_hole(setup_info(), metrics) if STRATEGY_PLANNER != "off" else None
+        if plan is not None and STRATEGY_PLANNER == "local":
+            self.chat_area.value += f"Caddie: {json.dumps(plan, indent = 4)}\n"
             self.input_box.value = ""
+            return
+
+        # Remove the pixel coordinates, only used to visualize SAM output, from the ChatGPT input.
+        for metric in metrics:
+            del metric["coordinates"]
+
+        # Part 3: Inter-Feature Distance
+        distances = feature_analysis(features)
+        hint = plan if STRATEGY_PLANNER == "hint" else None
+        prefix, user_input = llm_input(setup_info(), metrics, distances, hint)
+        if GPT_STREAMING:
+            gpt_response = await self.stream_answer(user_input, llm_upload.data_url, prefix)
+        else:
+            gpt_response = await get_gpt_response_async(user_input, llm_upload.data_url, prefix)
+            if gpt_response.startswith("Error: "):
+                self.chat_area.value += f"GPT-4: {gpt_response}\n"
+            else:
+                self.chat_area.value += \
+                    f"GPT-4: {json.dumps(json.loads(gpt_response), indent = 4)}\n"
+        if gpt_response.startswith("Error: ") and plan is not None \
+                and STRATEGY_PLANNER == "fallback":
+            self.chat_area.value += f"Caddie (offline plan): {json.dumps(plan, indent = 4)}\n"
+        self.input_box.value = ""
+
+    async def stream_answer(self, user_input: str, image_url: str, prefix: str) -> str:
+        """
+        Display the ChatGPT answer as it streams in. Each piece of text is added to the chat as
+        soon as it arrives, and each shot of the strategy is listed in the shots area as soon as
+        it is complete, so the first shot shows long before the whole answer is generated.
+
+        Args:
+            user_input: the hole part of the ChatGPT input, see llm_input.
+            image_url: the golf map as a data url.
+            prefix: the stable part of the ChatGPT input, see llm_input.
+
+        Returns:
+            gpt_response: the whole answer, or the error of the ChatGPT call.
+        """
+        parser = StrategyParser()
+        self.shots_area.value = ""
+        self.chat_area.value += "GPT-4: "
+
+        def show(delta):
+            self.chat_area.value += delta
+            for shot in parser.feed(delta):
+                if len(parser.items) == 1:
+                    span = tracing.current_span()
+                    span.set(time_to_first_shot=round(span.since_start(), 4))
+                self.shots_area.value += describe_shot(len(parser.items), shot) + "\n"
+
+        gpt_response = await get_gpt_response_async(user_input, image_url, prefix, show)
+        if not parser.text:
+            # Errors are returned rather than streamed.
+            self.chat_area.value += gpt_response
+        self.chat_area.value += "\n"
+        return gpt_response
 
     async def upload_image(self, widget):
         """
@@ -292,27 +372,24 @@ class AIGolfCaddie(toga.App):
             if file:
                 self.chat_area.value += f"Uploaded file: {file}\n"
                 self.selected_image_path = file
+                self.map_image = MapImage(file)
                 self.draw_image()
             else:
                 self.chat_area.value += f"No file selected\n"
         except ValueError:
             self.chat_area.value = f"File selection canceled\n"
    
-    def draw_image(self, processed_image_bytes = None):
+    def draw_image(self, processed_image = None):
         """
         Take the user image and upload it onto the ImageView to display on screen
         """
-        if processed_image_bytes:
+        if processed_image is not None:
             # SAM model update
-            image = Image.open(io.BytesIO(processed_image_bytes))
-            self.image_view.image = image
+            self.image_view.image = processed_image
             self.chat_area.value += "Image updated with SAM bounding boxes.\n"
-        elif self.selected_image_path:
+        elif self.map_image:
             # User image upload
-            image = Image.open(self.selected_image_path)
-            image_data = io.BytesIO()
-            image.save(image_data, format='PNG')
-            self.image_view.image = image
+            self.image_view.image = self.map_image.pixels
             self.chat_area.value += "Image set as background.\n"
     
     def visualize_detections(self, metrics: Dict) -> None:
@@ -326,7 +403,7 @@ class AIGolfCaddie(toga.App):
             in_img_file: the input image to load and draw over.
             out_img_file: where to save the annotated image.
         """
-        im = cv2.imread(self.selected_image_path)
+        im = self.map_image.bgr.copy()
         for feature_type in metrics.keys():  # "bunker", "fairway", "green", "tee"
             for feature_info in metrics[feature_type]:
                 u0, v0, u1, v1 = [
@@ -338,8 +415,7 @@ class AIGolfCaddie(toga.App):
                 cv2.putText(im, feature_type, (int(u0), int(v0) - 10), 
                             fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.6, color=(255,0,0))
                 cv2.circle(im, (int(uc), int(vc)), radius=4, color=(255,0,0), thickness=-1)
-        _, buffer = cv2.imencode('.png', im)
-        self.draw_image(buffer.tobytes())
+        self.draw_image(Image.fromarray(im[:, :, ::-1]))
 
     def show_course_data(self, widget):
         """
@@ -0,0 +1,162 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Optional
+
+"""
+Content-addressed caches used to skip repeated round trips to the SAM server and to ChatGPT. A
+cache is made of an in-memory LRU tier in front of an on-disk tier that evicts the least recently
+used entries once it grows past a size limit. Cached values are bytes, and can expire a fixed
+time after they were stored.
+"""
+
+# The header of values stored with a time to live: the time they were stored, in seconds.
+_STORED_AT = struct.Struct("<d")
+
+
+def cache_key(*parts) -> str:
+    """
+    Hash the given parts into a cache key. Strings and bytes are hashed as is, anything else is
+    hashed through its canonical (sorted keys) JSON form.
+
+    Returns:
+        key: a hex sha256 digest identifying the parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        elif not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, separators=(",", ":")).encode()
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """
+    An in-memory cache that holds at most max_entries values, dropping the least recently used.
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key: str, value: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class DiskCache:
+    """
+    A cache that stores one file per value in a directory, and drops the least recently used
+    files once their total size exceeds max_bytes. Any file system error is treated as a miss so
+    that a read-only or full disk never breaks a request.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as file:
+                value = file.read()
+            os.utime(self._path(key))  # Mark as recently used.
+            return value
+        except OSError:
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file first so a reader never sees a partial value.
+            descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(value)
+            os.replace(temp_path, self._path(key))
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used files until the directory fits within max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+class TieredCache:
+    """
+    An in-memory LRU tier in front of an on-disk tier. Disk hits are promoted into memory.
+    """
+    def __init__(
+        self,
+        max_entries: int,
+        directory: Optional[str],
+        max_bytes: int,
+        ttl: Optional[float] = None
+    ):
+        """
+        Args:
+            max_entries: the number of values kept in memory.
+            directory: where the disk tier stores its files, or None to only cache in memory.
+            max_bytes: the size limit of the disk tier.
+            ttl: the seconds a value stays valid after it is stored, or None to keep it until it
+                is evicted. Values are then stored behind the time they were stored at.
+        """
+        self.memory = LRUCache(max_entries)
+        self.disk = DiskCache(directory, max_bytes) if directory else None
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        if value is None or self.ttl is None:
+            return value
+        if len(value) < _STORED_AT.size:
+            return None
+        stored_at, = _STORED_AT.unpack_from(value)
+        if time.time() - stored_at > self.ttl:
+            return None
+        return value[_STORED_AT.size:]
+
+    def put(self, key: str, value: bytes) -> None:
+        if self.ttl is not None:
+            value = _STORED_AT.pack(time.time()) + value
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
@@ -136,38 +136,29 @@ This is an explanation of the key values from the above JSON:
 
 
 ## Physical Features
-The 2nd section of the input is about physical features. This is a list of features found within the golf course and their relative locations. The list is formatted as follows:
+The 2nd section of the input is about physical features. This is a list of features found within the golf course and their relative locations. Each feature is listed once. The list is formatted as follows:
 [
-	{“feature_name”: “fairway”, “feature_center_yards”:  [x_value, y_value]},
-	{"feature_name": "bunker", "feature_center_yards": [x_value, y_value]},
-	{"feature_name": "tee", "feature_center_yards": [x_value, y_value], "tee_color": "red"},
+	{"feature_id": 0, “feature_name”: “fairway”, “feature_center_yards”:  [x_value, y_value]},
+	{"feature_id": 1, "feature_name": "bunker", "feature_center_yards": [x_value, y_value]},
+	{"feature_id": 2, "feature_name": "tee", "feature_center_yards": [x_value, y_value], "tee_color": "red"},
 	…
 ]
 
-Where “feature_name” represents the type of feature on the golf course. The feature_name could be one of “fairway”, “bunker”, “tee”, or “green”. The feature_center_yards key will give you a 2D coordinate of the center of the feature. These are represented in a x, y coordinates where the measurement unit is in yards.
+Where “feature_id” is a number that identifies the feature, and “feature_name” represents the type of feature on the golf course. The feature_name could be one of “fairway”, “bunker”, “tee”, or “green”. The feature_center_yards key will give you a 2D coordinate of the center of the feature. These are represented in a x, y coordinates where the measurement unit is in yards.
 “tee” has an additional metric associated with it. “tee_color” represents what color the player is teeing off of, including colors like red, blue, or black. 
 
 ## Inter-Feature Distances
-The 3rd section of the input is about inter-features distances. This is a list of distances between golf features that represents the distance in yards between various combinations of the features mentioned in the above Physical Features section. Features include “fairway”, “bunker”, “tee”, and “green".
-The list is formatted as follows:
-[
+The 3rd section of the input is about inter-features distances. This is a table of distances between golf features that represents the distance in yards between various combinations of the features mentioned in the above Physical Features section. Features include “fairway”, “bunker”, “tee”, and “green".
+The distances are a table formatted as follows:
 {
-"distance": <float value in yards>, 
-"feature_1": {"feature_name": "fairway",
-"feature_center_yards": [<float value in yards>,<float value in yards>]},
-"feature_2": {"feature_name": "bunker",
-"feature_center_yards": [<float value in yards>,<float value in yards>]}
-},
-    	{
-        	"distance": <float value in yards>,
-        	"feature_1": {"feature_name": "fairway",
-            	"feature_center_yards": [<float value in yards>,<float value in yards>]},
-        	"feature_2": {"feature_name": "bunker",
-            "feature_center_yards": [<float value in yards>,<float value in yards>]}
-    	},
+	"<feature_id>": {"<feature_id>": <float value in yards>, "<feature_id>": <float value in yards>, …},
+	"<feature_id>": {"<feature_id>": <float value in yards>, …},
 …
-]
-The “distance” key represents the amount of distance in yards between two features. The “feature_1” and “feature_2” keys are the two features that the “distance” key measures. The values for the “feature_1” and “feature_2” keys contains the name of the feature in the “feature_name” key. Where “feature_name” represents the type of feature on the golf course. The feature_name could be one of “fairway”, “bunker”, “tee”, or “green”. The feature_center_yards key will give you a 2D coordinate of the center of the feature. These are represented in a x, y coordinates where the measurement unit is in yards. “feature_1” and “feature_2” correspond to physical features listed in the previous Physical Features section.
+}
+Each key of the table is the “feature_id” of a feature listed in the previous Physical Features section. Its value gives the distance in yards from that feature to other features, keyed by their “feature_id”. For example {"0": {"2": 131.4}} means feature 0 is 131.4 yards away from feature 2. Distances are given from fairways to bunkers and greens, from tees to fairways, bunkers and greens, and from bunkers to greens.
+
+## Local Plan
+The input may end with a 4th section, “Local Plan”. It is a plan computed from the setup information and the features, in the same JSON format as your response, with the shots chosen to keep landings away from bunkers within the level error. Use it as a starting point, and improve on it using the image and the other parts of the input.
 
 # Instructions for Generating Plan
 Please use all 3 text input parts as much as possible when generating the plan. Make sure to use the distances given within the inputs. Please give responses that are logically consistent with the distances and center coordinates given within the inputs for quantitative analysis. Use the given image for qualitative analysis Please respond using JSON format. Don’t respond with anything outside of the JSON. 
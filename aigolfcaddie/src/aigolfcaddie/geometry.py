@@ -0,0 +1,447 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import numpy as np
+from itertools import chain
+from typing import Dict, List, Tuple
+
+"""
+Batched geometry used to match user clicks against the polygons returned by the SAM server.
+
+All the polygons of one SAM response are packed into a single ragged array: `vertices` is an
+(n, 2) array holding the (u,v) vertices of every polygon back to back, and `offsets` is a
+(count + 1,) array such that polygon i is vertices[offsets[i]:offsets[i + 1]]. Every function
+below works on the whole response at once instead of looping over polygons in Python.
+"""
+
+# Upper bound on the number of grid cells along each axis of a PolygonIndex.
+MAX_GRID_CELLS = 64
+
+
+def pack_polygons(rings: List[List[Tuple[float,float]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack a list of polygons into a ragged vertex array. Rings with no vertices are dropped.
+
+    Args:
+        rings: a list of polygons, each a list of sequential vertices (u,v).
+
+    Returns:
+        vertices: an (n, 2) float array of the vertices of every polygon.
+        offsets: a (count + 1,) int array with the start of each polygon within vertices.
+    """
+    rings = [ring for ring in rings if len(ring)]
+    lengths = np.fromiter((len(ring) for ring in rings), dtype=np.int64, count=len(rings))
+    offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    vertices = np.array(list(chain.from_iterable(rings)), dtype=float).reshape(-1, 2)
+    return vertices, offsets
+
+
+def concatenate_polygons(
+    packed: List[Tuple[np.ndarray, np.ndarray]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Join several packed polygon arrays into one, keeping their order.
+
+    Args:
+        packed: a list of (vertices, offsets) pairs, see pack_polygons.
+
+    Returns:
+        vertices, offsets: the packed polygons of every pair.
+    """
+    if not packed:
+        return np.zeros((0, 2)), np.zeros(1, dtype=np.int64)
+    vertices = np.concatenate([part[0] for part in packed])
+    starts = np.cumsum([0] + [len(part[0]) for part in packed[:-1]])
+    offsets = np.concatenate(
+        [[0]] + [part[1][1:] + start for part, start in zip(packed, starts)]
+    ).astype(np.int64)
+    return vertices, offsets
+
+
+def _ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Concatenate np.arange(start, start + count) for every (start, count) pair.
+    """
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+
+def _next_vertices(vertices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Return the vertex following each vertex within its own polygon, wrapping around at the end.
+    """
+    following = np.arange(1, len(vertices) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+    return vertices[following]
+
+
+def polygon_bboxes(vertices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Calculate the bounding box of every polygon.
+
+    Returns:
+        bboxes: a (count, 4) array of [u0,v0,u1,v1] corners.
+    """
+    if len(offsets) < 2:
+        return np.zeros((0, 4))
+    starts = offsets[:-1]
+    return np.concatenate([
+        np.minimum.reduceat(vertices, starts, axis=0),
+        np.maximum.reduceat(vertices, starts, axis=0),
+    ], axis=1)
+
+
+def polygon_areas(vertices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Calculate the signed area of every polygon using the shoelace formula.
+
+    Returns:
+        areas: a (count,) array of signed areas. Counter clockwise polygons are positive.
+    """
+    if len(offsets) < 2:
+        return np.zeros(0)
+    following = _next_vertices(vertices, offsets)
+    cross_product = vertices[:, 0] * following[:, 1] - following[:, 0] * vertices[:, 1]
+    return 0.5 * np.add.reduceat(cross_product, offsets[:-1])
+
+
+def polygon_centroids(vertices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Calculate the center of mass of every polygon using the shoelace formula. Degenerate polygons
+    (zero area) fall back to the mean of their vertices.
+
+    Returns:
+        centroids: a (count, 2) array of (u,v) centers of mass.
+    """
+    if len(offsets) < 2:
+        return np.zeros((0, 2))
+    starts = offsets[:-1]
+    following = _next_vertices(vertices, offsets)
+    cross_product = vertices[:, 0] * following[:, 1] - following[:, 0] * vertices[:, 1]
+    area = 0.5 * np.add.reduceat(cross_product, starts)
+    moments = np.add.reduceat((vertices + following) * cross_product[:, None], starts, axis=0)
+    means = np.add.reduceat(vertices, starts, axis=0) / np.diff(offsets)[:, None]
+    degenerate = area == 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        centroids = moments / (6 * area[:, None])
+    centroids[degenerate] = means[degenerate]
+    return centroids
+
+
+def points_in_polygons(
+    points: np.ndarray,
+    vertices: np.ndarray,
+    offsets: np.ndarray,
+    point_ids: np.ndarray,
+    polygon_ids: np.ndarray
+) -> np.ndarray:
+    """
+    Test whether points lie inside polygons using ray casting, for many (point, polygon) pairs
+    in a single pass over all the edges involved.
+
+    Args:
+        points: an (m, 2) array of (u,v) points.
+        vertices: the packed polygon vertices.
+        offsets: the packed polygon offsets.
+        point_ids: a (k,) array of indices into points.
+        polygon_ids: a (k,) array of indices into the polygons, paired with point_ids.
+
+    Returns:
+        inside: a (k,) boolean array, true where the point lies inside the paired polygon.
+    """
+    if not len(point_ids):
+        return np.zeros(0, dtype=bool)
+    # Expand every pair into one row per edge of its polygon.
+    lengths = offsets[polygon_ids + 1] - offsets[polygon_ids]
+    pair = np.repeat(np.arange(len(point_ids)), lengths)
+    edge = _ranges(offsets[polygon_ids], lengths)
+    following = edge + 1
+    wraps = following == offsets[polygon_ids + 1][pair]
+    following[wraps] = offsets[polygon_ids][pair[wraps]]
+
+    u, v = points[point_ids][pair].T
+    u0, v0 = vertices[edge].T
+    u1, v1 = vertices[following].T
+    straddles = (v0 > v) != (v1 > v)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossing_u = u0 + (v - v0) * (u1 - u0) / (v1 - v0)
+    crosses = straddles & (u < crossing_u)
+    return np.bincount(pair, weights=crosses, minlength=len(point_ids)) % 2 == 1
+
+
+def polygon_spans(
+    vertices: np.ndarray,
+    offsets: np.ndarray,
+    shape: Tuple[int, int],
+    polygon_ids: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Scan polygons into the runs of cells they fill in a grid of unit cells, cell (row, column)
+    covering [column, column + 1) by [row, row + 1) of the (u,v) coordinates. A cell is filled
+    when its center lies inside the polygon by the same rule as points_in_polygons, so that
+    looking a point up in the cell it falls in agrees with testing the point itself, up to the
+    size of a cell.
+
+    Args:
+        vertices: the packed polygon vertices, in cells.
+        offsets: the packed polygon offsets.
+        shape: the (rows, columns) of the grid. Cells outside of it are left out.
+        polygon_ids: the indices of the polygons to scan.
+
+    Returns:
+        rows, starts, ends: the (k,) arrays of the row and the [start, end) columns of each run.
+            Runs of different polygons may overlap.
+    """
+    rows, columns = shape
+    polygon_ids = np.asarray(polygon_ids, dtype=np.int64)
+    lengths = offsets[polygon_ids + 1] - offsets[polygon_ids]
+    polygon = np.repeat(np.arange(len(polygon_ids)), lengths)
+    edge = _ranges(offsets[polygon_ids], lengths)
+    following = edge + 1
+    wraps = following == offsets[polygon_ids + 1][polygon]
+    following[wraps] = offsets[polygon_ids][polygon[wraps]]
+    u0, v0 = vertices[edge].T
+    u1, v1 = vertices[following].T
+
+    # Every edge crosses the rows whose center lies within [min(v0, v1), max(v0, v1)).
+    first = np.clip(np.ceil(np.minimum(v0, v1) - 0.5), 0, rows).astype(np.int64)
+    last = np.clip(np.ceil(np.maximum(v0, v1) - 0.5), 0, rows).astype(np.int64)
+    crossing = np.repeat(np.arange(len(edge)), last - first)
+    row = _ranges(first, last - first)
+    u0, v0, u1, v1 = u0[crossing], v0[crossing], u1[crossing], v1[crossing]
+    crossing_u = u0 + (row + 0.5 - v0) * (u1 - u0) / (v1 - v0)
+
+    # The crossings of a polygon and a row pair up, in order, into the runs inside it. A run
+    # fills the cells whose center lies within [start, end).
+    order = np.lexsort((crossing_u, row, polygon[crossing]))
+    column = np.clip(np.ceil(crossing_u[order] - 0.5), 0, columns).astype(np.int64)
+    return row[order][0::2], column[0::2], column[1::2]
+
+
+def simplify_polygons(
+    vertices: np.ndarray, offsets: np.ndarray, tolerance: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Simplify every polygon with the Douglas-Peucker algorithm, dropping the vertices that lie
+    within tolerance of the simplified outline. Each ring is split at its first and middle
+    vertices, and every round of the algorithm refines the segments of all polygons at once.
+
+    Args:
+        vertices: the packed polygon vertices.
+        offsets: the packed polygon offsets.
+        tolerance: the largest allowed distance between a dropped vertex and the simplified
+            outline, in the units of vertices.
+
+    Returns:
+        vertices, offsets: the packed simplified polygons. Every polygon keeps at least its
+            first, middle and last vertices.
+    """
+    count = len(offsets) - 1
+    keep = np.zeros(len(vertices), dtype=bool)
+    if not count:
+        return vertices, offsets
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    middles = (starts + ends) // 2
+    keep[starts] = keep[ends] = keep[middles] = True
+
+    u, v = vertices[:, 0], vertices[:, 1]
+    seg_start = np.concatenate([starts, middles])
+    seg_end = np.concatenate([middles, ends])
+    while True:
+        open_segments = seg_end - seg_start > 1
+        seg_start, seg_end = seg_start[open_segments], seg_end[open_segments]
+        if not len(seg_start):
+            break
+        # Squared distance from every interior vertex to the segment joining its segment's
+        # endpoints.
+        lengths = seg_end - seg_start - 1
+        segment = np.repeat(np.arange(len(seg_start)), lengths)
+        interior = _ranges(seg_start + 1, lengths)
+        start, end = seg_start[segment], seg_end[segment]
+        ab_u, ab_v = u[end] - u[start], v[end] - v[start]
+        ap_u, ap_v = u[interior] - u[start], v[interior] - v[start]
+        ab_length = ab_u * ab_u + ab_v * ab_v
+        t = np.divide(ap_u * ab_u + ap_v * ab_v, ab_length, out=np.zeros(len(ab_length)),
+                      where=ab_length > 0)
+        np.clip(t, 0, 1, out=t)
+        off_u, off_v = ap_u - t * ab_u, ap_v - t * ab_v
+        distance = off_u * off_u + off_v * off_v
+
+        # Split each segment at its farthest vertex when that vertex is out of tolerance. The
+        # interior vertices are grouped by segment, so the farthest is the first at the maximum.
+        segment_max = np.maximum.reduceat(distance, np.cumsum(lengths) - lengths)
+        at_max = np.flatnonzero(distance == segment_max[segment])
+        farthest = at_max[np.diff(segment[at_max], prepend=-1) != 0]
+        split = segment_max > tolerance * tolerance
+        split_at = interior[farthest[split]]
+        keep[split_at] = True
+        seg_start, seg_end = (
+            np.concatenate([seg_start[split], split_at]),
+            np.concatenate([split_at, seg_end[split]]),
+        )
+
+    kept = np.add.reduceat(keep.astype(np.int64), starts)
+    simplified_offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(kept, out=simplified_offsets[1:])
+    return vertices[keep], simplified_offsets
+
+
+def simplification_error(
+    vertices: np.ndarray,
+    offsets: np.ndarray,
+    simplified_vertices: np.ndarray,
+    simplified_offsets: np.ndarray
+) -> Dict:
+    """
+    Measure how much simplify_polygons changed the polygons.
+
+    Returns:
+        report: the vertex counts before and after, the largest relative change in polygon area,
+            and the largest shift of a center of mass, in the units of vertices.
+    """
+    areas = np.abs(polygon_areas(vertices, offsets))
+    simplified_areas = np.abs(polygon_areas(simplified_vertices, simplified_offsets))
+    area_error = np.abs(simplified_areas - areas) / np.maximum(areas, np.finfo(float).tiny)
+    shift = np.hypot(*(
+        polygon_centroids(simplified_vertices, simplified_offsets)
+        - polygon_centroids(vertices, offsets)
+    ).T)
+    return {
+        "vertices": len(vertices),
+        "simplified_vertices": len(simplified_vertices),
+        "max_area_error": float(area_error.max(initial=0)),
+        "max_centroid_shift": float(shift.max(initial=0)),
+    }
+
+
+class PolygonIndex:
+    """
+    A uniform grid over the bounding boxes of every polygon in one SAM response. The bounding
+    box, area and center of mass of each polygon are computed once, in a batch, when the index is
+    built, so looking up the polygons under a click only touches the polygons registered in the
+    grid cell containing that click.
+    """
+    def __init__(self, vertices: np.ndarray, offsets: np.ndarray):
+        """
+        Build the index.
+
+        Args:
+            vertices: the packed polygon vertices, see pack_polygons.
+            offsets: the packed polygon offsets, see pack_polygons.
+        """
+        self.vertices = vertices
+        self.offsets = offsets
+        count = len(offsets) - 1
+
+        self.bboxes = polygon_bboxes(vertices, offsets)
+        self.areas = np.abs(polygon_areas(vertices, offsets))
+        self.centroids = polygon_centroids(vertices, offsets)
+        self.bbox_areas = (
+            (self.bboxes[:, 2] - self.bboxes[:, 0]) * (self.bboxes[:, 3] - self.bboxes[:, 1])
+        )
+
+        # Size the grid so that each cell holds a handful of polygons on average.
+        self.cells = int(min(max(np.ceil(np.sqrt(count)), 1), MAX_GRID_CELLS))
+        if count:
+            self.origin = self.bboxes[:, :2].min(axis=0)
+            extent = self.bboxes[:, 2:].max(axis=0) - self.origin
+        else:
+            self.origin = np.zeros(2)
+            extent = np.ones(2)
+        self.cell_size = np.where(extent > 0, extent / self.cells, 1.0)
+
+        # Register every polygon in each cell its bounding box overlaps. Polygons within a cell
+        # are ordered by bounding box area so that the first hit of a lookup is the smallest.
+        by_area = np.argsort(self.bbox_areas, kind="stable")
+        lo = self._cell(self.bboxes[by_area, :2])
+        hi = self._cell(self.bboxes[by_area, 2:])
+        cols = hi[:, 0] - lo[:, 0] + 1
+        counts = cols * (hi[:, 1] - lo[:, 1] + 1)
+        owner = np.repeat(np.arange(count), counts)
+        local = _ranges(np.zeros_like(counts), counts)
+        cell_ids = (
+            (lo[owner, 1] + local // cols[owner]) * self.cells + lo[owner, 0] + local % cols[owner]
+        )
+
+        order = np.argsort(cell_ids, kind="stable")
+        self.cell_polygons = by_area[owner[order]]
+        self.cell_starts = np.searchsorted(
+            cell_ids[order], np.arange(self.cells * self.cells + 1)
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _cell(self, points: np.ndarray) -> np.ndarray:
+        """
+        Convert (u,v) points into integer (column, row) grid cells, clipped to the grid.
+        """
+        cell = np.floor((points - self.origin) / self.cell_size).astype(int)
+        return np.clip(cell, 0, self.cells - 1)
+
+    def candidates(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find, for every point, the polygons whose bounding box contains it.
+
+        Args:
+            points: an (m, 2) array of (u,v) points.
+
+        Returns:
+            point_ids: a (k,) array of indices into points.
+            polygon_ids: a (k,) array of the polygons paired with point_ids. The pairs of each
+                point are ordered from the smallest to the largest bounding box area.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if not len(self) or not len(points):
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        cell = self._cell(points)
+        cell = cell[:, 1] * self.cells + cell[:, 0]
+        starts, stops = self.cell_starts[cell], self.cell_starts[cell + 1]
+        counts = stops - starts
+        point_ids = np.repeat(np.arange(len(points)), counts)
+        polygon_ids = self.cell_polygons[_ranges(starts, counts)]
+
+        u, v = points[point_ids].T
+        bboxes = self.bboxes[polygon_ids]
+        within = (
+            (bboxes[:, 0] <= u) & (bboxes[:, 2] >= u) & (bboxes[:, 1] <= v) & (bboxes[:, 3] >= v)
+        )
+        return point_ids[within], polygon_ids[within]
+
+    def locate(self, points: np.ndarray) -> np.ndarray:
+        """
+        Find, for every point, the smallest polygon that actually contains it. Only the polygons
+        whose bounding box contains the point are ray cast, and ties between nested or
+        overlapping polygons go to the one with the smallest polygon area.
+
+        Args:
+            points: an (m, 2) array of (u,v) points.
+
+        Returns:
+            polygon_ids: an (m,) array with the matched polygon of every point, or -1 where no
+                polygon contains the point.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        point_ids, polygon_ids = self.candidates(points)
+        inside = points_in_polygons(points, self.vertices, self.offsets, point_ids, polygon_ids)
+        point_ids, polygon_ids = point_ids[inside], polygon_ids[inside]
+
+        order = np.lexsort((self.areas[polygon_ids], point_ids))
+        point_ids, polygon_ids = point_ids[order], polygon_ids[order]
+        matched, first = np.unique(point_ids, return_index=True)
+        located = np.full(len(points), -1)
+        located[matched] = polygon_ids[first]
+        return located
+
+    def query(self, u: float, v: float) -> np.ndarray:
+        """
+        Find the polygons whose bounding box contains a single point.
+
+        Returns:
+            polygon_ids: the indices of the polygons whose bounding box contains (u,v), ordered
+                from the smallest to the largest bounding box area.
+        """
+        return self.candidates(np.array([[u, v]]))[1]
@@ -0,0 +1,179 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+from PIL import Image
+import base64
+import io
+import numpy as np
+from functools import cached_property
+from typing import Tuple
+
+"""
+The golf map shared by SAM, ChatGPT and the visualizations. The map is decoded once and each
+encoding of it is computed the first time it is needed and then reused.
+"""
+
+# Quality of the JPEG variant of the map.
+JPEG_QUALITY = 90
+
+# How the map is prepared before being uploaded to each destination: the longest side is shrunk
+# to max_dimension pixels (None keeps the full resolution), then the map is encoded in format
+# ("PNG", "JPEG" or "WEBP") at quality (ignored for PNG). GPT-4o downsizes images to fit 2048
+# pixels anyway, and SAM segments at 1024 pixels internally. Both destinations share one
+# preparation, so a message resizes and encodes the map once; an upload that differs only in its
+# encoding still reuses the resized map, see MapImage.upload.
+SAM_UPLOAD = {"max_dimension": 2048, "format": "JPEG", "quality": 90}
+LLM_UPLOAD = dict(SAM_UPLOAD)
+
+
+def _encode(image: Image.Image, format: str, quality: int = None) -> bytes:
+    image_bytes = io.BytesIO()
+    options = {} if format == "PNG" or quality is None else {"quality": quality}
+    image.save(image_bytes, format=format, **options)
+    return image_bytes.getvalue()
+
+
+class Upload:
+    """
+    An encoded, possibly downscaled, copy of a map ready to be sent to SAM or ChatGPT.
+    """
+    def __init__(self, data: bytes, format: str, factor: float):
+        """
+        Args:
+            data: the encoded image.
+            format: the PIL format of data, such as "PNG" or "JPEG".
+            factor: the upload size over the original size. Pixel coordinates in the upload
+                divided by factor are coordinates in the original map.
+        """
+        self.data = data
+        self.format = format
+        self.factor = factor
+
+    @cached_property
+    def b64(self) -> str:
+        return base64.b64encode(self.data).decode()
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{Image.MIME[self.format]};base64,{self.b64}"
+
+
+class MapImage:
+    """
+    A golf map image with lazily computed, memoized representations.
+    """
+    def __init__(self, path: str):
+        """
+        Args:
+            path: the path of the image file. The file is not read until a representation is used.
+        """
+        self.path = path
+        self.uploads = {}
+        self.resized = {}
+
+    @cached_property
+    def pixels(self) -> Image.Image:
+        """
+        The decoded image, in RGB.
+        """
+        with Image.open(self.path) as image:
+            return image.convert("RGB")
+
+    @cached_property
+    def size(self):
+        """
+        The (width, height) of the image in pixels.
+        """
+        return self.pixels.size
+
+    @cached_property
+    def png_bytes(self) -> bytes:
+        image_bytes = io.BytesIO()
+        self.pixels.save(image_bytes, format='PNG')
+        return image_bytes.getvalue()
+
+    @cached_property
+    def b64_png(self) -> str:
+        """
+        The full resolution PNG encoding as a base64 string.
+        """
+        return self.upload().b64
+
+    @cached_property
+    def jpeg_bytes(self) -> bytes:
+        image_bytes = io.BytesIO()
+        self.pixels.save(image_bytes, format='JPEG', quality=JPEG_QUALITY)
+        return image_bytes.getvalue()
+
+    def upload(
+        self, max_dimension: int = None, format: str = "PNG", quality: int = None
+    ) -> Upload:
+        """
+        Prepare the map for upload, see SAM_UPLOAD and LLM_UPLOAD. Each distinct preparation is
+        computed once, and each downscaled size is resized once whatever its encodings.
+
+        Args:
+            max_dimension: the largest allowed width or height, or None to keep the full size.
+            format: the encoding, "PNG", "JPEG" or "WEBP".
+            quality: the encoder quality for JPEG and WEBP.
+
+        Returns:
+            upload: the encoded map, with the factor needed to map its pixels back to the original.
+        """
+        format = format.upper()
+        key = (max_dimension, format, quality)
+        if key not in self.uploads:
+            image, factor = self.resize(max_dimension)
+            if factor == 1.0 and format == "PNG":
+                self.uploads[key] = Upload(self.png_bytes, format, factor)
+            else:
+                self.uploads[key] = Upload(_encode(image, format, quality), format, factor)
+        return self.uploads[key]
+
+    def resize(self, max_dimension: int = None) -> Tuple[Image.Image, float]:
+        """
+        The map shrunk so that its largest side fits max_dimension, computed once per size.
+
+        Returns:
+            image, factor: the resized map, and its size over the original size.
+        """
+        if max_dimension not in self.resized:
+            width, height = self.size
+            image, factor = self.pixels, 1.0
+            if max_dimension and max(width, height) > max_dimension:
+                factor = max_dimension / max(width, height)
+                image = image.resize(
+                    (round(width * factor), round(height * factor)), Image.Resampling.LANCZOS
+                )
+            self.resized[max_dimension] = image, factor
+        return self.resized[max_dimension]
+
+    def tile(self, box: Tuple[int, int, int, int], format: str = "PNG",
+             quality: int = None) -> Upload:
+        """
+        Prepare a full resolution crop of the map for upload, see tiling.tile_boxes. Pixel
+        coordinates in the crop plus (u0,v0) are coordinates in the original map.
+
+        Args:
+            box: the (u0,v0,u1,v1) pixel box of the crop.
+            format: the encoding, "PNG", "JPEG" or "WEBP".
+            quality: the encoder quality for JPEG and WEBP.
+        """
+        format = format.upper()
+        key = (tuple(box), format, quality)
+        if key not in self.uploads:
+            image = self.pixels.crop(tuple(box))
+            self.uploads[key] = Upload(_encode(image, format, quality), format, 1.0)
+        return self.uploads[key]
+
+    @cached_property
+    def bgr(self) -> np.ndarray:
+        """
+        The pixels as a read-only BGR array, the layout opencv draws on. Copy before drawing.
+        """
+        array = np.ascontiguousarray(np.asarray(self.pixels)[:, :, ::-1])
+        array.flags.writeable = False
+        return array
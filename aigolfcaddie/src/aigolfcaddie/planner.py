@@ -0,0 +1,391 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import heapq
+import itertools
+import math
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from aigolfcaddie.simulator import HazardMap, TERRAINS, simulate_shots
+from aigolfcaddie.tracing import current_span, traced
+
+"""
+A local planner answering with the same FORMATTED JSON as ChatGPT, in milliseconds, from the
+setup information and the physical features of analyze_polygons.
+
+The line of play runs from the tee through the fairways to the green. Each shot either carries a
+club its full distance along that line, lays up to LAYUP_FRACTIONS of it, or, once the green is
+in reach, goes at the green with the shortest club that gets there. A shot of d yards misses its
+target by up to d * tan(level_error) yards, and landing within that error of a bunker costs up to
+BUNKER_PENALTY strokes, and the putts expected grow with how far the approach misses the hole.
+A shortest path search over the yards left to the green finds the club sequence with the fewest
+expected strokes:
+
+    plan = plan_hole(setup_info(), metrics)
+
+Given the HazardMap of the hole, the bunker penalty is instead the simulated rate at which each
+candidate shot finds a bunker, see simulator.py.
+
+The plan can answer a hole on its own, stand in when ChatGPT cannot be reached, or be given to
+ChatGPT as a starting point, see utils.STRATEGY_PLANNER.
+"""
+
+# Strokes a landing in a bunker is expected to cost.
+BUNKER_PENALTY = 0.5
+
+# Radius of a bunker whose outline is not known, in yards.
+DEFAULT_BUNKER_RADIUS = 10.0
+
+# Fractions of a club's full distance a shot may lay up to.
+LAYUP_FRACTIONS = (1.0, 0.85, 0.7)
+
+# An approach landing this close to the hole is planned with a single putt, further out with two.
+ONE_PUTT_YARDS = 10.0
+
+# The distance the first of two putts leaves to the hole.
+TAP_IN_YARDS = 1.0
+
+# Obstacles closer than this to the line of play are in its center.
+CENTER_YARDS = 5.0
+
+# Shots before the green is reached, at most.
+MAX_SHOTS = 8
+
+# Landings sampled per candidate shot when planning against a HazardMap.
+PLANNER_SAMPLES = 256
+
+PUTTER = "putter"
+
+
+def dispersion(distance, level_error: float):
+    """
+    How far off target a shot of distance yards, or an array of them, can land, for an error of
+    level_error degrees.
+    """
+    return distance * math.tan(math.radians(level_error))
+
+
+def feature_radius(feature: Dict, default: float) -> float:
+    """
+    The radius of a feature from its bounding box "coordinates", or default without them.
+    """
+    if "coordinates" not in feature:
+        return default
+    u0, v0, u1, v1 = feature["coordinates"]
+    return max(u1 - u0, v1 - v0) / 2
+
+
+class LineOfPlay:
+    """
+    The polyline from the tee through the fairways to the green, measured in yards from the tee.
+    """
+    def __init__(self, points: np.ndarray):
+        self.points = points
+        lengths = np.hypot(*np.diff(points, axis=0).T)
+        self.stations = np.concatenate([[0.0], np.cumsum(lengths)])
+        self.length = float(self.stations[-1])
+
+    def point(self, station):
+        """
+        The point station yards along the line, or the (k,2) points of an array of stations.
+        """
+        return np.stack([np.interp(station, self.stations, self.points[:, 0]),
+                         np.interp(station, self.stations, self.points[:, 1])], axis=-1)
+
+    def offset(self, point: np.ndarray) -> Tuple[float, float]:
+        """
+        Where a point is relative to the line.
+
+        Returns:
+            station: the yards along the line of the closest point of the line.
+            side: the signed yards from the line, positive to the right of the direction of play.
+        """
+        best = (math.inf, 0.0, 0.0)
+        for start, end, station in zip(self.points[:-1], self.points[1:], self.stations):
+            direction = end - start
+            length = float(np.hypot(*direction))
+            if length == 0:
+                continue
+            along = min(max(float(np.dot(point - start, direction)) / length, 0.0), length)
+            closest = start + direction * (along / length)
+            # Image coordinates point down, so a positive cross product is to the right.
+            cross = float(direction[0] * (point - start)[1] - direction[1] * (point - start)[0])
+            distance = float(np.hypot(*(point - closest)))
+            if distance < best[0]:
+                best = (distance, station + along, math.copysign(distance, cross))
+        return best[1], best[2]
+
+    def bend(self) -> float:
+        """
+        The angle in degrees between the first and last legs, positive when bending right.
+        """
+        first, last = np.diff(self.points[:2], axis=0)[0], np.diff(self.points[-2:], axis=0)[0]
+        return math.degrees(math.atan2(first[0] * last[1] - first[1] * last[0],
+                                       float(np.dot(first, last))))
+
+
+def line_of_play(tee: np.ndarray, green: np.ndarray, fairways: List[np.ndarray]) -> LineOfPlay:
+    """
+    The line from the tee to the green through the fairways lying between them.
+    """
+    axis = green - tee
+    length_squared = float(np.dot(axis, axis)) or 1.0
+    between = []
+    for fairway in fairways:
+        along = float(np.dot(fairway - tee, axis)) / length_squared
+        if 0 < along < 1:
+            between.append((along, fairway))
+    between.sort(key=lambda item: item[0])
+    return LineOfPlay(np.array([tee] + [fairway for _, fairway in between] + [green], dtype=float))
+
+
+def bunker_penalty(
+    points: np.ndarray, errors: np.ndarray, bunkers: np.ndarray, radii: np.ndarray
+) -> np.ndarray:
+    """
+    The strokes expected to be lost to bunkers by shots aimed at points.
+
+    Args:
+        points: the (k,2) aim points.
+        errors: how far off target each shot can land, see dispersion.
+        bunkers: the (n,2) bunker centers.
+        radii: the radius of each bunker.
+
+    Returns:
+        penalties: the (k,) expected strokes lost by each shot.
+    """
+    if not len(bunkers):
+        return np.zeros(len(points))
+    offsets = points[:, None, :] - bunkers[None, :, :]
+    gaps = np.hypot(offsets[..., 0], offsets[..., 1]) - radii
+    reach = np.maximum(errors, 1.0)[:, None]
+    return BUNKER_PENALTY * np.clip(1 - gaps / reach, 0, 1).sum(axis=1)
+
+
+def expected_putts(miss: float) -> float:
+    """
+    The putts expected from miss yards away: one from the hole, one and a half from
+    ONE_PUTT_YARDS, approaching two further out.
+    """
+    return 1 + miss / (miss + ONE_PUTT_YARDS)
+
+
+def putts(miss: float) -> List[Tuple[float, float]]:
+    """
+    The putts from miss yards away, as (distance hit, distance from hole) pairs.
+    """
+    if miss <= ONE_PUTT_YARDS:
+        return [(miss, 0.0)]
+    return [(miss - TAP_IN_YARDS, TAP_IN_YARDS), (TAP_IN_YARDS, 0.0)]
+
+
+def pick_features(setup: Dict, metrics: List[Dict]) -> Optional[Tuple[Dict, Dict]]:
+    """
+    The tee the player tees off from and the green of the hole, or None without both.
+    """
+    tees = [metric for metric in metrics if metric["feature_name"] == "tee"]
+    greens = [metric for metric in metrics if metric["feature_name"] == "green"]
+    if not tees or not greens:
+        return None
+    tee = next((tee for tee in tees if tee.get("tee_color") == setup.get("tee_color")), tees[0])
+    # The green of the hole is the one farthest from the tee.
+    center = np.array(tee["feature_center_yards"], dtype=float)
+    green = max(greens, key=lambda green: float(
+        np.hypot(*(np.array(green["feature_center_yards"], dtype=float) - center))
+    ))
+    return tee, green
+
+
+@traced("planner")
+def plan_hole(
+    setup: Dict,
+    metrics: List[Dict],
+    hazards: Optional[HazardMap] = None,
+    samples: int = PLANNER_SAMPLES,
+    seed: int = 0
+) -> Optional[Dict]:
+    """
+    Plan the hole as ChatGPT would, following the FORMATTED schema.
+
+    Args:
+        setup: the setup information, see utils.setup_info. The clubs listed in both
+            "avilable_clubs" and "club_performance" are used, the putter only on the green.
+        metrics: the physical features, see utils.analyze_polygons. Their "coordinates", when
+            present, size the bunkers.
+        hazards: the terrain of the hole, to simulate each candidate shot against the bunker
+            outlines instead of estimating its penalty from the bunker centers.
+        samples: the landings simulated per candidate shot.
+        seed: the seed of the simulation, so that plans are repeatable.
+
+    Returns:
+        plan: the strategy and expected outcome, or None when there is no tee, green or club.
+    """
+    picked = pick_features(setup, metrics)
+    performance = setup.get("club_performance", {})
+    available = setup.get("avilable_clubs", list(performance))
+    clubs = sorted(
+        ((club, float(performance[club])) for club in available
+         if club in performance and club != PUTTER and performance[club] > 0),
+        key=lambda item: item[1],
+    )
+    if picked is None or not clubs:
+        return None
+    tee, green = picked
+    level_error = float(setup.get("level_error", 0))
+
+    def center(feature):
+        return np.array(feature["feature_center_yards"], dtype=float)
+
+    fairways = [center(metric) for metric in metrics if metric["feature_name"] == "fairway"]
+    bunker_metrics = [metric for metric in metrics if metric["feature_name"] == "bunker"]
+    bunkers = np.array([center(metric) for metric in bunker_metrics], dtype=float).reshape(-1, 2)
+    radii = np.array([feature_radius(metric, DEFAULT_BUNKER_RADIUS) for metric in bunker_metrics])
+    line = line_of_play(center(tee), center(green), fairways)
+
+    # Every full or laid up shot.
+    shot_clubs = [club for club, _ in clubs for _ in LAYUP_FRACTIONS]
+    hits = np.array([carry * fraction for _, carry in clubs for fraction in LAYUP_FRACTIONS])
+    rng = np.random.default_rng(seed)
+    bunker = TERRAINS.index("bunker")
+
+    def penalties(station, targets, distances):
+        """The strokes lost to bunkers by shots from station to each of targets."""
+        if hazards is None:
+            return bunker_penalty(line.point(targets), dispersion(distances, level_error),
+                                  bunkers, radii)
+        rates = simulate_shots(hazards, line.point(station), line.point(targets), distances,
+                               level_error, samples, rng)
+        return BUNKER_PENALTY * rates[:, bunker]
+
+    # A* search over the yards played along the line. Each entry is the expected strokes plus a
+    # lower bound of the strokes left, a tie breaker, the expected strokes, the yards played
+    # (None once holed), the shots and the plan so far. At least one more shot than it takes to
+    # bring the green within reach, and a putt, are left.
+    longest = clubs[-1][1]
+
+    def strokes_left(remaining):
+        return np.ceil(np.maximum(remaining - longest, 0) / longest) + 2
+
+    order = itertools.count()
+    queue = [(float(strokes_left(line.length)), next(order), 0.0, 0.0, 0, [])]
+    best = {}
+    while queue:
+        _, _, cost, station, count, shots = heapq.heappop(queue)
+        if station is None:
+            current_span().set(states=len(best), shots=len(shots))
+            return describe_plan(shots, cost, line, bunker_metrics, metrics)
+        if best.get(round(station), math.inf) < cost or count >= MAX_SHOTS:
+            continue
+        remaining = line.length - station
+
+        # Go at the green with the shortest club that reaches it.
+        reach = next((club for club, carry in clubs if carry >= remaining), None)
+        if reach is not None:
+            error = dispersion(remaining, level_error)
+            miss = error / 2
+            finish = putts(miss)
+            penalty = penalties(station, np.array([line.length]), np.array([remaining]))[0]
+            total = cost + 1 + expected_putts(miss) + float(penalty)
+            plan = shots + [(reach, remaining, line.length, miss)] + \
+                [(PUTTER, hit, None, left) for hit, left in finish]
+            heapq.heappush(queue, (total, next(order), total, None, count + 1, plan))
+
+        # Shots short of the green, all scored at once.
+        short = np.flatnonzero(hits < remaining)
+        targets = station + hits[short]
+        totals = cost + 1 + penalties(station, targets, hits[short])
+        bounds = totals + strokes_left(line.length - targets)
+        for index, target, total, bound in zip(short.tolist(), targets.tolist(), totals.tolist(),
+                                               bounds.tolist()):
+            if best.get(round(target), math.inf) <= total:
+                continue
+            best[round(target)] = total
+            heapq.heappush(queue, (bound, next(order), total, target, count + 1, shots + [
+                (shot_clubs[index], float(hits[index]), target, line.length - target)
+            ]))
+    return None
+
+
+def describe_plan(
+    shots: List[Tuple], strokes: float, line: LineOfPlay, bunkers: List[Dict], metrics: List[Dict]
+) -> Dict:
+    """
+    Write a plan found by plan_hole in the FORMATTED schema.
+    """
+    strategy = []
+    for club, hit, station, left in shots:
+        if club == PUTTER:
+            location = "in the hole" if left == 0 else "next to the hole"
+        elif station >= line.length:
+            location = "on the green"
+        else:
+            location = landing_location(line, station, metrics)
+        strategy.append({
+            "club": club,
+            "distance hit": round(hit),
+            "estimated location": location,
+            "distance_from_hole": round(left),
+        })
+
+    obstacles = []
+    tee = line.points[0]
+    for bunker in bunkers:
+        point = np.array(bunker["feature_center_yards"], dtype=float)
+        _, side = line.offset(point)
+        obstacles.append({
+            "obstacle_type": "bunker",
+            "distance_from_tee": round(float(np.hypot(*(point - tee)))),
+            "left_right_or_center_from_fairway":
+                "center" if abs(side) < CENTER_YARDS else "right" if side > 0 else "left",
+        })
+
+    full_shots = [shot for shot in strategy if shot["club"] != PUTTER]
+    explanation = (
+        f"The hole plays {round(line.length)} yards along the fairway. "
+        + ", then ".join(f"{shot['club']} {shot['distance hit']} yards" for shot in full_shots)
+        + f" reaches the green, keeping each landing clear of the {len(bunkers)} bunker"
+        + ("s" if len(bunkers) != 1 else "") + " within the expected error where possible."
+    )
+    return {
+        "strategy": strategy,
+        "expected_outcome": {
+            "explanation_of_strategy": explanation,
+            "stroke_count": round(strokes, 1),
+            "fairway_shape": fairway_shape(line),
+            "location_of_all_obstacles": obstacles,
+        },
+    }
+
+
+def landing_location(line: LineOfPlay, station: float, metrics: List[Dict]) -> str:
+    """
+    Describe where a shot landing station yards along the line ends up.
+    """
+    point = line.point(station)
+    to_green = round(line.length - station)
+    for metric in metrics:
+        if metric["feature_name"] != "fairway":
+            continue
+        center = np.array(metric["feature_center_yards"], dtype=float)
+        if np.hypot(*(point - center)) <= feature_radius(metric, 0.0):
+            return f"the fairway, {to_green} yards from the green"
+    return f"the line of play, {to_green} yards from the green"
+
+
+def fairway_shape(line: LineOfPlay) -> str:
+    """
+    Describe the line of play: its length and whether it bends.
+    """
+    if len(line.points) < 3:
+        return f"Straight from the tee to the green, {round(line.length)} yards."
+    bend = line.bend()
+    if abs(bend) < 10:
+        shape = "Straight"
+    else:
+        shape = f"Doglegs {'right' if bend > 0 else 'left'} by {round(abs(bend))} degrees"
+    return f"{shape} through {len(line.points) - 2} fairway section" \
+        f"{'s' if len(line.points) > 3 else ''}, {round(line.length)} yards to the green."
@@ -0,0 +1,140 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import json
+import math
+from typing import Dict, List, Optional
+
+"""
+Compact serialization of the user input sent to ChatGPT, see utils.llm_input.
+
+Prompt tokens drive both the latency and the cost of a ChatGPT answer, so each section of the
+input is written as JSON without indentation or spaces, with numbers rounded to PROMPT_DIGITS
+decimals. Each physical feature is listed once with its "feature_id", and the inter-feature
+distances are a table indexed by those ids instead of a list repeating both features per pair:
+
+    {"0":{"2":131.4,"3":212.0},"4":{"1":88.9}}
+
+reads as: feature 0 is 131.4 yards from feature 2 and 212.0 yards from feature 3, and feature 4
+is 88.9 yards from feature 1.
+
+estimate_tokens counts tokens with tiktoken when it is installed, and approximates them from the
+length of the text otherwise.
+"""
+
+# Decimals kept for the yards in the prompt. A tenth of a yard is well below the SAM accuracy.
+PROMPT_DIGITS = 1
+
+# Characters per token assumed when tiktoken is not installed. Close for JSON and English text.
+CHARACTERS_PER_TOKEN = 4
+
+# The tiktoken encoding of GPT-4o.
+TOKEN_ENCODING = "o200k_base"
+
+_encoding = None
+
+
+def round_numbers(value, digits: int = PROMPT_DIGITS):
+    """
+    Round every float nested in lists, tuples and dictionaries. Tuples become lists, as in JSON.
+
+    Args:
+        value: a JSON serializable value.
+        digits: the decimals kept.
+    """
+    if isinstance(value, float):
+        return round(value, digits)
+    if isinstance(value, dict):
+        return {key: round_numbers(item, digits) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [round_numbers(item, digits) for item in value]
+    return value
+
+
+def compact_json(value, digits: int = PROMPT_DIGITS) -> str:
+    """
+    Serialize a value as JSON without whitespace, with its floats rounded to digits decimals.
+    """
+    return json.dumps(round_numbers(value, digits), separators=(",", ":"), ensure_ascii=False)
+
+
+def distance_table(distances: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """
+    Index the distances by feature id.
+
+    Args:
+        distances: the inter-feature distances, see utils.feature_analysis.
+
+    Returns:
+        table: maps the "feature_1" id of each distance to a dictionary from the "feature_2" id to
+            the distance in yards. Ids are strings, as JSON keys are.
+    """
+    table = {}
+    for distance in distances:
+        table.setdefault(str(distance["feature_1"]), {})[str(distance["feature_2"])] = \
+            distance["distance"]
+    return table
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    The number of tokens ChatGPT reads for the text, exactly with tiktoken or else approximately.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+        except ImportError:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+
+
+def compact_sections(
+    setup: Dict,
+    features: List[Dict],
+    distances: List[Dict],
+    plan: Optional[Dict] = None,
+    digits: int = PROMPT_DIGITS
+) -> Dict[str, str]:
+    """
+    Serialize the three parts of the user input described in the system instructions.
+
+    Args:
+        setup: the setup information, see utils.setup_info.
+        features: the physical features, see utils.analyze_polygons, without their "coordinates".
+        distances: the inter-feature distances, see utils.feature_analysis.
+        plan: a plan of the local planner to start from, see planner.plan_hole, sent as a fourth
+            "Local Plan" section when given.
+        digits: the decimals kept for the yards.
+
+    Returns:
+        sections: maps the title of each section to its text, in the order of the input.
+    """
+    sections = {
+        "Setup Information": compact_json(setup, digits),
+        "Physical Features": compact_json(features, digits),
+        "Inter-Feature Distance": compact_json(distance_table(distances), digits),
+    }
+    if plan is not None:
+        sections["Local Plan"] = compact_json(plan, digits)
+    return sections
+
+
+def format_sections(sections: Dict[str, str]) -> str:
+    """
+    Write sections, see compact_sections, each under a "## <title>" heading.
+    """
+    return "".join(f"## {title}\n{text}\n" for title, text in sections.items())
+
+
+def section_tokens(sections: Dict[str, str]) -> Dict[str, int]:
+    """
+    Estimate the tokens of each section, see estimate_tokens.
+    """
+    return {title: estimate_tokens(text) for title, text in sections.items()}
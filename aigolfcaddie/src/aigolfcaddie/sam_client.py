@@ -0,0 +1,240 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import asyncio
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, List, Tuple
+
+from aigolfcaddie.transport import PACKED_CONTENT_TYPE
+
+"""
+HTTP clients for the SAM server. All calls share one pooled session so that the TLS connection
+through the ngrok tunnel is kept alive between requests instead of being renegotiated each time.
+SamClient is blocking, AsyncSamClient is its asyncio counterpart used by the app.
+"""
+
+# Seconds to wait for the tunnel to accept a connection, and for the server to answer. Automask
+# with SAM2-L and 100 points per side takes a while, so the read timeout is generous.
+SAM_TIMEOUT = (10, 300)
+
+# Status codes worth retrying. The tunnel answers 502/504 while the server is restarting.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def accept_headers(packed: bool) -> Dict:
+    """
+    The headers of a segmentation request. Responses may always be gzip compressed.
+    """
+    accept = f"{PACKED_CONTENT_TYPE}, application/json;q=0.5" if packed else "application/json"
+    return {"Accept": accept, "Accept-Encoding": "gzip"}
+
+
+def point_prompts(points: List[Tuple[float, float]]) -> List[Dict]:
+    """
+    Turn clicks into samapi point prompts, one positive (foreground) point per prompt.
+    """
+    return [
+        {"point_coords": [[int(round(u)), int(round(v))]], "point_labels": [1]}
+        for u, v in points
+    ]
+
+
+class SamClient:
+    """
+    A client for the samapi server with connection pooling, bounded retries and timeouts.
+    """
+    def __init__(
+        self,
+        address: str,
+        pool_size: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: Tuple[float, float] = SAM_TIMEOUT
+    ):
+        """
+        Args:
+            address: the base url of the SAM API, ending in "/sam/".
+            pool_size: the number of keep-alive connections held open to the server.
+            retries: how many times a request is retried after a connection reset or a 5xx
+                response. Retries back off exponentially, starting at backoff seconds.
+            backoff: the delay before the first retry, in seconds.
+            timeout: the (connect, read) timeouts of every request, in seconds.
+        """
+        self.address = address
+        self.timeout = timeout
+        # Segmentation requests are idempotent, so POSTs are retried like GETs.
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def version(self) -> str:
+        """
+        Return the samapi server package version. Also, can be used to check if server is
+        connected.
+        """
+        return self.session.get(self.address + "version/", timeout=self.timeout).text
+
+    def automask(self, b64str_img: str, params: Dict, packed: bool = False) -> requests.Response:
+        """
+        POST an image to /sam/automask/.
+
+        Args:
+            b64str_img: an image encoded as an base64 character string.
+            params: the SAM automask parameters, see SAM_AUTOMASK_PARAMS in utils.
+            packed: ask for the compact binary polygon format of transport.py. Servers that do
+                not support it answer with GeoJSON, so decode with transport.decode_sam_response.
+
+        Returns:
+            response: the server response. Raises a requests exception if the server could not be
+                reached or did not answer within the timeouts, after all retries.
+        """
+        return self.session.post(
+            self.address + "automask/",
+            json={"b64img": b64str_img, **params},
+            headers=accept_headers(packed),
+            timeout=self.timeout
+        )
+
+    def prompts(
+        self, b64str_img: str, points: List[Tuple[float, float]], params: Dict,
+        packed: bool = False
+    ) -> requests.Response:
+        """
+        POST an image with one positive point prompt per click to /sam/prompts/, so that the
+        server only decodes the masks of the clicked features, all in one request. Servers
+        without this endpoint answer 404, see prompt.
+
+        Args:
+            b64str_img: an image encoded as an base64 character string.
+            points: the (u,v) pixel coordinates of the clicks, in the uploaded image.
+            params: the SAM parameters, see SAM_PROMPT_PARAMS in utils.
+            packed: ask for the compact binary polygon format, see automask.
+        """
+        return self.session.post(
+            self.address + "prompts/",
+            json={"b64img": b64str_img, "prompts": point_prompts(points), **params},
+            headers=accept_headers(packed),
+            timeout=self.timeout
+        )
+
+    def prompt(
+        self, b64str_img: str, point: Tuple[float, float], params: Dict
+    ) -> requests.Response:
+        """
+        POST an image with a single positive point prompt to the /sam/ endpoint of samapi.
+        """
+        return self.session.post(
+            self.address,
+            json={"b64img": b64str_img, **point_prompts([point])[0], **params},
+            headers=accept_headers(False),
+            timeout=self.timeout
+        )
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncSamClient:
+    """
+    An asyncio client for the samapi server with the same pooling, retry and timeout behaviour
+    as SamClient.
+    """
+    def __init__(
+        self,
+        address: str,
+        pool_size: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: Tuple[float, float] = SAM_TIMEOUT
+    ):
+        """
+        Args:
+            address: the base url of the SAM API, ending in "/sam/".
+            pool_size: the number of keep-alive connections held open to the server.
+            retries: how many times a request is retried after a connection reset or a 5xx
+                response. Retries back off exponentially, starting at backoff seconds.
+            backoff: the delay before the first retry, in seconds.
+            timeout: the (connect, read) timeouts of every request, in seconds.
+        """
+        self.address = address
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        Send a request, retrying connection errors and 5xx responses with exponential backoff.
+        """
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = await self.client.request(method, self.address + path, **kwargs)
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    return response
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def version(self) -> str:
+        """
+        Return the samapi server package version.
+        """
+        return (await self._request("GET", "version/")).text
+
+    async def automask(
+        self, b64str_img: str, params: Dict, packed: bool = False
+    ) -> httpx.Response:
+        """
+        POST an image to /sam/automask/, see SamClient.automask. Raises an httpx exception if the
+        server could not be reached or did not answer within the timeouts, after all retries.
+        """
+        return await self._request(
+            "POST", "automask/", json={"b64img": b64str_img, **params},
+            headers=accept_headers(packed)
+        )
+
+    async def prompts(
+        self, b64str_img: str, points: List[Tuple[float, float]], params: Dict,
+        packed: bool = False
+    ) -> httpx.Response:
+        """
+        POST an image with one point prompt per click to /sam/prompts/, see SamClient.prompts.
+        """
+        return await self._request(
+            "POST", "prompts/",
+            json={"b64img": b64str_img, "prompts": point_prompts(points), **params},
+            headers=accept_headers(packed)
+        )
+
+    async def prompt(
+        self, b64str_img: str, point: Tuple[float, float], params: Dict
+    ) -> httpx.Response:
+        """
+        POST an image with a single point prompt to /sam/, see SamClient.prompt.
+        """
+        return await self._request(
+            "POST", "", json={"b64img": b64str_img, **point_prompts([point])[0], **params},
+            headers=accept_headers(False)
+        )
+
+    async def close(self) -> None:
+        await self.client.aclose()
@@ -0,0 +1,215 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import math
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from aigolfcaddie.geometry import PolygonIndex, polygon_spans
+
+"""
+Monte Carlo landing probabilities of a shot against the segmented golf features.
+
+The features matched by utils.match_features are painted into a raster, a HazardMap, once per
+hole. A shot is then thousands of landings sampled in one NumPy batch: the direction is off by a
+normal error with a standard deviation of half the level_error degrees, so about 95% of shots
+land within level_error of the line, and the distance is off by DISTANCE_ERROR of the carry.
+Looking every landing up in the raster gives the rate at which the shot finds each terrain:
+
+    hazards = HazardMap.from_matches(*match_features(vertices, offsets, course_data))
+    rates = simulate_shot(hazards, tee, aim, club_performance["driver"], level_error)
+    rates["bunker"], rates["fairway"], ...
+
+100,000 samples take a few milliseconds, so candidate shots can be compared inside a planning
+loop, see planner.plan_hole.
+"""
+
+# The terrains a landing can find. Features painted later win where they overlap, so a bunker
+# inside a fairway is a bunker. Anything outside the features is rough.
+TERRAINS = ("rough", "fairway", "tee", "green", "bunker")
+
+# The size of a raster cell, in yards.
+RESOLUTION_YARDS = 0.5
+
+# The standard deviation of the carry, as a fraction of it.
+DISTANCE_ERROR = 0.05
+
+# Landings sampled per shot.
+SAMPLES = 100_000
+
+
+class HazardMap:
+    """
+    A raster of the terrain of the hole, looked up by position in yards.
+    """
+    def __init__(self, grid: np.ndarray, origin: np.ndarray, resolution: float):
+        """
+        Args:
+            grid: the (rows, columns) index into TERRAINS of each cell.
+            origin: the (u,v) yards of the corner of the first cell.
+            resolution: the size of a cell, in yards.
+        """
+        self.grid = grid
+        self.origin = np.asarray(origin, dtype=np.float32)
+        self.resolution = resolution
+
+    @classmethod
+    def from_polygons(
+        cls,
+        vertices: np.ndarray,
+        offsets: np.ndarray,
+        names: List[str],
+        resolution: float = RESOLUTION_YARDS
+    ) -> "HazardMap":
+        """
+        Paint packed polygons, in yards, with the terrain named for each.
+
+        Args:
+            vertices: the packed polygons, see geometry.pack_polygons.
+            offsets: the packed polygon offsets.
+            names: the feature type of each polygon, one of TERRAINS.
+            resolution: the size of a cell, in yards.
+        """
+        if not len(vertices):
+            return cls(np.zeros((1, 1), dtype=np.uint8), np.zeros(2), resolution)
+        origin = vertices.min(axis=0) - resolution
+        columns, rows = np.ceil((vertices.max(axis=0) - origin) / resolution).astype(int) + 2
+        grid = np.zeros((rows, columns), dtype=np.uint8)
+        # Painted with the same cells as lookup: cell i covers [i, i + 1) in cells of the map.
+        cells = (vertices - origin) / resolution
+        for code, terrain in enumerate(TERRAINS):
+            polygon_ids = [i for i, name in enumerate(names) if name == terrain]
+            if not polygon_ids:
+                continue
+            spans = polygon_spans(cells, offsets, grid.shape, polygon_ids)
+            # One slice per run: runs are few next to the cells they fill.
+            for row, start, end in zip(*(span.tolist() for span in spans)):
+                grid[row, start:end] = code
+        return cls(grid, origin, resolution)
+
+    @classmethod
+    def from_matches(
+        cls,
+        index: PolygonIndex,
+        matches: List[Tuple[str, Dict, int]],
+        resolution: float = RESOLUTION_YARDS
+    ) -> "HazardMap":
+        """
+        Paint the polygons matched to the clicks, see utils.match_features.
+        """
+        polygons = {polygon: name for name, _, polygon in matches}
+        rings = [index.vertices[index.offsets[i]:index.offsets[i + 1]] for i in polygons]
+        offsets = np.cumsum([0] + [len(ring) for ring in rings])
+        vertices = np.concatenate(rings) if rings else np.zeros((0, 2))
+        return cls.from_polygons(vertices, offsets, list(polygons.values()), resolution)
+
+    def lookup(self, points: np.ndarray) -> np.ndarray:
+        """
+        The index into TERRAINS at each of the (..., 2) points. Points off the map are rough.
+        """
+        cells = np.floor((points - self.origin) / self.resolution).astype(np.int32)
+        u, v = cells[..., 0], cells[..., 1]
+        rows, columns = self.grid.shape
+        inside = (u >= 0) & (u < columns) & (v >= 0) & (v < rows)
+        codes = self.grid[np.where(inside, v, 0), np.where(inside, u, 0)]
+        return np.where(inside, codes, 0)
+
+
+def sample_landings(
+    origin: np.ndarray,
+    aims: np.ndarray,
+    carries: np.ndarray,
+    level_error: float,
+    samples: int,
+    rng: np.random.Generator,
+    distance_error: float = DISTANCE_ERROR
+) -> np.ndarray:
+    """
+    Sample where shots land.
+
+    Args:
+        origin: the (u,v) yards the shots are played from.
+        aims: the (k,2) points aimed at.
+        carries: the (k,) yards each shot carries, on average.
+        level_error: the dispersion of the player, in degrees, see setup_info.
+        samples: the landings sampled per shot.
+        rng: the random generator.
+        distance_error: the standard deviation of the carry, as a fraction of it.
+
+    Returns:
+        landings: the (k, samples, 2) landing points, in float32 yards.
+    """
+    origin = np.asarray(origin, dtype=np.float32)
+    direction = np.asarray(aims, dtype=np.float32) - origin
+    headings = np.arctan2(direction[:, 1], direction[:, 0])[:, None]
+    noise = rng.standard_normal((2, len(direction), samples), dtype=np.float32)
+    angles = headings + noise[0] * np.float32(math.radians(level_error) / 2)
+    distances = np.asarray(carries, dtype=np.float32)[:, None] * \
+        (1 + noise[1] * np.float32(distance_error))
+    landings = np.empty((len(direction), samples, 2), dtype=np.float32)
+    np.multiply(np.cos(angles), distances, out=landings[..., 0])
+    np.multiply(np.sin(angles), distances, out=landings[..., 1])
+    landings += origin
+    return landings
+
+
+def simulate_shots(
+    hazards: HazardMap,
+    origin: np.ndarray,
+    aims: np.ndarray,
+    club_distances: np.ndarray,
+    level_error: float,
+    samples: int = SAMPLES,
+    rng: Optional[np.random.Generator] = None,
+    distance_error: float = DISTANCE_ERROR
+) -> np.ndarray:
+    """
+    The rate at which each of k candidate shots lands on each terrain, in one batch.
+
+    Args:
+        hazards: the terrain of the hole.
+        origin: the (u,v) yards the shots are played from.
+        aims: the (k,2) points aimed at.
+        club_distances: the (k,) full distance of the club of each shot, see club_performance. A
+            shot carries to its aim point, or the full distance of its club when short of it.
+        level_error: the dispersion of the player, in degrees.
+        samples: the landings sampled per shot.
+        rng: the random generator, a fresh one by default.
+        distance_error: the standard deviation of the carry, as a fraction of it.
+
+    Returns:
+        rates: the (k, len(TERRAINS)) fraction of landings on each terrain.
+    """
+    rng = rng or np.random.default_rng()
+    aims = np.asarray(aims, dtype=np.float32).reshape(-1, 2)
+    reach = np.hypot(*(aims - np.asarray(origin, dtype=np.float32)).T)
+    carries = np.minimum(reach, np.asarray(club_distances, dtype=np.float32))
+    landings = sample_landings(origin, aims, carries, level_error, samples, rng, distance_error)
+    codes = hazards.lookup(landings).astype(np.int64)
+    codes += np.arange(len(aims))[:, None] * len(TERRAINS)
+    counts = np.bincount(codes.ravel(), minlength=len(aims) * len(TERRAINS))
+    return counts.reshape(len(aims), len(TERRAINS)) / samples
+
+
+def simulate_shot(
+    hazards: HazardMap,
+    origin: np.ndarray,
+    aim: np.ndarray,
+    club_distance: float,
+    level_error: float,
+    samples: int = SAMPLES,
+    rng: Optional[np.random.Generator] = None,
+    distance_error: float = DISTANCE_ERROR
+) -> Dict[str, float]:
+    """
+    The rate at which a shot lands on each terrain, see simulate_shots.
+
+    Returns:
+        rates: maps each of TERRAINS to the fraction of landings on it.
+    """
+    rates = simulate_shots(hazards, origin, [aim], [club_distance], level_error, samples, rng,
+                           distance_error)
+    return dict(zip(TERRAINS, rates[0].tolist()))
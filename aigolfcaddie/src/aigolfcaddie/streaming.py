@@ -0,0 +1,116 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import json
+from typing import Dict, List, Optional
+
+"""
+Incremental parsing of the strategy ChatGPT streams, following the FORMATTED schema. The text
+is fed in as it arrives, and each item of the "strategy" list is returned as soon as its closing
+brace does, long before the rest of the answer has been generated:
+
+    parser = StrategyParser()
+    for delta in deltas:
+        for shot in parser.feed(delta):
+            ...
+
+The parser only tracks strings, escapes and nesting, one character at a time, and hands each
+complete item to json.loads. Text outside the list is not validated.
+"""
+
+
+class StrategyParser:
+    """
+    Returns the items of a list in a streamed JSON object as soon as each one is complete.
+    """
+    def __init__(self, key: str = "strategy"):
+        """
+        Args:
+            key: the key of the list, in the outermost object.
+        """
+        self.key = key
+        self.text = ""
+        self.items = []
+        # One entry per open object or list: its bracket and, for values, the key it belongs to.
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.string_start = 0
+        self.last_string = None
+        self.item_start = None
+
+    def _in_list(self) -> bool:
+        return len(self.stack) == 2 and self.stack[1] == ("[", self.key)
+
+    def feed(self, delta: str) -> List[Dict]:
+        """
+        Parse the next piece of the streamed text.
+
+        Args:
+            delta: the text streamed since the last call.
+
+        Returns:
+            items: the items of the list completed by delta, in order.
+        """
+        completed = []
+        start = len(self.text)
+        self.text += delta
+        for index in range(start, len(self.text)):
+            char = self.text[index]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    self.last_string = self.text[self.string_start:index + 1]
+            elif char == '"':
+                self.in_string = True
+                self.string_start = index
+            elif char in "{[":
+                if char == "{" and self._in_list():
+                    self.item_start = index
+                key = json.loads(self.last_string) if self.last_string else None
+                self.stack.append((char, key))
+                self.last_string = None
+            elif char in "}]":
+                if self.stack:
+                    self.stack.pop()
+                if char == "}" and self.item_start is not None and self._in_list():
+                    item = json.loads(self.text[self.item_start:index + 1])
+                    self.items.append(item)
+                    completed.append(item)
+                    self.item_start = None
+            elif char == ",":
+                self.last_string = None
+        return completed
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether the outermost object has been closed.
+        """
+        return bool(self.text.strip()) and not self.stack and not self.in_string
+
+    def result(self) -> Optional[Dict]:
+        """
+        The whole parsed object, once done.
+        """
+        return json.loads(self.text) if self.done else None
+
+
+def describe_shot(number: int, shot: Dict) -> str:
+    """
+    One line about a shot of the strategy, for display.
+
+    Args:
+        number: the number of the shot, from 1.
+        shot: an item of the "strategy" list of FORMATTED.
+    """
+    return (f"Shot {number}: {shot.get('club')}, {shot.get('distance hit')} yards to "
+            f"{shot.get('estimated location')}, "
+            f"{shot.get('distance_from_hole')} yards from the hole")
@@ -0,0 +1,204 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import cv2
+import numpy as np
+from typing import List, Tuple
+
+from aigolfcaddie.geometry import concatenate_polygons, polygon_bboxes
+
+"""
+Tiled segmentation of maps too large to be sent to SAM as one image. The map is cut into
+overlapping tiles that are segmented on their own, at full resolution, and the polygons of every
+tile are merged back into one set in the coordinates of the original map.
+
+A feature crossing a seam comes back once per tile it touches, each copy cut at its tile edge.
+Tiles overlap so that such copies cover the same pixels in the overlap strip: copies from two
+tiles that agree within the strip they share are the same feature, and are replaced by the
+outline of their union.
+"""
+
+# The width and height of a tile, and how much neighbouring tiles overlap, in pixels. SAM
+# segments at 1024 pixels internally, so tiles of that size are not downsampled by the server.
+TILE_SIZE = 1024
+TILE_OVERLAP = 128
+
+# Copies of a feature from two tiles are merged when their intersection over union within the
+# overlap of the tiles is at least this.
+SEAM_IOU_THRESHOLD = 0.5
+
+Box = Tuple[int, int, int, int]
+
+
+def _tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    """
+    The starts of the fewest tiles covering length with at least overlap pixels between
+    neighbours, spread evenly so the first tile starts at 0 and the last one ends at length.
+    """
+    if length <= tile_size:
+        return [0]
+    count = -(-(length - overlap) // (tile_size - overlap))
+    return [round(k * (length - tile_size) / (count - 1)) for k in range(count)]
+
+
+def tile_boxes(
+    width: int, height: int, tile_size: int = TILE_SIZE, overlap: int = TILE_OVERLAP
+) -> List[Box]:
+    """
+    Cut a width x height map into overlapping tiles.
+
+    Args:
+        width: the width of the map in pixels.
+        height: the height of the map in pixels.
+        tile_size: the largest width and height of a tile.
+        overlap: the least number of pixels shared by neighbouring tiles. Must be smaller than
+            tile_size.
+
+    Returns:
+        boxes: the (u0,v0,u1,v1) pixel box of each tile, row by row. A map that fits in one tile
+            gives a single box covering the whole map.
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError("The tile overlap must be smaller than the tile size.")
+    return [
+        (u0, v0, min(u0 + tile_size, width), min(v0 + tile_size, height))
+        for v0 in _tile_starts(height, tile_size, overlap)
+        for u0 in _tile_starts(width, tile_size, overlap)
+    ]
+
+
+def _rasterize(
+    vertices: np.ndarray, offsets: np.ndarray, polygons: np.ndarray, box: Box
+) -> np.ndarray:
+    """
+    Fill the given polygons into one mask covering box.
+    """
+    u0, v0, u1, v1 = box
+    mask = np.zeros((v1 - v0, u1 - u0), dtype=np.uint8)
+    rings = [
+        np.round(vertices[offsets[i]:offsets[i + 1]]).astype(np.int32) - (u0, v0)
+        for i in polygons
+    ]
+    cv2.fillPoly(mask, rings, 1)
+    return mask
+
+
+def _pixel_box(bbox: np.ndarray, within: Box) -> Box:
+    """
+    The pixels _rasterize may fill for a polygon with the given [u0,v0,u1,v1] bbox, within a box.
+    """
+    return (max(int(np.floor(bbox[0])), within[0]), max(int(np.floor(bbox[1])), within[1]),
+            min(int(np.ceil(bbox[2])) + 1, within[2]), min(int(np.ceil(bbox[3])) + 1, within[3]))
+
+
+def _find(parents: np.ndarray, i: int) -> int:
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def merge_tiles(
+    tiles: List[Tuple[np.ndarray, np.ndarray]],
+    boxes: List[Box],
+    iou_threshold: float = SEAM_IOU_THRESHOLD
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge the polygons segmented on each tile into one set of polygons in map coordinates.
+
+    Args:
+        tiles: the (vertices, offsets) packed polygons of each tile, in pixels of the tile.
+        boxes: the box of each tile within the map, see tile_boxes.
+        iou_threshold: see SEAM_IOU_THRESHOLD.
+
+    Returns:
+        vertices, offsets: the packed polygons of the map. Polygons found by a single tile are
+            kept as they are and in tile order; the copies of a feature split across tiles are
+            replaced by one polygon, the outline of their union, in place of the first copy.
+    """
+    vertices, offsets = concatenate_polygons([
+        (tile_vertices + box[:2], tile_offsets)
+        for (tile_vertices, tile_offsets), box in zip(tiles, boxes)
+    ])
+    count = len(offsets) - 1
+    tile_ids = np.repeat(np.arange(len(tiles)), [len(o) - 1 for _, o in tiles])
+    bboxes = polygon_bboxes(vertices, offsets)
+    parents = np.arange(count)
+
+    for i, box_i in enumerate(boxes):
+        for j in range(i + 1, len(boxes)):
+            box_j = boxes[j]
+            strip = (max(box_i[0], box_j[0]), max(box_i[1], box_j[1]),
+                     min(box_i[2], box_j[2]), min(box_i[3], box_j[3]))
+            if strip[0] >= strip[2] or strip[1] >= strip[3]:
+                continue
+            # Polygons of either tile that reach into the strip both tiles see.
+            in_strip = (
+                (bboxes[:, 0] < strip[2]) & (bboxes[:, 2] > strip[0]) &
+                (bboxes[:, 1] < strip[3]) & (bboxes[:, 3] > strip[1])
+            )
+            left = np.flatnonzero(in_strip & (tile_ids == i))
+            right = np.flatnonzero(in_strip & (tile_ids == j))
+            if not len(left) or not len(right):
+                continue
+            # Each polygon is only rasterized over its own part of the strip, and each pair
+            # only compared where those parts overlap.
+            clips = {
+                polygon: _pixel_box(bboxes[polygon], strip)
+                for polygon in np.concatenate([left, right]).tolist()
+            }
+            masks, areas = {}, {}
+            for polygon, clip in clips.items():
+                masks[polygon] = _rasterize(vertices, offsets, [polygon], clip).astype(bool)
+                areas[polygon] = np.count_nonzero(masks[polygon])
+            left_clips = np.array([clips[a] for a in left.tolist()])
+            right_clips = np.array([clips[b] for b in right.tolist()])
+            overlaps = (
+                (np.maximum(left_clips[:, None, 0], right_clips[None, :, 0]) <
+                 np.minimum(left_clips[:, None, 2], right_clips[None, :, 2])) &
+                (np.maximum(left_clips[:, None, 1], right_clips[None, :, 1]) <
+                 np.minimum(left_clips[:, None, 3], right_clips[None, :, 3]))
+            )
+            for k, m in np.argwhere(overlaps).tolist():
+                a, b = int(left[k]), int(right[m])
+                (au0, av0, au1, av1), (bu0, bv0, bu1, bv1) = clips[a], clips[b]
+                u0, v0, u1, v1 = max(au0, bu0), max(av0, bv0), min(au1, bu1), min(av1, bv1)
+                intersection = np.count_nonzero(
+                    masks[a][v0 - av0:v1 - av0, u0 - au0:u1 - au0] &
+                    masks[b][v0 - bv0:v1 - bv0, u0 - bu0:u1 - bu0]
+                )
+                if not intersection:
+                    continue
+                union = areas[a] + areas[b] - intersection
+                if intersection >= iou_threshold * union:
+                    parents[_find(parents, b)] = _find(parents, a)
+
+    roots = np.array([_find(parents, i) for i in range(count)], dtype=np.int64)
+    sizes = np.bincount(roots, minlength=count)
+    rings = []
+    for polygon in np.flatnonzero(roots == np.arange(count)).tolist():
+        if sizes[polygon] == 1:
+            rings.append(vertices[offsets[polygon]:offsets[polygon + 1]])
+        else:
+            rings.append(
+                _union_outline(vertices, offsets, np.flatnonzero(roots == polygon), bboxes)
+            )
+    return concatenate_polygons([(ring, np.array([0, len(ring)])) for ring in rings])
+
+
+def _union_outline(vertices: np.ndarray, offsets: np.ndarray, polygons: np.ndarray,
+                   bboxes: np.ndarray) -> np.ndarray:
+    """
+    The outer outline of the union of the given polygons, traced on a one pixel raster.
+    """
+    u0, v0 = np.floor(bboxes[polygons, :2].min(axis=0)).astype(int)
+    u1, v1 = np.ceil(bboxes[polygons, 2:].max(axis=0)).astype(int)
+    # One pixel of margin so that the outline of a polygon on the box edge is traced.
+    box = (u0 - 1, v0 - 1, u1 + 2, v1 + 2)
+    mask = _rasterize(vertices, offsets, polygons, box)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    outline = max(contours, key=cv2.contourArea)
+    return outline.reshape(-1, 2).astype(float) + box[:2]
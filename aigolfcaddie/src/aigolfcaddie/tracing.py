@@ -0,0 +1,274 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+"""
+Per-stage timing of a caddie answer. Each stage (the SAM call, the geometry, ChatGPT, ...) is
+recorded as a span with its start and end time and attributes such as bytes sent and received,
+polygon and token counts, or the time to the first ChatGPT token. Spans opened inside another
+span, in the same thread or asyncio task, become its children, so one answer is one trace.
+
+Finished spans are handed to sinks: LogSink, JsonLinesSink and OpenTelemetrySink. With no sink
+configured, span() returns a shared do-nothing span, so the instrumentation costs next to nothing.
+
+    with span("sam.automask", bytes_in=len(b64str_img)) as sam_span:
+        ...
+        sam_span.set(polygons=count)
+
+or, for a whole function, with the traced decorator and current_span().set(...) in its body.
+
+Tracing is off by default. Turn it on with configure(), or with the AIGOLFCADDIE_TRACE
+environment variable holding a comma separated list of sinks: "log", "jsonl:<path>" or "otel".
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """
+    One timed stage. Use it as a context manager, see span.
+    """
+    def __init__(self, name: str, attributes: Dict, parent: Optional["Span"]):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start = None
+        self.end = None
+        self._start_counter = None
+        self._token = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        """
+        The seconds between the start and the end of the span.
+        """
+        return None if self.end is None else self.end - self.start
+
+    def set(self, **attributes) -> None:
+        """
+        Add attributes to the span.
+        """
+        self.attributes.update(attributes)
+
+    def since_start(self) -> float:
+        """
+        The seconds since the span started, for attributes such as the time to first token.
+        """
+        return time.perf_counter() - self._start_counter
+
+    def __enter__(self) -> "Span":
+        self.start = time.time()
+        self._start_counter = time.perf_counter()
+        self._token = _current.set(self)
+        for sink in _sinks:
+            sink.on_start(self)
+        return self
+
+    def __exit__(self, error_type, error, traceback) -> None:
+        self.end = self.start + self.since_start()
+        _current.reset(self._token)
+        if error_type is not None:
+            self.attributes["error"] = f"{error_type.__name__}: {error}"
+        for sink in _sinks:
+            try:
+                sink.on_end(self)
+            except Exception:
+                logger.exception("Trace sink %r failed.", sink)
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """
+    The span handed out while tracing is off.
+    """
+    def set(self, **attributes) -> None:
+        pass
+
+    def since_start(self) -> float:
+        return 0.0
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+_current = contextvars.ContextVar("aigolfcaddie_span", default=None)
+_sinks = []
+
+
+def span(name: str, **attributes):
+    """
+    Start a span, a child of the current span if there is one.
+
+    Args:
+        name: the name of the stage, such as "sam.automask".
+        attributes: the first attributes of the span, see Span.set.
+    """
+    if not _sinks:
+        return _NOOP_SPAN
+    return Span(name, attributes, _current.get())
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    """
+    Decorate a function, or a coroutine function, to run each call in a span named name. The
+    function can add attributes through current_span().
+    """
+    def decorate(function: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def traced_coroutine(*args, **kwargs):
+                if not _sinks:
+                    return await function(*args, **kwargs)
+                with Span(name, {}, _current.get()):
+                    return await function(*args, **kwargs)
+            return traced_coroutine
+
+        @functools.wraps(function)
+        def traced_function(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs)
+            with Span(name, {}, _current.get()):
+                return function(*args, **kwargs)
+        return traced_function
+    return decorate
+
+
+def current_span():
+    """
+    The innermost open span, or the do-nothing span.
+    """
+    return _current.get() or _NOOP_SPAN
+
+
+def bind(function: Callable, *args) -> Callable[[], object]:
+    """
+    Wrap a call to run in an executor so that spans it opens are children of the current span.
+    loop.run_in_executor does not carry the context over to the worker thread by itself.
+    """
+    context = contextvars.copy_context()
+    return lambda: context.run(function, *args)
+
+
+class Sink:
+    """
+    Receives spans as they start and end.
+    """
+    def on_start(self, span: Span) -> None:
+        pass
+
+    def on_end(self, span: Span) -> None:
+        pass
+
+
+class LogSink(Sink):
+    """
+    Logs each finished span on one line.
+    """
+    def __init__(self, log: logging.Logger = logger, level: int = logging.INFO):
+        self.log = log
+        self.level = level
+
+    def on_end(self, span: Span) -> None:
+        self.log.log(self.level, "%s took %.1f ms %s", span.name, span.duration * 1000,
+                     json.dumps(span.attributes, default=str))
+
+
+class JsonLinesSink(Sink):
+    """
+    Appends each finished span as a JSON object on its own line of a file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def on_end(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self.lock, open(self.path, "a") as file:
+            file.write(line)
+
+
+class OpenTelemetrySink(Sink):
+    """
+    Mirrors spans into OpenTelemetry, to be exported by whatever exporter the OpenTelemetry SDK
+    is configured with. Needs the opentelemetry-api package.
+    """
+    def __init__(self, tracer=None):
+        from opentelemetry import trace
+        self.trace = trace
+        self.tracer = tracer or trace.get_tracer("aigolfcaddie")
+        self.spans = {}
+
+    def on_start(self, span: Span) -> None:
+        parent = self.spans.get(span.parent.span_id) if span.parent else None
+        context = self.trace.set_span_in_context(parent) if parent is not None else None
+        self.spans[span.span_id] = self.tracer.start_span(
+            span.name, context=context, start_time=int(span.start * 1e9)
+        )
+
+    def on_end(self, span: Span) -> None:
+        otel_span = self.spans.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        for key, value in span.attributes.items():
+            if not isinstance(value, (bool, int, float, str)):
+                value = json.dumps(value, default=str)
+            otel_span.set_attribute(key, value)
+        otel_span.end(end_time=int(span.end * 1e9))
+
+
+def configure(sinks: List[Sink]) -> None:
+    """
+    Send spans to the given sinks from now on. An empty list turns tracing off.
+    """
+    _sinks[:] = sinks
+
+
+def sinks_from_spec(spec: str) -> List[Sink]:
+    """
+    Parse a comma separated list of sinks, see AIGOLFCADDIE_TRACE.
+    """
+    sinks = []
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        if item == "log":
+            sinks.append(LogSink())
+        elif item.startswith("jsonl:"):
+            sinks.append(JsonLinesSink(item[len("jsonl:"):]))
+        elif item == "otel":
+            sinks.append(OpenTelemetrySink())
+        else:
+            raise ValueError(f"Unknown trace sink {item!r}.")
+    return sinks
+
+
+if os.environ.get("AIGOLFCADDIE_TRACE"):
+    configure(sinks_from_spec(os.environ["AIGOLFCADDIE_TRACE"]))
@@ -0,0 +1,100 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-12-15
+"""
+
+import json
+import struct
+import zlib
+import numpy as np
+from typing import Tuple, Union
+
+from aigolfcaddie.geometry import pack_polygons
+
+"""
+Decoding of SAM server responses straight into the packed polygon arrays used by geometry.py.
+
+Besides the GeoJSON text returned by samapi, the client understands a compact binary format that
+a server can send when the request accepts PACKED_CONTENT_TYPE:
+
+    magic       5 bytes     b"SAMP1"
+    count       uint32      number of polygons
+    n           uint32      total number of vertices
+    body        zlib compressed
+                    offsets     (count + 1) uint32, start of each polygon within vertices
+                    vertices    (n, 2) float32, (u,v) pixel coordinates
+
+All integers and floats are little endian.
+"""
+
+PACKED_CONTENT_TYPE = "application/x-sam-polygons"
+PACKED_MAGIC = b"SAMP1"
+_HEADER = struct.Struct("<5sII")
+
+
+class SamResponseError(ValueError):
+    """
+    A SAM server response, or a cached one, that is malformed or truncated.
+    """
+
+
+def pack_sam_polygons(vertices: np.ndarray, offsets: np.ndarray) -> bytes:
+    """
+    Encode packed polygons in the compact binary format.
+    """
+    header = _HEADER.pack(PACKED_MAGIC, len(offsets) - 1, len(vertices))
+    body = offsets.astype("<u4").tobytes() + vertices.astype("<f4").tobytes()
+    return header + zlib.compress(body, 6)
+
+
+def unpack_sam_polygons(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode the compact binary format.
+
+    Returns:
+        vertices: an (n, 2) float array of the vertices of every polygon.
+        offsets: a (count + 1,) int array with the start of each polygon within vertices.
+            Raises SamResponseError if data is not in the format or is truncated.
+    """
+    try:
+        magic, count, n = _HEADER.unpack_from(data)
+        if magic != PACKED_MAGIC:
+            raise ValueError("Not a packed SAM polygon response.")
+        body = zlib.decompress(data[_HEADER.size:])
+        offsets = np.frombuffer(body, dtype="<u4", count=count + 1).astype(np.int64)
+        vertices = np.frombuffer(body, dtype="<f4", count=2 * n, offset=4 * (count + 1))
+    except (ValueError, struct.error, zlib.error) as e:
+        raise SamResponseError(f"Malformed packed SAM response: {e}") from e
+    return vertices.reshape(-1, 2).astype(float), offsets
+
+
+def parse_geojson_polygons(geojson: Union[str, bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Parse the GeoJSON returned by samapi into packed polygons, keeping the outer ring of each
+    feature. Raises SamResponseError if the GeoJSON is malformed or truncated.
+    """
+    try:
+        data = json.loads(geojson)
+        # Each feature contains 'type', 'geometry', and 'properties'.
+        return pack_polygons([feature['geometry']['coordinates'][0] for feature in data])
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise SamResponseError(f"Malformed GeoJSON SAM response: {e}") from e
+
+
+def decode_sam_response(body: bytes, content_type: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode a SAM server response body into packed polygons, whichever format the server chose.
+    Compressed (gzip) transfers are already undone by the HTTP client.
+
+    Args:
+        body: the raw response body.
+        content_type: the Content-Type header of the response.
+
+    Returns:
+        vertices, offsets: the packed polygons, see geometry.pack_polygons. Raises
+            SamResponseError if the body is malformed or truncated.
+    """
+    if content_type and content_type.split(";")[0].strip() == PACKED_CONTENT_TYPE:
+        return unpack_sam_polygons(body)
+    return parse_geojson_polygons(body)
@@ -4,25 +4,116 @@ email: peterxiaofun@gmail.com
 date: 2024-12-15
 """
 
-from openai import OpenAI
-from PIL import Image
+from openai import AsyncOpenAI, OpenAI
+import asyncio
+import functools
+import inspect
 import json
-import base64
-import io
+import logging
+import os
 import numpy as np
-import requests
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Tuple
 
+from aigolfcaddie.cache import TieredCache, cache_key
 from aigolfcaddie.constants import FORMATTED, SYSTEM_INSTRUCTIONS
+from aigolfcaddie.geometry import (
+    PolygonIndex, concatenate_polygons, pack_polygons, polygon_areas, polygon_centroids,
+    simplification_error, simplify_polygons
+)
+from aigolfcaddie.imaging import LLM_UPLOAD, SAM_UPLOAD, MapImage
+from aigolfcaddie.prompt import compact_sections, format_sections, section_tokens
+from aigolfcaddie.sam_client import AsyncSamClient, SamClient
+from aigolfcaddie.tiling import Box, merge_tiles, tile_boxes
+from aigolfcaddie.tracing import bind, current_span, traced
+from aigolfcaddie.transport import (
+    PACKED_CONTENT_TYPE, decode_sam_response, pack_sam_polygons, parse_geojson_polygons,
+    unpack_sam_polygons
+)
 
 """
 Contains all utility functions used by app.py to complete calls to SAM model and ChatGPT 4-o.
 """
 
+logger = logging.getLogger(__name__)
+
 api_key = 'REDACTED'
 client = OpenAI(api_key=api_key)
+async_client = AsyncOpenAI(api_key=api_key)
+
+# The ChatGPT model answering with the golf strategy.
+GPT_MODEL = "gpt-4o"
+
+# How the chat bot uses the local planner of planner.py: "hint" gives its plan to ChatGPT as a
+# starting point, "fallback" shows it when ChatGPT cannot be reached, "local" answers with it
+# instead of calling ChatGPT, and "off" does not plan.
+STRATEGY_PLANNER = "fallback"
+
+# Show the ChatGPT answer in the chat as it streams in, and each shot of the strategy as soon as
+# it is complete. False shows the whole answer, indented, once it is done.
+GPT_STREAMING = True
+
+# Set SAM_API_ADDR to use another server, such as the local stand-in of benchmarks/standin.py.
+SAM_API_ADDR = os.environ.get("SAM_API_ADDR", "https://clever-prompt-tiger.ngrok-free.app/sam/")
+
+# SAM parameters tuned for golf map segmentation. Following
+#   https://github.com/ksugar/samapi/tree/main?tab=readme-ov-file#endpoint-samautomask-post
+SAM_AUTOMASK_PARAMS = {
+    "type": "sam2_l",
+    "output_type": "Multi-mask (all)",
+    "pred_iou_thresh": 0.8, # Default 0.88
+    "points_per_side": 100, # Default 32
+    "points_per_batch": 128, # Default 64
+}
+
+# SAM parameters of click-guided segmentation. With one point prompt per click, the server only
+# decodes the masks of the clicked features instead of a 100x100 grid of candidate masks.
+SAM_PROMPT_PARAMS = {
+    "type": "sam2_l",
+    "multimask_output": False,
+}
+
+# "prompt" segments only the clicked features, "automask" segments the whole map, and "tiled"
+# segments the whole map at full resolution in overlapping tiles, see tiling.py.
+SAM_SEGMENTATION_MODE = "prompt"
+
+# How many tiles of a map are segmented at once, at most. Matches the pool of async_sam_client.
+SAM_TILE_CONCURRENCY = 4
+
+# Ask the SAM server for compact binary polygons instead of GeoJSON text. Servers without support
+# for the format keep answering GeoJSON, which is decoded just the same.
+SAM_PACKED_RESPONSES = True
+
+# SAM outlines are simplified to within this many yards before they are analyzed.
+SIMPLIFY_TOLERANCE_YARDS = 0.5
+
+# The pairs of feature types whose distances are given to ChatGPT, see feature_analysis.
+FEATURE_PAIRS = [
+    ("fairway", "bunker"),
+    ("fairway", "green"),
+    ("tee", "fairway"),
+    ("tee", "bunker"),
+    ("bunker", "green"),
+    ("tee", "green"),
+]
+
+# Cache of SAM results keyed by the image and the SAM parameters.
+SAM_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aigolfcaddie", "sam")
+SAM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+sam_cache = TieredCache(max_entries=8, directory=SAM_CACHE_DIR, max_bytes=SAM_CACHE_MAX_BYTES)
+
+# Cache of ChatGPT strategies keyed by the model, the instructions, the schema and the text input,
+# so a hole asked about again with the same setup is answered without calling ChatGPT. Entries
+# expire after STRATEGY_CACHE_TTL seconds.
+STRATEGY_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aigolfcaddie", "strategy")
+STRATEGY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+STRATEGY_CACHE_TTL = 24 * 60 * 60
+strategy_cache = TieredCache(max_entries=64, directory=STRATEGY_CACHE_DIR,
+                             max_bytes=STRATEGY_CACHE_MAX_BYTES, ttl=STRATEGY_CACHE_TTL)
+
+# Shared, pooled connections to the SAM server.
+sam_client = SamClient(SAM_API_ADDR)
+async_sam_client = AsyncSamClient(SAM_API_ADDR)
 
-SAM_API_ADDR = "https://clever-prompt-tiger.ngrok-free.app/sam/"
 
 def get_samapi_version() -> str:
     """
@@ -31,17 +122,19 @@ def get_samapi_version() -> str:
     Returns:
         version_str: a string indiciating the SAM API version.
     """
-    result = requests.get(SAM_API_ADDR + "version/")
-    return result.text
+    return sam_client.version()
 
 
+@traced("sam.automask")
 def call_sam(b64str_img: str, bbox) -> str:
     """
     Utility function to call the SAM server at the SAM_API_ADDR. The SAM server will inference the
     SAM model to generate GeoJSON edges to capture segmented regions within the image.
 
     This function tunes the SAM parameters to work best with golf map segmentation. Specifically,
-    this call makes a POST request to /sam/automask/ and waits for a response.
+    this call makes a POST request to /sam/automask/ and waits for a response. Successful responses
+    are cached by image and parameters, so repeat calls for the same image skip the server. Raises a
+    requests exception if the server cannot be reached within the timeouts of sam_client.
 
     The SAM parameters are described here:
         https://github.com/ksugar/samapi/tree/main?tab=readme-ov-file#endpoint-samautomask-post
@@ -54,21 +147,225 @@ def call_sam(b64str_img: str, bbox) -> str:
             contains a list of json objects with following keys: "geometry", "type", and
             "properties". 
     """
-    # Note: Following https://github.com/ksugar/samapi/tree/main?tab=readme-ov-file#endpoint-samautomask-post
-    result = requests.post(
-        SAM_API_ADDR + "automask/",
-        json={
-            "type": "sam2_l",
-            "b64img": b64str_img,
-            "output_type": "Multi-mask (all)",
-            "pred_iou_thresh": 0.8, # Default 0.88
-            "points_per_side": 100, # Default 32
-            "points_per_batch": 128, # Default 64
-        }
-    )
+    # Segmentations of an image already sent with the same parameters are served from the cache.
+    key = cache_key(b64str_img, SAM_AUTOMASK_PARAMS)
+    cached = sam_cache.get(key)
+    current_span().set(bytes_in=len(b64str_img), cache_hit=cached is not None)
+    if cached is not None:
+        return cached.decode()
+
+    result = sam_client.automask(b64str_img, SAM_AUTOMASK_PARAMS)
+    current_span().set(status=result.status_code, bytes_out=len(result.content))
+    if result.ok:
+        sam_cache.put(key, result.content)
     return result.text
 
 
+def cached_sam_polygons(key: str, b64str_img: str, **attributes) -> Optional[Tuple]:
+    """
+    Look up SAM polygons cached under key, recording the lookup on the current span along with
+    the size of the image and any other attributes.
+
+    Returns:
+        vertices, offsets: the cached packed polygons, or None when they are not cached.
+    """
+    cached = sam_cache.get(key)
+    current_span().set(bytes_in=len(b64str_img), cache_hit=cached is not None, **attributes)
+    if cached is None:
+        return None
+    return unpack_sam_polygons(cached)
+
+
+def store_sam_polygons(key: str, results: List) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode the responses of the SAM server into one packed polygon array, in order, and cache it
+    under key in the compact format whatever the server sent. CPU bound for large GeoJSON
+    responses, so asyncio callers run it in an executor.
+
+    Args:
+        key: the cache key of the request, see cache_key.
+        results: the responses, either requests or httpx ones. Raises their exception if any of
+            them is an error.
+
+    Returns:
+        vertices, offsets: the segmentations as packed polygons, see geometry.pack_polygons.
+    """
+    current_span().set(bytes_out=sum(len(result.content) for result in results))
+    packed = []
+    for result in results:
+        result.raise_for_status()
+        packed.append(decode_sam_response(result.content, result.headers.get("Content-Type")))
+    vertices, offsets = packed[0] if len(packed) == 1 else concatenate_polygons(packed)
+    current_span().set(polygons=len(offsets) - 1)
+    sam_cache.put(key, pack_sam_polygons(vertices, offsets))
+    return vertices, offsets
+
+
+@traced("sam.automask")
+def call_sam_polygons(b64str_img: str, bbox) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Like call_sam, but asks the server for the compact polygon format (see transport.py) when
+    SAM_PACKED_RESPONSES is set, and decodes the response straight into packed polygon arrays
+    rather than GeoJSON text. The cache holds the compact format whatever the server sent.
+
+    Returns:
+        vertices, offsets: the segmentations as packed polygons, see geometry.pack_polygons.
+            Raises a requests exception if the server cannot be reached or answers with an error.
+    """
+    key = cache_key(b64str_img, SAM_AUTOMASK_PARAMS, PACKED_CONTENT_TYPE)
+    cached = cached_sam_polygons(key, b64str_img)
+    if cached is not None:
+        return cached
+
+    result = sam_client.automask(b64str_img, SAM_AUTOMASK_PARAMS, packed=SAM_PACKED_RESPONSES)
+    current_span().set(status=result.status_code)
+    return store_sam_polygons(key, [result])
+
+
+@traced("sam.automask")
+async def call_sam_polygons_async(b64str_img: str, bbox) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The asyncio counterpart of call_sam_polygons, decoding the response in an executor. Shares
+    its cache, and raises an httpx exception if the server cannot be reached within the timeouts
+    of async_sam_client or answers with an error.
+    """
+    key = cache_key(b64str_img, SAM_AUTOMASK_PARAMS, PACKED_CONTENT_TYPE)
+    cached = cached_sam_polygons(key, b64str_img)
+    if cached is not None:
+        return cached
+
+    result = await async_sam_client.automask(
+        b64str_img, SAM_AUTOMASK_PARAMS, packed=SAM_PACKED_RESPONSES
+    )
+    current_span().set(status=result.status_code)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, bind(store_sam_polygons, key, [result]))
+
+
+def map_tiles(map_image: MapImage) -> List[Box]:
+    """
+    The boxes of the tiles a map is segmented in, see tiling.tile_boxes. Records their number on
+    the current span.
+    """
+    boxes = tile_boxes(*map_image.size)
+    current_span().set(tiles=len(boxes))
+    return boxes
+
+
+def tile_upload(map_image: MapImage, box: Box) -> str:
+    """
+    A tile of the map at full resolution, encoded for SAM as a base64 string.
+    """
+    return map_image.tile(box, SAM_UPLOAD["format"], SAM_UPLOAD["quality"]).b64
+
+
+@traced("sam.tiled")
+def call_sam_tiled(map_image: MapImage) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Segment a map of any size with automask, one full resolution tile at a time, so that small
+    features are not lost to downsampling and each request stays small. Tiles are cached like
+    any other image by call_sam_polygons.
+
+    Args:
+        map_image: the map to segment.
+
+    Returns:
+        vertices, offsets: the segmentations of the whole map as packed polygons, in pixels of
+            the original map (an upload factor of 1). See tiling.merge_tiles.
+    """
+    boxes = map_tiles(map_image)
+    tiles = [call_sam_polygons(tile_upload(map_image, box), []) for box in boxes]
+    return merge_tiles(tiles, boxes)
+
+
+@traced("sam.tiled")
+async def call_sam_tiled_async(map_image: MapImage) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The asyncio counterpart of call_sam_tiled, segmenting up to SAM_TILE_CONCURRENCY tiles at
+    once. Tiles are encoded and merged in an executor.
+    """
+    loop = asyncio.get_running_loop()
+    boxes = await loop.run_in_executor(None, bind(map_tiles, map_image))
+    semaphore = asyncio.Semaphore(SAM_TILE_CONCURRENCY)
+
+    async def segment(box):
+        async with semaphore:
+            upload = await loop.run_in_executor(None, tile_upload, map_image, box)
+            return await call_sam_polygons_async(upload, [])
+
+    tiles = await asyncio.gather(*[segment(box) for box in boxes])
+    return await loop.run_in_executor(None, merge_tiles, tiles, boxes)
+
+
+def click_points(clicks: Dict, upload_factor: float = 1.0) -> List[Tuple[float, float]]:
+    """
+    The (u,v) pixel coordinates of every golf feature click, in the order of feature_clicks,
+    within an upload of the map that is upload_factor times the size of the original.
+    """
+    return [
+        (click["u"] * upload_factor, click["v"] * upload_factor)
+        for _, click in feature_clicks(clicks)
+    ]
+
+
+@traced("sam.prompts")
+def call_sam_prompts(
+    b64str_img: str, points: List[Tuple[float, float]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Segment only the clicked features, with one positive point prompt per click. The prompts are
+    sent in one request to /sam/prompts/; servers without that endpoint (stock samapi) are asked
+    once per click on /sam/ instead. Results are cached by image, points and parameters.
+
+    Args:
+        b64str_img: an image encoded as an base64 character string.
+        points: the (u,v) pixel coordinates of the clicks in that image, see click_points.
+
+    Returns:
+        vertices, offsets: the masks of the clicked features as packed polygons. Raises a
+            requests exception if the server cannot be reached or answers with an error.
+    """
+    key = cache_key(b64str_img, SAM_PROMPT_PARAMS, points, PACKED_CONTENT_TYPE)
+    cached = cached_sam_polygons(key, b64str_img, points=len(points))
+    if cached is not None:
+        return cached
+
+    result = sam_client.prompts(b64str_img, points, SAM_PROMPT_PARAMS, packed=SAM_PACKED_RESPONSES)
+    if result.status_code in (404, 405):
+        results = [sam_client.prompt(b64str_img, point, SAM_PROMPT_PARAMS) for point in points]
+    else:
+        results = [result]
+    current_span().set(requests=len(results))
+    return store_sam_polygons(key, results)
+
+
+@traced("sam.prompts")
+async def call_sam_prompts_async(
+    b64str_img: str, points: List[Tuple[float, float]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The asyncio counterpart of call_sam_prompts. On servers without /sam/prompts/, the per click
+    requests are sent concurrently.
+    """
+    key = cache_key(b64str_img, SAM_PROMPT_PARAMS, points, PACKED_CONTENT_TYPE)
+    cached = cached_sam_polygons(key, b64str_img, points=len(points))
+    if cached is not None:
+        return cached
+
+    result = await async_sam_client.prompts(
+        b64str_img, points, SAM_PROMPT_PARAMS, packed=SAM_PACKED_RESPONSES
+    )
+    if result.status_code in (404, 405):
+        results = await asyncio.gather(*[
+            async_sam_client.prompt(b64str_img, point, SAM_PROMPT_PARAMS) for point in points
+        ])
+    else:
+        results = [result]
+    current_span().set(requests=len(results))
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, bind(store_sam_polygons, key, results))
+
+
 def calculate_center_of_mass(vertices):
     """
     Calculate the center of mass using the shoelace formula. 
@@ -79,71 +376,127 @@ def calculate_center_of_mass(vertices):
     Returns:
         com: the (u,v) of the center of mass of the shape.
     """
-    n = len(vertices)
-    
-    area = 0.0
-    cx = 0.0
-    cy = 0.0
-
-    # Calculate area using the shoelace formula
-    for i in range(n):
-        x0, y0 = vertices[i]
-        x1, y1 = vertices[(i + 1) % n]  # Next vertex, wrapping around
-        cross_product = x0 * y1 - x1 * y0
-        area += cross_product
-        cx += (x0 + x1) * cross_product
-        cy += (y0 + y1) * cross_product
-    
-    area *= 0.5
-    if area == 0:
+    vertices, offsets = pack_polygons([vertices])
+    if polygon_areas(vertices, offsets)[0] == 0:
         raise ValueError("The area of the polygon is zero, check the vertices.")
-    
-    # Finalize centroid coordinates
-    cx /= (6 * area)
-    cy /= (6 * area)
-
+    cx, cy = polygon_centroids(vertices, offsets)[0].tolist()
     return (round(cx,4), round(cy,4))
 
 
-def analyze_result(geojson_str: str, clicks: Dict) -> List[Dict]:
+def feature_clicks(clicks: Dict) -> List[Tuple[str, Dict]]:
+    """
+    List the (golf feature, click) pairs of the course data, skipping "file" and "scale".
+    """
+    return [
+        (golf_feature, click)
+        for golf_feature in clicks.keys() if golf_feature != "file" and golf_feature != "scale"
+        for click in clicks[golf_feature]
+    ]
+
+
+def analyze_result(geojson_str: str, clicks: Dict, upload_factor: float = 1.0) -> List[Dict]:
     """
     Analyse geojson string generated by the samapi.
 
     Args:
         geojson_str: the geojson string. Contains a list of json objects with following keys: 
             "geometry", "type", and "properties". 
+        clicks: the course data, see analyze_polygons.
+        upload_factor: see analyze_polygons.
 
     Returns:
         bounding_boxes: a list of bounding boxes. Each bounding box is a dictionary with describing
             the locations of the box corners and center.
     """
-    data = json.loads(geojson_str)
+    return analyze_polygons(*parse_geojson_polygons(geojson_str), clicks, upload_factor)
+
+
+def match_features(
+    vertices: np.ndarray,
+    offsets: np.ndarray,
+    clicks: Dict,
+    upload_factor: float = 1.0,
+    simplify_tolerance: float = SIMPLIFY_TOLERANCE_YARDS
+) -> Tuple[PolygonIndex, List[Tuple[str, Dict, int]]]:
+    """
+    Match the clicks of each golf feature to the SAM polygons, see analyze_polygons for the
+    arguments.
+
+    Returns:
+        index: the SAM polygons, in yards.
+        matches: the feature type, click and polygon of each click inside a polygon, in the order
+            of the clicks.
+    """
+    vertices = vertices * (clicks["scale"] / upload_factor)
+    if simplify_tolerance > 0:
+        simplified = simplify_polygons(vertices, offsets, simplify_tolerance)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Simplified SAM polygons: %s",
+                         simplification_error(vertices, offsets, *simplified))
+        vertices, offsets = simplified
+
+    # Index every polygon of the response in a single batch.
+    index = PolygonIndex(vertices, offsets)
+
+    features = feature_clicks(clicks)
+    points = np.array(
+        [[click["u"], click["v"]] for _, click in features], dtype=float
+    ).reshape(-1, 2) * clicks["scale"]
+
+    # Match each click to the smallest polygon it actually falls inside.
+    matches = index.locate(points).tolist()
+    current_span().set(polygons=len(index), vertices=len(vertices), clicks=len(matches),
+                       matched=sum(polygon != -1 for polygon in matches))
+    return index, [
+        (golf_feature, click, polygon)
+        for (golf_feature, click), polygon in zip(features, matches) if polygon != -1
+    ]
+
+
+@traced("analyze")
+def analyze_polygons(
+    vertices: np.ndarray,
+    offsets: np.ndarray,
+    clicks: Dict,
+    upload_factor: float = 1.0,
+    simplify_tolerance: float = SIMPLIFY_TOLERANCE_YARDS
+) -> List[Dict]:
+    """
+    Match the clicks of each golf feature to the SAM polygons and describe the matched polygons.
+
+    Args:
+        vertices: the packed SAM polygons, in pixels of the segmented image.
+        offsets: the packed SAM polygon offsets, see geometry.pack_polygons.
+        clicks: the course data. Maps each golf feature type to a list of (u,v) clicks, and
+            "scale" to the scale of the image. Each click is matched to the smallest polygon that
+            contains it. The clicks are not modified, and a click outside every polygon is skipped.
+        upload_factor: the size of the image SAM segmented over the size of the original image,
+            see Upload.factor. The polygons are mapped back to the original image, so the output
+            does not depend on how the image was downscaled for upload.
+        simplify_tolerance: the polygons are simplified once, before any other geometry, by
+            dropping the vertices within this many yards of the simplified outline. 0 keeps
+            every vertex. The resulting area and center of mass errors are logged at debug level.
+
+    Returns:
+        bounding_boxes: a list of bounding boxes. Each bounding box is a dictionary with describing
+            the locations of the box corners and center, and a "feature_id", its index in the list.
+    """
+    index, matches = match_features(vertices, offsets, clicks, upload_factor, simplify_tolerance)
+
     all_metrics = []
-    for golf_feature in clicks.keys():
-        if golf_feature != "file" and golf_feature != "scale":
-            for click in clicks[golf_feature]:
-                minarea = -1
-                click["u"] *= clicks["scale"]
-                click["v"] *= clicks["scale"]
-                for feature in data:  # feature contains 'type', 'geometry', and 'properties'
-                    verticies = feature['geometry']['coordinates'][0]
-                    verticies = np.array(verticies) * clicks["scale"]
-                    
-                    # Calculate the edges of the bounding box.
-                    u0, v0 = np.min(verticies, axis=0)
-                    u1, v1 = np.max(verticies, axis=0)
-                    if contained(u0, v0, u1, v1, click):
-                        if minarea == -1 or abs(u1 - u0) * abs(v1-v0) < minarea:
-                            minarea = abs(u1 - u0) * abs(v1-v0)
-                            feature_info = {
-                                "feature_name" : golf_feature,
-                                "feature_center_yards" : calculate_center_of_mass(verticies),
-                                "coordinates" : [u0,v0,u1,v1]
-                            } # add distance and direction to other features
-                            if golf_feature == "tee":
-                                feature_info["tee_color"] = click["color"]
-                
-                all_metrics.append(feature_info)
+    for golf_feature, click, polygon in matches:
+        u0, v0, u1, v1 = index.bboxes[polygon].tolist()
+        uc, vc = index.centroids[polygon].tolist()
+        feature_info = {
+            "feature_id" : len(all_metrics),
+            "feature_name" : golf_feature,
+            "feature_center_yards" : (round(uc,4), round(vc,4)),
+            "coordinates" : [u0,v0,u1,v1]
+        } # add distance and direction to other features
+        if golf_feature == "tee":
+            feature_info["tee_color"] = click["color"]
+
+        all_metrics.append(feature_info)
     return all_metrics
 
 
@@ -209,9 +562,207 @@ def feature_organization(metrics: List[Dict]) -> Dict:
     return features
   
 
-def get_gpt_response(message, image_path = None):
+def llm_input(
+    setup: Dict, features: List[Dict], distances: List[Dict], plan: Optional[Dict] = None
+) -> Tuple[str, str]:
     """
-    Call ChatGPT and get its response to user input using the OpenAI Python module
+    Format the three part user input described in the system instructions, compactly, see
+    prompt.py. The estimated tokens of each part are logged and added to the current span.
+
+    The input is split so that what changes from hole to hole comes last. OpenAI caches the
+    longest prompt prefix it has seen recently, and the system instructions, the response schema
+    and the setup information are the same for every hole of a round.
+
+    Args:
+        setup: the setup information, see setup_info.
+        features: the physical features, see analyze_polygons, without their "coordinates".
+        distances: the inter-feature distances, see feature_analysis.
+        plan: a plan of the local planner for ChatGPT to start from, see planner.plan_hole.
+
+    Returns:
+        prefix: the setup information, the same across holes.
+        message: the physical features, inter-feature distances and plan of the hole.
+    """
+    sections = compact_sections(setup, features, distances, plan)
+    tokens = section_tokens(sections)
+    logger.debug("Estimated prompt tokens per section: %s", tokens)
+    current_span().set(estimated_tokens=tokens)
+
+    setup_section = {"Setup Information": sections.pop("Setup Information")}
+    prefix = "The following are the 3 input parts described previously:\n"
+    prefix += format_sections(setup_section)
+    return prefix, format_sections(sections)
+
+
+def gpt_messages(message: str, image_url: str = None, prefix: str = "") -> List[Dict]:
+    """
+    Build the chat messages sent to ChatGPT: the system instructions, then the user input with the
+    golf map attached when an image is provided. Everything that stays the same across calls comes
+    first, so that it can be served from the OpenAI prompt cache.
+
+    Args:
+        message: the formatted user input, see get_gpt_response.
+        image_url: the golf map as a data url, typically MapImage.upload(**LLM_UPLOAD).data_url.
+        prefix: the part of the user input that stays the same across calls, see llm_input.
+    """
+    content = [
+    {
+        "type": "text",
+        "text": message
+    }
+    ]
+    if prefix:
+        content.insert(0, {"type": "text", "text": prefix})
+    if image_url:
+        content.append(
+            {
+            "type": "image_url",
+            "image_url" :{
+                "url": image_url
+            }
+            }
+        )
+    return [
+        {"role": "system", "content": SYSTEM_INSTRUCTIONS},
+        {"role": "user", "content": content}
+    ]
+
+
+def prompt_cache_key(prefix: str) -> str:
+    """
+    The key routing calls with the same stable prompt prefix to the same OpenAI prompt cache.
+    """
+    return cache_key(SYSTEM_INSTRUCTIONS, FORMATTED, prefix)
+
+
+def strategy_key(message: str, prefix: str = "") -> str:
+    """
+    The strategy cache key of a ChatGPT input. The input of llm_input is canonical already: the
+    features, distances and setup are written in a fixed order with their numbers rounded, so the
+    same hole with the same setup gives the same key. The golf map image is left out of the key,
+    as the features are measured from it.
+
+    Args:
+        message: the formatted user input, see get_gpt_response.
+        prefix: the part of the input that stays the same across calls, see llm_input.
+    """
+    return cache_key(GPT_MODEL, FORMATTED, SYSTEM_INSTRUCTIONS, prefix, message)
+
+
+def remember_strategy(key: str, full_response: str) -> None:
+    """
+    Cache a ChatGPT response under key, unless it is an error or not a complete JSON strategy.
+    """
+    try:
+        json.loads(full_response)
+    except ValueError:
+        return
+    strategy_cache.put(key, full_response.encode())
+
+
+def cached_strategy(function: Callable) -> Callable:
+    """
+    Decorate a ChatGPT call, or its coroutine counterpart, taking (message, image, prefix,
+    on_delta) so that a strategy already given for the same input is returned from
+    strategy_cache, and passed whole to on_delta, instead of calling ChatGPT. New strategies are
+    remembered, see remember_strategy. Records whether the cache was hit on the current span.
+    The arguments are bound to the signature of function, so its own keywords keep working.
+    """
+    signature = inspect.signature(function)
+
+    def lookup(args: Tuple, kwargs: Dict):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        message, prefix, on_delta = (
+            arguments.arguments[name] for name in ("message", "prefix", "on_delta"))
+        key = strategy_key(message, prefix)
+        cached = strategy_cache.get(key)
+        current_span().set(cache_hit=cached is not None)
+        if cached is None:
+            return key, None
+        if on_delta:
+            on_delta(cached.decode())
+        return key, cached.decode()
+
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def cached_coroutine(*args, **kwargs):
+            key, cached = lookup(args, kwargs)
+            if cached is not None:
+                return cached
+            full_response = await function(*args, **kwargs)
+            remember_strategy(key, full_response)
+            return full_response
+        return cached_coroutine
+
+    @functools.wraps(function)
+    def cached_function(*args, **kwargs):
+        key, cached = lookup(args, kwargs)
+        if cached is not None:
+            return cached
+        full_response = function(*args, **kwargs)
+        remember_strategy(key, full_response)
+        return full_response
+    return cached_function
+
+
+def gpt_request(message: str, image_url: Optional[str] = None, prefix: str = "") -> Dict:
+    """
+    The arguments of a streamed chat completion answering message, see gpt_messages. Records the
+    size of the input on the current span.
+    """
+    current_span().set(prompt_chars=len(prefix) + len(message), image_chars=len(image_url or ""))
+    return dict(
+        model=GPT_MODEL,
+        messages=gpt_messages(message, image_url, prefix),
+        prompt_cache_key=prompt_cache_key(prefix),
+        stream=True,
+        stream_options={"include_usage": True},
+        response_format=FORMATTED
+    )
+
+
+def gpt_error(error: Exception) -> str:
+    """
+    Record a failed ChatGPT call on the current span, and the answer shown for it instead.
+    """
+    current_span().set(error=str(error))
+    return f"Error: {str(error)}"
+
+
+def trace_gpt_chunk(response, full_response: str) -> str:
+    """
+    Record the time to the first token and the token usage of a streamed ChatGPT response on
+    the current span.
+
+    Args:
+        response: a chunk of the stream.
+        full_response: the content streamed before this chunk.
+
+    Returns:
+        content: the content of the chunk. The last chunk only carries the usage.
+    """
+    content = (response.choices[0].delta.content or "") if response.choices else ""
+    span = current_span()
+    if content and not full_response:
+        span.set(time_to_first_token=round(span.since_start(), 4))
+    usage = getattr(response, "usage", None)
+    if usage:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        span.set(prompt_tokens=usage.prompt_tokens,
+                 cached_prompt_tokens=cached_tokens,
+                 uncached_prompt_tokens=usage.prompt_tokens - cached_tokens,
+                 completion_tokens=usage.completion_tokens)
+    return content
+
+
+@traced("gpt")
+@cached_strategy
+def get_gpt_response(message, image_path = None, prefix = "", on_delta = None):
+    """
+    Call ChatGPT and get its response to user input using the OpenAI Python module. A strategy
+    already given for the same input is returned from the cache instead, see cached_strategy.
 
     Args:
         message: the text the user sent. This text is formatted using in accordance to what is laid out 
@@ -219,113 +770,97 @@ def get_gpt_response(message, image_path = None):
             physical features, and inter-feature distances
         image_path: the image of the golf map if provided. This image would be used as supplement for
             the model to use when identifying qualitative information such as the shape of the fairway.
+        prefix: the part of the input that stays the same across calls, such as the setup
+            information, sent ahead of message so that OpenAI can serve it from its prompt cache.
+        on_delta: called with each piece of the response as it streams in, such as to display it
+            right away, see streaming.StrategyParser. A cached response is passed whole.
 
     Returns:
         full_response: a string containing ChatGPT's response to the model. The response strictly follows
             the "formatted" JSON schema and contains the golf strategy information 
     """
-
     full_response = ""
     try:
+        image_url = MapImage(image_path).upload(**LLM_UPLOAD).data_url if image_path else None
         # Make an API call using the OpenAI module
-        content = [
-        {
-            "type": "text",
-            "text": message
-        }
-        ]
-        if image_path:
-            image = Image.open(image_path)
-            image_bytes = io.BytesIO()
-            image.save(image_bytes, format='PNG')
-            image_bytes = (
-                "data:image/png;base64," + base64.b64encode(image_bytes.getvalue()).decode()
-            )
-            content.append(
-                {
-                "type": "image_url",
-                "image_url" :{
-                    "url": image_bytes
-                }
-                }
-            )
-        for response in client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": SYSTEM_INSTRUCTIONS},
-                {"role": "user", "content": content}
-            ],
-            stream=True,
-            response_format = FORMATTED
-        ):
-            full_response += (response.choices[0].delta.content or "")
+        for response in client.chat.completions.create(**gpt_request(message, image_url, prefix)):
+            delta = trace_gpt_chunk(response, full_response)
+            if on_delta and delta:
+                on_delta(delta)
+            full_response += delta
         # Extract the content of the response
         return full_response
     except Exception as e:
-        return f"Error: {str(e)}"
+        return gpt_error(e)
+
+
+@traced("gpt")
+@cached_strategy
+async def get_gpt_response_async(
+    message: str,
+    image_url: str = None,
+    prefix: str = "",
+    on_delta: Optional[Callable[[str], None]] = None
+) -> str:
+    """
+    The asyncio counterpart of get_gpt_response, streaming the response with AsyncOpenAI so the
+    event loop keeps running while ChatGPT generates. Takes the image already prepared as a data
+    url instead of its path, see gpt_messages. on_delta is called on the event loop.
+    """
+    full_response = ""
+    try:
+        stream = await async_client.chat.completions.create(
+            **gpt_request(message, image_url, prefix)
+        )
+        async for response in stream:
+            delta = trace_gpt_chunk(response, full_response)
+            if on_delta and delta:
+                on_delta(delta)
+            full_response += delta
+        return full_response
+    except Exception as e:
+        return gpt_error(e)
 
 
-def feature_analysis(metrics: Dict) -> List[Dict]:
+@traced("feature_analysis")
+def feature_analysis(metrics: Dict, pairs: List[Tuple[str, str]] = FEATURE_PAIRS) -> List[Dict]:
     """
     Find the distance between golf features in yards
 
     Args:
-        metrics: the golf features list. Contains a list of dictionaries each describing a golf feature 
-            identified. The "feature_name" of each feature is used to group features together by type,
-            used for the type vs type comparisons, and the "feature_center_yards" of each feature is
-            used to find the distance between the two features.
+        metrics: the golf features grouped by type, see feature_organization. The
+            "feature_center_yards" of each feature is used to find the distance between features,
+            and its "feature_id" to refer to it.
+        pairs: the pairs of feature types to measure, such as ("tee", "green").
 
     Returns:
-        distances: a list of dictionaries about golf feature distances. Each dictionary contains the 
-            distance between the two features, as well as the two dictionary descriptions of each
-            golf feature. Comparisons were made between fairway and bunker, fairway and green,
-            tee and fairway, and tee and bunker
-    """
-    # calculate distance from tee to middle of fairway, tee to bunker
-    fairway_bunker = []
-    fairway_green = []
-    tee_fairway = []
-    tee_bunker = []
-
-    # lambda function to do distance calculations between two points
-    def dist(feature1, feature2):
-        x1, x2, y1, y2 = (
-            feature1['feature_center_yards'][0],
-            feature2["feature_center_yards"][0],
-            feature1['feature_center_yards'][1],
-            feature2["feature_center_yards"][1]
-        )
-        return round(((x1 - x2) ** 2 + (y1 - y2) ** 2) ** 0.5, 2)
-
-    for fairway in metrics["fairway"]:
-        for bunker in metrics["bunker"]:
-            distance = dist(fairway, bunker)
-            fairway_bunker.append({
-                "distance" : distance,
-                "feature_1" : fairway,
-                "feature_2" : bunker
-            })
-        for green in metrics["green"]:
-            distance = dist(fairway, green)
-            fairway_green.append({
-                "distance" : distance,
-                "feature_1" : fairway,
-                "feature_2" : green
-            })
-        for tee in metrics["tee"]:
-            distance = dist(fairway, tee)
-            tee_fairway.append({
-                    "distance" : distance,
-                    "feature_1" : tee,
-                    "feature_2" : fairway
-                })
-    for tee in metrics["tee"]:
-        for bunker in metrics["bunker"]:
-            distance = dist(tee, bunker)
-            tee_bunker.append({
-                    "distance" : distance,
-                    "feature_1" : tee,
-                    "feature_2" : bunker
-                })
-    
-    return fairway_bunker + fairway_green +tee_fairway + tee_bunker
\ No newline at end of file
+        distances: a list of dictionaries about golf feature distances. Each dictionary contains the
+            distance between two features and the "feature_id" of each, in the order of pairs.
+            Feature types with no features are skipped.
+    """
+    names = list(metrics)
+    features = [feature for name in names for feature in metrics[name]]
+    centers = np.array(
+        [feature["feature_center_yards"] for feature in features], dtype=float
+    ).reshape(-1, 2)
+    ids = [feature["feature_id"] for feature in features]
+
+    # One matrix of the distances between every two features; each pair of types is a block of it.
+    difference = centers[:, None, :] - centers[None, :, :]
+    matrix = np.round(np.hypot(difference[..., 0], difference[..., 1]), 2)
+    bounds = np.cumsum([0] + [len(metrics[name]) for name in names]).tolist()
+    slices = {name: slice(bounds[i], bounds[i + 1]) for i, name in enumerate(names)}
+
+    distances = []
+    for name_1, name_2 in pairs:
+        if name_1 not in slices or name_2 not in slices:
+            continue
+        rows, columns = slices[name_1], slices[name_2]
+        block = matrix[rows, columns].tolist()
+        for id_1, row in zip(ids[rows], block):
+            distances.extend(
+                {"distance": distance, "feature_1": id_1, "feature_2": id_2}
+                for id_2, distance in zip(ids[columns], row)
+            )
+    current_span().set(features=len(features), distances=len(distances))
+    return distances
@@ -0,0 +1,48 @@
+import os
+import time
+
+from aigolfcaddie.cache import DiskCache, LRUCache, TieredCache, cache_key
+
+
+def test_cache_key_depends_on_every_part():
+    """The same image with different SAM parameters is a different entry."""
+    assert cache_key("img", {"a": 1, "b": 2}) == cache_key("img", {"b": 2, "a": 1})
+    assert cache_key("img", {"a": 1}) != cache_key("img", {"a": 2})
+    assert cache_key("ab", "c") != cache_key("a", "bc")
+
+
+def test_lru_cache_drops_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    cache.get("a")
+    cache.put("c", b"3")
+    assert cache.get("a") == b"1"
+    assert cache.get("b") is None
+    assert cache.get("c") == b"3"
+
+
+def test_disk_cache_evicts_past_size_limit(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=10)
+    cache.put("old", b"x" * 6)
+    os.utime(tmp_path / "old", (0, 0))
+    cache.put("new", b"y" * 6)
+    assert cache.get("old") is None
+    assert cache.get("new") == b"y" * 6
+
+
+def test_tiered_cache_promotes_disk_hits(tmp_path):
+    TieredCache(4, str(tmp_path), 1024).put("key", b"value")
+    cache = TieredCache(4, str(tmp_path), 1024)
+    assert cache.memory.get("key") is None
+    assert cache.get("key") == b"value"
+    assert cache.memory.get("key") == b"value"
+
+
+def test_tiered_cache_expires_values_after_ttl(tmp_path, monkeypatch):
+    cache = TieredCache(4, str(tmp_path), 1024, ttl=60)
+    cache.put("key", b"value")
+    assert cache.get("key") == b"value"
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("key") is None
@@ -0,0 +1,96 @@
+import numpy as np
+
+from aigolfcaddie.geometry import (
+    PolygonIndex, pack_polygons, points_in_polygons, polygon_areas, polygon_bboxes,
+    polygon_centroids, polygon_spans, simplification_error, simplify_polygons
+)
+
+
+def square(u, v, size):
+    return [[u, v], [u + size, v], [u + size, v + size], [u, v + size]]
+
+
+def test_batched_polygon_measures():
+    """Areas, centers of mass and bounding boxes are computed for every polygon at once."""
+    vertices, offsets = pack_polygons([square(0, 0, 2), [[0, 0], [4, 0], [0, 3]], []])
+    assert offsets.tolist() == [0, 4, 7]
+    assert np.allclose(polygon_areas(vertices, offsets), [4, 6])
+    assert np.allclose(polygon_centroids(vertices, offsets), [[1, 1], [4 / 3, 1]])
+    assert np.allclose(polygon_bboxes(vertices, offsets), [[0, 0, 2, 2], [0, 0, 4, 3]])
+
+
+def test_points_in_polygons():
+    """Ray casting tests every (point, polygon) pair in one pass."""
+    # An L shape whose bounding box covers the point (3, 3) although the shape does not.
+    vertices, offsets = pack_polygons([
+        [[0, 0], [4, 0], [4, 1], [1, 1], [1, 4], [0, 4]],
+        square(2, 2, 2),
+    ])
+    points = np.array([[0.5, 3.0], [3.0, 3.0], [3.0, 0.5]])
+    inside = points_in_polygons(
+        points, vertices, offsets, np.array([0, 1, 2, 1]), np.array([0, 0, 0, 1])
+    )
+    assert inside.tolist() == [True, False, True, True]
+
+
+def test_polygon_spans_fill_the_cells_whose_center_is_inside():
+    """A cell is in a run exactly when ray casting puts its center in one of the polygons."""
+    angles = np.linspace(0, 2 * np.pi, 40, endpoint=False)
+    radii = np.where(np.arange(40) % 2, 4.3, 9.7)
+    star = np.stack([12.2 + radii * np.cos(angles), 9.6 + radii * np.sin(angles)], axis=1)
+    vertices, offsets = pack_polygons([
+        star.tolist(), [[0, 0], [4, 0], [4, 1], [1, 1], [1, 4], [0, 4]], square(18.5, -3, 6)
+    ])
+    filled = np.zeros((20, 24), dtype=bool)
+    for row, start, end in zip(*polygon_spans(vertices, offsets, filled.shape, np.arange(3))):
+        filled[row, start:end] = True
+    rows, columns = np.indices(filled.shape)
+    centers = np.stack([columns.ravel() + 0.5, rows.ravel() + 0.5], axis=1)
+    inside = np.zeros(len(centers), dtype=bool)
+    for polygon in range(3):
+        inside |= points_in_polygons(centers, vertices, offsets, np.arange(len(centers)),
+                                     np.full(len(centers), polygon))
+    assert filled.ravel().tolist() == inside.tolist()
+    assert all(len(span) == 0 for span in polygon_spans(vertices, offsets, (20, 24), []))
+
+
+def test_polygon_index_orders_by_bbox_area():
+    """Lookups return the polygons under a point from smallest to largest bounding box."""
+    index = PolygonIndex(*pack_polygons([square(0, 0, 100), square(40, 40, 10),
+                                         square(200, 200, 5)]))
+    assert index.query(45, 45).tolist() == [1, 0]
+    assert index.query(10, 10).tolist() == [0]
+    assert index.query(150, 150).tolist() == []
+    point_ids, polygon_ids = index.candidates(np.array([[45, 45], [201, 201]]))
+    assert point_ids.tolist() == [0, 0, 1]
+    assert polygon_ids.tolist() == [1, 0, 2]
+
+
+def test_polygon_index_empty():
+    """An empty SAM response never matches a click."""
+    assert PolygonIndex(*pack_polygons([])).query(1, 1).tolist() == []
+
+
+def test_polygon_index_locate_uses_true_containment():
+    """A click in the notch of a large shape goes to the polygon that really contains it."""
+    index = PolygonIndex(*pack_polygons([
+        [[0, 0], [40, 0], [40, 10], [10, 10], [10, 40], [0, 40]],
+        square(15, 15, 30),
+        square(20, 20, 5),
+    ]))
+    located = index.locate(np.array([[30, 30], [5, 30], [22, 22], [60, 60]]))
+    assert located.tolist() == [1, 0, 2, -1]
+
+
+def test_simplify_polygons_within_tolerance():
+    """A densely sampled circle keeps its shape with a fraction of its vertices."""
+    angles = np.linspace(0, 2 * np.pi, 2000, endpoint=False)
+    circle = np.stack([50 + 40 * np.cos(angles), 50 + 40 * np.sin(angles)], axis=1)
+    vertices, offsets = pack_polygons([circle.tolist(), square(0, 0, 5)])
+
+    simplified = simplify_polygons(vertices, offsets, tolerance=0.5)
+    report = simplification_error(vertices, offsets, *simplified)
+    assert np.diff(simplified[1]).tolist()[1] == 4
+    assert report["simplified_vertices"] < 100
+    assert report["max_area_error"] < 0.02
+    assert report["max_centroid_shift"] < 0.5
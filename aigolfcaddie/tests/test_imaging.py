@@ -0,0 +1,49 @@
+import base64
+import io
+
+from PIL import Image
+
+from aigolfcaddie.imaging import LLM_UPLOAD, SAM_UPLOAD, MapImage
+
+
+def test_map_image_encodes_once(tmp_path):
+    """Each representation is computed on first use and then reused."""
+    path = tmp_path / "map.png"
+    Image.new("RGBA", (30, 20), (10, 20, 30, 255)).save(path)
+    image = MapImage(str(path))
+
+    assert image.size == (30, 20)
+    assert image.b64_png is image.b64_png
+    assert base64.b64decode(image.b64_png) == image.png_bytes
+    assert image.bgr.shape == (20, 30, 3)
+    assert image.bgr[0, 0].tolist() == [30, 20, 10]
+    assert not image.bgr.flags.writeable
+
+
+def test_map_image_upload_downscales(tmp_path):
+    """Uploads shrink to the maximum dimension and report the factor to map pixels back."""
+    path = tmp_path / "map.png"
+    Image.new("RGB", (400, 200), (10, 20, 30)).save(path)
+    image = MapImage(str(path))
+
+    upload = image.upload(max_dimension=100, format="jpeg", quality=80)
+    assert upload.factor == 0.25
+    assert upload.data_url.startswith("data:image/jpeg;base64,")
+    with Image.open(io.BytesIO(upload.data)) as decoded:
+        assert decoded.size == (100, 50)
+    assert image.upload(max_dimension=100, format="JPEG", quality=80) is upload
+    assert image.upload().data == image.png_bytes
+
+
+def test_map_image_resizes_once_per_size(tmp_path):
+    """Uploads of the same size share one resized map, and the default presets one upload."""
+
+    path = tmp_path / "map.png"
+    Image.new("RGB", (400, 200), (10, 20, 30)).save(path)
+    image = MapImage(str(path))
+
+    jpeg = image.upload(max_dimension=100, format="JPEG", quality=80)
+    webp = image.upload(max_dimension=100, format="WEBP", quality=60)
+    assert jpeg.data != webp.data and jpeg.factor == webp.factor
+    assert list(image.resized) == [100]
+    assert image.upload(**SAM_UPLOAD) is image.upload(**LLM_UPLOAD)
@@ -0,0 +1,48 @@
+import time
+
+from aigolfcaddie.constants import FORMATTED
+from aigolfcaddie.planner import plan_hole
+from aigolfcaddie.utils import setup_info
+
+
+def hole(bunker_center):
+    """A straight 420 yard hole played up the image, with a bunker."""
+    u, v = bunker_center
+    return [
+        {"feature_id": 0, "feature_name": "tee", "feature_center_yards": (0.0, 420.0),
+         "tee_color": "black"},
+        {"feature_id": 1, "feature_name": "fairway", "feature_center_yards": (0.0, 200.0),
+         "coordinates": [-20.0, 60.0, 20.0, 340.0]},
+        {"feature_id": 2, "feature_name": "bunker", "feature_center_yards": bunker_center,
+         "coordinates": [u - 8, v - 8, u + 8, v + 8]},
+        {"feature_id": 3, "feature_name": "green", "feature_center_yards": (0.0, 0.0)},
+    ]
+
+
+def test_plan_follows_the_schema_and_reaches_the_hole():
+    start = time.perf_counter()
+    plan = plan_hole(setup_info(), hole((30.0, 150.0)))
+    assert time.perf_counter() - start < 0.1
+
+    schema = FORMATTED["json_schema"]["schema"]["properties"]
+    shot_keys = set(schema["strategy"]["items"]["required"])
+    assert set(plan) == {"strategy", "expected_outcome"}
+    assert set(plan["expected_outcome"]) == set(schema["expected_outcome"]["required"])
+    assert all(set(shot) == shot_keys for shot in plan["strategy"])
+    assert plan["strategy"][-1]["club"] == "putter"
+    assert plan["strategy"][-1]["distance_from_hole"] == 0
+    obstacle, = plan["expected_outcome"]["location_of_all_obstacles"]
+    assert obstacle["left_right_or_center_from_fairway"] == "right"
+    assert obstacle["distance_from_tee"] == 272
+
+
+def test_plan_lays_up_short_of_a_bunker_at_driver_distance():
+    setup = setup_info()
+    clear = plan_hole(setup, hole((60.0, 0.0)))
+    assert clear["strategy"][0]["club"] == "driver"
+    guarded = plan_hole(setup, hole((0.0, 150.0)))
+    assert guarded["strategy"][0]["distance hit"] < 230
+
+
+def test_plan_needs_a_tee_and_a_green():
+    assert plan_hole(setup_info(), hole((0.0, 150.0))[:3]) is None
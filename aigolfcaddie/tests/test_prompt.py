@@ -0,0 +1,20 @@
+import json
+
+from aigolfcaddie.prompt import compact_sections, distance_table, section_tokens
+
+
+def test_compact_sections_list_features_once_and_index_distances_by_id():
+    features = [
+        {"feature_id": 0, "feature_name": "tee", "feature_center_yards": (1.04, 2.0),
+         "tee_color": "red"},
+        {"feature_id": 1, "feature_name": "green", "feature_center_yards": (4.0, 6.0)},
+    ]
+    distances = [{"distance": 5.0049, "feature_1": 0, "feature_2": 1}]
+
+    sections = compact_sections({"level_error": 20}, features, distances)
+    assert list(sections) == ["Setup Information", "Physical Features", "Inter-Feature Distance"]
+    assert ", " not in sections["Physical Features"] and ": " not in sections["Physical Features"]
+    assert json.loads(sections["Physical Features"])[0]["feature_center_yards"] == [1.0, 2.0]
+    assert json.loads(sections["Inter-Feature Distance"]) == {"0": {"1": 5.0}}
+    assert distance_table(distances) == {"0": {"1": 5.0049}}
+    assert all(tokens > 0 for tokens in section_tokens(sections).values())
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from aigolfcaddie.sam_client import AsyncSamClient, SamClient
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Answers 503 to the first POST, then echoes the request parameters."""
+    posts = 0
+
+    def do_POST(self):
+        FlakyHandler.posts += 1
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        status = 503 if FlakyHandler.posts == 1 else 200
+        payload = json.dumps({"type": body["type"]}).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/sam/"
+    httpd.shutdown()
+
+
+def test_automask_retries_server_errors(server):
+    FlakyHandler.posts = 0
+    client = SamClient(server, retries=2, backoff=0)
+    result = client.automask("aW1n", {"type": "sam2_l"})
+    assert result.ok
+    assert result.json() == {"type": "sam2_l"}
+    assert FlakyHandler.posts == 2
+    client.close()
+
+
+def test_async_automask_retries_server_errors(server):
+    FlakyHandler.posts = 0
+
+    async def automask():
+        client = AsyncSamClient(server, retries=2, backoff=0)
+        try:
+            return await client.automask("aW1n", {"type": "sam2_l"})
+        finally:
+            await client.close()
+
+    result = asyncio.run(automask())
+    assert result.is_success
+    assert result.json() == {"type": "sam2_l"}
+    assert FlakyHandler.posts == 2
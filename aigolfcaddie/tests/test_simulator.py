@@ -0,0 +1,64 @@
+import time
+
+import numpy as np
+
+from aigolfcaddie.simulator import TERRAINS, HazardMap, simulate_shot, simulate_shots
+from aigolfcaddie.utils import match_features
+
+
+def square(u0, v0, u1, v1):
+    return np.array([[u0, v0], [u1, v0], [u1, v1], [u0, v1], [u0, v0]], dtype=float)
+
+
+def hazard_map():
+    """A fairway up the image with a bunker in its middle, and a green at the origin."""
+    rings = [square(-20, 60, 20, 340), square(-10, 140, 10, 160), square(-15, -15, 15, 15)]
+    offsets = np.cumsum([0] + [len(ring) for ring in rings])
+    return HazardMap.from_polygons(np.concatenate(rings), offsets, ["fairway", "bunker", "green"])
+
+
+def test_simulated_rates_follow_the_dispersion():
+    hazards = hazard_map()
+    rng = np.random.default_rng(0)
+    # A perfect player hits what they aim at, bunker over fairway where they overlap.
+    exact = simulate_shot(hazards, (0, 420), (0, 150), 300, 1e-6, rng=rng, distance_error=1e-6)
+    assert exact["bunker"] > 0.95
+    # Short of the aim point, the shot carries the full distance of the club.
+    short = simulate_shot(hazards, (0, 420), (0, 0), 220, 1e-6, rng=rng, distance_error=1e-6)
+    assert short["fairway"] > 0.95
+    # A wider dispersion sends more shots into the rough.
+    wide = simulate_shots(hazards, (0, 420), [(0, 250), (0, 250)], [300, 300], 1.0, rng=rng)
+    wider = simulate_shots(hazards, (0, 420), [(0, 250)], [300], 20.0, rng=rng)
+    assert abs(wide[0] - wide[1]).max() < 0.02
+    assert wider[0, 0] > wide[0, 0] + 0.3
+    assert np.allclose(wider.sum(axis=1), 1)
+
+
+def test_lookup_splits_cells_at_the_polygon_edges():
+    hazards = HazardMap.from_polygons(square(10, 10, 30, 30), np.array([0, 5]), ["bunker"])
+    edges = np.array([[10, 20], [30, 20], [20, 10], [20, 30]], dtype=float)
+    normals = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]], dtype=float)
+    inside = hazards.lookup(edges - 0.1 * normals)
+    outside = hazards.lookup(edges + 0.1 * normals)
+    assert inside.tolist() == [TERRAINS.index("bunker")] * 4
+    assert outside.tolist() == [TERRAINS.index("rough")] * 4
+
+
+def test_one_hundred_thousand_samples_take_well_under_100_ms():
+    hazards = hazard_map()
+    rng = np.random.default_rng(0)
+    simulate_shot(hazards, (0, 420), (0, 150), 270, 20, rng=rng)
+    start = time.perf_counter()
+    simulate_shot(hazards, (0, 420), (0, 150), 270, 20, samples=100_000, rng=rng)
+    assert time.perf_counter() - start < 0.1
+
+
+def test_hazard_map_paints_the_matched_features():
+    rings = [square(0, 0, 100, 100), square(200, 0, 220, 20)]
+    clicks = {"green": [{"u": 50, "v": 50}], "bunker": [], "fairway": [], "tee": [],
+              "scale": 1.0}
+    hazards = HazardMap.from_matches(*match_features(
+        np.concatenate(rings), np.array([0, 5, 10]), clicks, simplify_tolerance=0
+    ))
+    assert hazards.lookup(np.array([[50.0, 50.0], [210.0, 10.0], [-50.0, 0.0]])).tolist() == \
+        [3, 0, 0]
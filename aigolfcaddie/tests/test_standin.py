@@ -0,0 +1,59 @@
+import asyncio
+import base64
+import io
+import json
+
+from openai import AsyncOpenAI
+from PIL import Image
+
+from aigolfcaddie import utils
+from aigolfcaddie.cache import TieredCache
+from aigolfcaddie.sam_client import SamClient
+from benchmarks.standin import STANDIN_STRATEGY, StandinServer
+from aigolfcaddie.transport import decode_sam_response
+
+
+def blank_image(width, height):
+    image_bytes = io.BytesIO()
+    Image.new("RGB", (width, height)).save(image_bytes, format="PNG")
+    return base64.b64encode(image_bytes.getvalue()).decode()
+
+
+def test_standin_serves_synthetic_polygons_in_either_format():
+    with StandinServer(count=25, vertices=40) as server:
+        client = SamClient(server.address, retries=0)
+        assert client.version() == "standin"
+        for packed in (True, False):
+            result = client.automask(blank_image(400, 300), {"type": "sam2_l"}, packed=packed)
+            vertices, offsets = decode_sam_response(result.content, result.headers["Content-Type"])
+            assert len(offsets) - 1 == 25
+            assert vertices.min() >= 0 and vertices[:, 0].max() <= 400
+        result = client.prompts(blank_image(400, 300), [(100, 50)], {}, packed=True)
+        vertices, offsets = decode_sam_response(result.content, result.headers["Content-Type"])
+        assert len(offsets) == 2
+        assert abs(vertices.mean(axis=0) - (100, 50)).max() < 5
+        client.close()
+
+
+def test_standin_replays_recorded_responses(tmp_path):
+    ring = [[0, 0], [10, 0], [10, 10], [0, 0]]
+    (tmp_path / "hole.json").write_text(json.dumps(
+        [{"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [ring]},
+          "properties": {}}]
+    ))
+    with StandinServer(replay=str(tmp_path)) as server:
+        client = SamClient(server.address, retries=0)
+        result = client.automask("aW1n", {}, packed=True)
+        vertices, offsets = decode_sam_response(result.content, result.headers["Content-Type"])
+        client.close()
+    assert vertices.tolist() == ring
+    assert offsets.tolist() == [0, 4]
+
+
+def test_standin_streams_chat_completions(monkeypatch):
+    with StandinServer() as server:
+        monkeypatch.setattr(utils, "strategy_cache", TieredCache(0, None, 0))
+        monkeypatch.setattr(utils, "async_client",
+                            AsyncOpenAI(api_key="standin", base_url=server.openai_base_url))
+        response = asyncio.run(utils.get_gpt_response_async("Plan the hole."))
+    assert json.loads(response) == STANDIN_STRATEGY
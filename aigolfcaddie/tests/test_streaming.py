@@ -0,0 +1,27 @@
+import json
+
+from benchmarks.standin import STANDIN_STRATEGY
+from aigolfcaddie.streaming import StrategyParser, describe_shot
+
+
+def test_strategy_parser_returns_each_shot_as_soon_as_it_closes():
+    text = json.dumps(STANDIN_STRATEGY)
+    parser = StrategyParser()
+    completed = []
+    for index, char in enumerate(text):
+        for shot in parser.feed(char):
+            completed.append((index, shot))
+    shots = STANDIN_STRATEGY["strategy"]
+    assert [shot for _, shot in completed] == shots
+    first_end = text.index("}")
+    assert completed[0][0] == first_end
+    assert parser.done and parser.result() == STANDIN_STRATEGY
+    assert describe_shot(1, shots[0]).startswith("Shot 1: driver, 250 yards")
+
+
+def test_strategy_parser_ignores_brackets_in_strings_and_other_lists():
+    parser = StrategyParser()
+    shots = parser.feed('{"notes": [{"a": 1}], "strategy": [{"club": "7-iron \\"}{\\" ]"}, ')
+    assert shots == [{"club": '7-iron "}{" ]'}]
+    assert parser.feed('{"club": "putter"}]}') == [{"club": "putter"}]
+    assert parser.result()["notes"] == [{"a": 1}]
@@ -0,0 +1,38 @@
+import numpy as np
+
+from aigolfcaddie.geometry import pack_polygons, polygon_areas, polygon_bboxes
+from aigolfcaddie.tiling import merge_tiles, tile_boxes
+
+
+def clip_rectangle(rectangle, box):
+    """The part of a map rectangle one tile sees, in pixels of the tile."""
+    u0, v0, u1, v1 = box
+    a, b = max(rectangle[0], u0) - u0, max(rectangle[1], v0) - v0
+    c, d = min(rectangle[2], u1) - u0, min(rectangle[3], v1) - v0
+    if a >= c or b >= d:
+        return []
+    return [[a, b], [c, b], [c, d], [a, d]]
+
+
+def test_tile_boxes_cover_the_map_with_overlap():
+    boxes = tile_boxes(2000, 1000, tile_size=1024, overlap=128)
+    assert boxes == [(0, 0, 1024, 1000), (488, 0, 1512, 1000), (976, 0, 2000, 1000)]
+    assert tile_boxes(800, 600) == [(0, 0, 800, 600)]
+
+
+def test_merge_tiles_joins_features_across_seams():
+    """A fairway cut by every seam comes back whole; features inside one tile are kept."""
+    boxes = tile_boxes(2000, 1500, tile_size=1024, overlap=128)
+    fairway = (100, 200, 1900, 1300)
+    tiles = []
+    for box in boxes:
+        bunker = [[10, 10], [30, 10], [30, 30], [10, 30]]
+        tiles.append(pack_polygons([clip_rectangle(fairway, box), bunker]))
+
+    vertices, offsets = merge_tiles(tiles, boxes)
+    areas = np.abs(polygon_areas(vertices, offsets))
+    bboxes = polygon_bboxes(vertices, offsets)
+    assert len(offsets) - 1 == 1 + len(boxes)
+    assert areas[0] == 1800 * 1100
+    assert bboxes[0].tolist() == list(fairway)
+    assert sorted(areas[1:].tolist()) == [400.0] * len(boxes)
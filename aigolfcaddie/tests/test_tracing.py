@@ -0,0 +1,114 @@
+import asyncio
+import json
+
+import pytest
+from openai import AsyncOpenAI, OpenAI
+
+from aigolfcaddie import tracing, utils
+from aigolfcaddie.cache import TieredCache
+from benchmarks.standin import StandinServer
+
+
+class ListSink(tracing.Sink):
+    def __init__(self):
+        self.spans = []
+
+    def on_end(self, span):
+        self.spans.append(span)
+
+
+@pytest.fixture
+def sink():
+    sink = ListSink()
+    tracing.configure([sink])
+    yield sink
+    tracing.configure([])
+
+
+def test_spans_are_noops_when_disabled():
+    tracing.configure([])
+    with tracing.span("stage", polygons=3) as span:
+        span.set(clicks=1)
+    assert tracing.current_span() is span
+
+
+def test_traced_functions_nest_into_one_trace(sink, tmp_path):
+    @tracing.traced("inner")
+    def inner():
+        tracing.current_span().set(polygons=12)
+
+    with tracing.span("outer", clicks=2):
+        inner()
+    inner_span, outer_span = sink.spans
+    assert inner_span.attributes == {"polygons": 12}
+    assert inner_span.parent is outer_span
+    assert inner_span.trace_id == outer_span.trace_id
+    assert outer_span.duration >= inner_span.duration
+
+    path = tmp_path / "spans.jsonl"
+    tracing.JsonLinesSink(str(path)).on_end(inner_span)
+    record = json.loads(path.read_text())
+    assert record["parent_id"] == outer_span.span_id
+    assert record["attributes"] == {"polygons": 12}
+
+
+def test_gpt_span_records_first_token_and_usage(sink, monkeypatch):
+    with StandinServer(first_token_latency=0.05) as server:
+        monkeypatch.setattr(utils, "strategy_cache", TieredCache(0, None, 0))
+        monkeypatch.setattr(utils, "async_client",
+                            AsyncOpenAI(api_key="standin", base_url=server.openai_base_url))
+        asyncio.run(utils.get_gpt_response_async("Plan the hole."))
+    gpt_span, = sink.spans
+    assert gpt_span.name == "gpt"
+    assert gpt_span.attributes["time_to_first_token"] >= 0.05
+    assert gpt_span.attributes["completion_tokens"] > 0
+
+
+def test_gpt_span_separates_cached_prompt_tokens(sink, monkeypatch):
+    with StandinServer() as server:
+        monkeypatch.setattr(utils, "strategy_cache", TieredCache(0, None, 0))
+        monkeypatch.setattr(utils, "async_client",
+                            AsyncOpenAI(api_key="standin", base_url=server.openai_base_url))
+        prefix, _ = utils.llm_input(utils.setup_info(), [], [])
+
+        async def two_holes():
+            for message in ("First hole.", "Second hole."):
+                await utils.get_gpt_response_async(message, None, prefix)
+        asyncio.run(two_holes())
+    first, second = (span.attributes for span in sink.spans)
+    assert first["cached_prompt_tokens"] == 0
+    assert second["cached_prompt_tokens"] >= 1024
+    assert second["uncached_prompt_tokens"] == \
+        second["prompt_tokens"] - second["cached_prompt_tokens"]
+
+
+def test_gpt_answers_a_repeated_hole_from_the_strategy_cache(sink, monkeypatch):
+    monkeypatch.setattr(utils, "strategy_cache", TieredCache(4, None, 0, ttl=60))
+    with StandinServer() as server:
+        monkeypatch.setattr(utils, "async_client",
+                            AsyncOpenAI(api_key="standin", base_url=server.openai_base_url))
+
+        async def two_golfers():
+            return [await utils.get_gpt_response_async("Same hole.", None, "Same setup.")
+                    for _ in range(2)]
+        first, second = asyncio.run(two_golfers())
+    assert first == second
+    assert [span.attributes["cache_hit"] for span in sink.spans] == [False, True]
+    assert "completion_tokens" not in sink.spans[1].attributes
+
+
+def test_gpt_functions_accept_their_keyword_arguments(sink, monkeypatch):
+    monkeypatch.setattr(utils, "strategy_cache", TieredCache(4, None, 0, ttl=60))
+    with StandinServer() as server:
+        monkeypatch.setattr(utils, "client",
+                            OpenAI(api_key="standin", base_url=server.openai_base_url))
+        monkeypatch.setattr(utils, "async_client",
+                            AsyncOpenAI(api_key="standin", base_url=server.openai_base_url))
+        deltas = []
+        first = utils.get_gpt_response("Same hole.", image_path=None, prefix="Same setup.",
+                                       on_delta=deltas.append)
+        second = asyncio.run(utils.get_gpt_response_async(
+            message="Same hole.", image_url=None, prefix="Same setup.", on_delta=deltas.append))
+    assert not first.startswith("Error")
+    assert first == second == deltas[-1]
+    assert [span.attributes["cache_hit"] for span in sink.spans] == [False, True]
@@ -0,0 +1,49 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+
+from aigolfcaddie.geometry import pack_polygons
+from aigolfcaddie.transport import (
+    PACKED_CONTENT_TYPE, SamResponseError, decode_sam_response, pack_sam_polygons,
+    unpack_sam_polygons
+)
+
+
+RINGS = [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], [[5, 5], [8, 5], [8, 9]]]
+
+
+def test_packed_polygons_round_trip():
+    vertices, offsets = pack_polygons(RINGS)
+    data = pack_sam_polygons(vertices, offsets)
+    decoded_vertices, decoded_offsets = unpack_sam_polygons(data)
+    assert np.array_equal(decoded_vertices, vertices)
+    assert np.array_equal(decoded_offsets, offsets)
+
+
+def test_decode_sam_response_picks_format_from_content_type():
+    """GeoJSON and packed responses decode to the same arrays."""
+    geojson = json.dumps([
+        {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [ring]},
+         "properties": {}}
+        for ring in RINGS
+    ]).encode()
+    packed = pack_sam_polygons(*pack_polygons(RINGS))
+    assert len(packed) < len(gzip.compress(geojson))
+
+    from_geojson = decode_sam_response(geojson, "application/json")
+    from_packed = decode_sam_response(packed, PACKED_CONTENT_TYPE + "; charset=binary")
+    for a, b in zip(from_geojson, from_packed):
+        assert np.array_equal(a, b)
+
+
+@pytest.mark.parametrize("body, content_type", [
+    (pack_sam_polygons(*pack_polygons(RINGS))[:-4], PACKED_CONTENT_TYPE),
+    (pack_sam_polygons(*pack_polygons(RINGS))[:6], PACKED_CONTENT_TYPE),
+    (b'[{"type": "Feature", "geometry": {"coord', "application/json"),
+    (b'[{"type": "Feature"}]', "application/json"),
+])
+def test_truncated_responses_raise_one_error(body, content_type):
+    with pytest.raises(SamResponseError):
+        decode_sam_response(body, content_type)
@@ -0,0 +1,85 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from aigolfcaddie import utils
+from aigolfcaddie.cache import TieredCache
+from aigolfcaddie.sam_client import SamClient
+from aigolfcaddie.utils import analyze_result, call_sam_prompts, click_points, feature_analysis
+
+
+def polygon(u, v, size):
+    ring = [[u, v], [u + size, v], [u + size, v + size], [u, v + size], [u, v]]
+    return {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {}}
+
+
+def test_analyze_result_maps_downscaled_polygons_back():
+    """Polygons segmented on a half size upload land in the frame of the original clicks."""
+    clicks = {"bunker": [{"u": 30, "v": 30}], "green": [{"u": 500, "v": 500}], "tee": [],
+              "fairway": [], "scale": 2.0}
+    geojson = json.dumps([polygon(0, 0, 100), polygon(10, 10, 10)])
+
+    metrics = analyze_result(geojson, clicks, upload_factor=0.5)
+    assert metrics == [{
+        "feature_id": 0,
+        "feature_name": "bunker",
+        "feature_center_yards": (60.0, 60.0),
+        "coordinates": [40.0, 40.0, 80.0, 80.0],
+    }]
+    assert clicks["bunker"] == [{"u": 30, "v": 30}]
+
+
+def test_feature_analysis_measures_type_pairs_by_feature_id():
+    features = {
+        "tee": [{"feature_id": 0, "feature_center_yards": (0.0, 0.0)}],
+        "green": [{"feature_id": 1, "feature_center_yards": (3.0, 4.0)}],
+        "bunker": [{"feature_id": 2, "feature_center_yards": (0.0, 1.0)},
+                   {"feature_id": 3, "feature_center_yards": (3.0, 0.0)}],
+    }
+    assert feature_analysis(features) == [
+        {"distance": 1.0, "feature_1": 0, "feature_2": 2},
+        {"distance": 3.0, "feature_1": 0, "feature_2": 3},
+        {"distance": 4.24, "feature_1": 2, "feature_2": 1},
+        {"distance": 4.0, "feature_1": 3, "feature_2": 1},
+        {"distance": 5.0, "feature_1": 0, "feature_2": 1},
+    ]
+
+
+class SamapiHandler(BaseHTTPRequestHandler):
+    """Like stock samapi: no /sam/prompts/, and a square around the point prompt on /sam/."""
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path != "/sam/":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        (u, v), = body["point_coords"]
+        payload = json.dumps([polygon(u - 5, v - 5, 10)]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_call_sam_prompts_falls_back_to_one_request_per_click(monkeypatch):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), SamapiHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(utils, "sam_client",
+                        SamClient(f"http://127.0.0.1:{httpd.server_address[1]}/sam/", retries=0))
+    monkeypatch.setattr(utils, "sam_cache", TieredCache(4, None, 0))
+    try:
+        clicks = {"green": [{"u": 100, "v": 40}], "bunker": [{"u": 20, "v": 60}], "scale": 1.0}
+        points = click_points(clicks, upload_factor=0.5)
+        assert points == [(50.0, 20.0), (10.0, 30.0)]
+        vertices, offsets = call_sam_prompts("aW1n", points)
+    finally:
+        httpd.shutdown()
+    assert offsets.tolist() == [0, 5, 10]
+    assert vertices[:5].min(axis=0).tolist() == [45.0, 15.0]
+    assert vertices[5:].min(axis=0).tolist() == [5.0, 25.0]
@@ -0,0 +1,504 @@
+"""
+author: Peter Xiao
+email: peterxiaofun@gmail.com
+date: 2024-09-09
+"""
+
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+import cv2
+import numpy as np
+import torch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Tuple
+
+from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from sam2.build_sam import build_sam2
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+
+"""
+A SAM2 server speaking the samapi protocol used by the app, built for many concurrent users.
+
+samapi runs one uvicorn worker holding one model, so requests are served one at a time. Here a
+single process holds the model once per GPU, and every automask and prompt request goes through
+a shared queue: each GPU takes up to SAM_MAX_BATCH waiting requests at once (waiting at most
+SAM_MAX_WAIT_MS for the batch to fill) and runs their images through the image encoder as one
+batch, then decodes the masks of each request. The light work around the GPU (decoding images,
+tracing mask outlines and encoding responses) runs on a pool of SAM_CPU_WORKERS threads.
+
+Image embeddings, the expensive half of segmentation, are cached by image hash within
+SAM_EMBEDDING_CACHE_MB. A map queried again, with other clicks or parameters, only runs the
+cheap mask decoder.
+
+Start it with a single uvicorn worker, the process spreads the load over the GPUs by itself:
+    uvicorn batch_server:app --workers 1 --port 3000
+
+Endpoints:
+    GET  /sam/version/      the server version.
+    POST /sam/automask/     segment a whole image, like samapi.
+    POST /sam/              segment the object under one point prompt, like samapi.
+    POST /sam/prompts/      segment the objects under several point prompts of one image.
+
+Segmentations are answered as samapi GeoJSON, or in the compact polygon format of
+aigolfcaddie/transport.py when the request accepts PACKED_CONTENT_TYPE.
+"""
+
+
+SERVER_VERSION = "0.6.0+batch"
+
+# Model checkpoint and config, see https://github.com/facebookresearch/sam2.
+SAM_CHECKPOINT = os.environ.get("SAM_CHECKPOINT", "checkpoints/sam2.1_hiera_large.pt")
+SAM_CONFIG = os.environ.get("SAM_CONFIG", "configs/sam2.1/sam2.1_hiera_l.yaml")
+
+# The most requests encoded together, and how long the first request of a batch waits for others.
+SAM_MAX_BATCH = int(os.environ.get("SAM_MAX_BATCH", 4))
+SAM_MAX_WAIT_MS = float(os.environ.get("SAM_MAX_WAIT_MS", 20))
+
+# Memory held by cached image embeddings, across all GPUs. A SAM2-L embedding takes about 8MB in
+# bfloat16 (16MB in float32), so the default keeps the last couple of hundred maps.
+SAM_EMBEDDING_CACHE_MB = int(os.environ.get("SAM_EMBEDDING_CACHE_MB", 2048))
+
+# Threads for decoding images, tracing mask outlines and encoding responses.
+SAM_CPU_WORKERS = int(os.environ.get("SAM_CPU_WORKERS", 4))
+
+# Compact polygon format, see aigolfcaddie/transport.py.
+PACKED_CONTENT_TYPE = "application/x-sam-polygons"
+PACKED_MAGIC = b"SAMP1"
+
+
+class AutomaskRequest(BaseModel):
+    b64img: str
+    type: str = "sam2_l"
+    points_per_side: int = 32
+    points_per_batch: int = 64
+    pred_iou_thresh: float = 0.88
+    stability_score_thresh: float = 0.95
+    min_mask_region_area: int = 0
+    output_type: str = "Multi-mask (all)"
+
+
+class PromptRequest(BaseModel):
+    b64img: str
+    type: str = "sam2_l"
+    point_coords: List[List[float]]
+    point_labels: List[int]
+    multimask_output: bool = False
+
+
+class PromptsRequest(BaseModel):
+    b64img: str
+    type: str = "sam2_l"
+    prompts: List[Dict]
+    multimask_output: bool = False
+
+
+class Embedding:
+    """
+    The image encoder output for one image, kept on the device of the model that computed it.
+    """
+    def __init__(self, image_embed: torch.Tensor, high_res_feats: List[torch.Tensor],
+                 size: Tuple[int, int]):
+        self.image_embed = image_embed
+        self.high_res_feats = high_res_feats
+        self.size = size
+
+    @property
+    def device(self) -> torch.device:
+        return self.image_embed.device
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            tensor.element_size() * tensor.nelement()
+            for tensor in [self.image_embed, *self.high_res_feats]
+        )
+
+    def to(self, device: str) -> "Embedding":
+        return Embedding(
+            self.image_embed.to(device),
+            [feature.to(device) for feature in self.high_res_feats],
+            self.size
+        )
+
+
+class EmbeddingCache:
+    """
+    Image embeddings keyed by image hash, dropping the least recently used ones once they hold
+    more than max_bytes. Only used from the event loop thread.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key: str) -> Optional[Embedding]:
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key: str, embedding: Embedding) -> None:
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        if embedding.nbytes > self.max_bytes:
+            return
+        self.entries[key] = embedding
+        self.nbytes += embedding.nbytes
+        while self.nbytes > self.max_bytes:
+            _, dropped = self.entries.popitem(last=False)
+            self.nbytes -= dropped.nbytes
+
+
+class EmbeddedPredictor(SAM2ImagePredictor):
+    """
+    A predictor that can be handed an embedding computed in a batch instead of encoding the
+    image again. The automatic mask generator calls set_image on the whole image, which then
+    reuses the embedding.
+    """
+    embedding: Optional[Embedding] = None
+
+    def use(self, embedding: Embedding) -> None:
+        """
+        Make embedding the current image, as set_image would after encoding it.
+        """
+        self.reset_predictor()
+        self._orig_hw = [embedding.size]
+        self._features = {
+            "image_embed": embedding.image_embed,
+            "high_res_feats": embedding.high_res_feats,
+        }
+        self._is_image_set = True
+
+    def set_image(self, image) -> None:
+        if self.embedding is not None and tuple(image.shape[:2]) == self.embedding.size:
+            self.use(self.embedding)
+        else:
+            super().set_image(image)
+
+
+class SamModel:
+    """
+    SAM2 loaded once on one device, used by one thread at a time.
+    """
+    def __init__(self, device: str):
+        self.device = device
+        self.model = build_sam2(SAM_CONFIG, SAM_CHECKPOINT, device=device)
+        self.predictor = EmbeddedPredictor(self.model)
+        # All the GPU work of this model runs on this thread, in submission order.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sam-{device}")
+
+    def _autocast(self):
+        if self.device.startswith("cuda"):
+            return torch.autocast("cuda", dtype=torch.bfloat16)
+        return torch.autocast("cpu", enabled=False)
+
+    def embed(self, images: List[np.ndarray]) -> List[Embedding]:
+        """
+        Run the image encoder over a batch of RGB images.
+        """
+        with torch.inference_mode(), self._autocast():
+            self.predictor.set_image_batch(images)
+            features = self.predictor._features
+            # Clone each image out of the batch: a slice would keep the storage of the whole
+            # batch alive in the cache, well past what Embedding.nbytes accounts for.
+            return [
+                Embedding(
+                    features["image_embed"][i:i + 1].clone(),
+                    [feature[i:i + 1].clone() for feature in features["high_res_feats"]],
+                    tuple(image.shape[:2])
+                )
+                for i, image in enumerate(images)
+            ]
+
+    def automask(self, embedding: Embedding, image: np.ndarray,
+                 request: AutomaskRequest) -> List[np.ndarray]:
+        """
+        Generate the masks of every object of an already encoded image.
+        """
+        generator = SAM2AutomaticMaskGenerator(
+            self.model,
+            points_per_side=request.points_per_side,
+            points_per_batch=request.points_per_batch,
+            pred_iou_thresh=request.pred_iou_thresh,
+            stability_score_thresh=request.stability_score_thresh,
+            min_mask_region_area=request.min_mask_region_area,
+        )
+        generator.predictor = self.predictor
+        with torch.inference_mode(), self._autocast():
+            self.predictor.embedding = embedding
+            try:
+                masks = generator.generate(image)
+            finally:
+                self.predictor.embedding = None
+        if request.output_type == "Single Mask" and masks:
+            masks = [max(masks, key=lambda mask: mask["predicted_iou"])]
+        return [mask["segmentation"] for mask in masks]
+
+    def prompts(self, embedding: Embedding, prompts: List[Dict],
+                multimask_output: bool) -> List[np.ndarray]:
+        """
+        Decode the best mask of each point prompt of an already encoded image.
+        """
+        with torch.inference_mode(), self._autocast():
+            self.predictor.use(embedding)
+            masks = []
+            for prompt in prompts:
+                prompt_masks, scores, _ = self.predictor.predict(
+                    point_coords=np.array(prompt["point_coords"], dtype=np.float32),
+                    point_labels=np.array(prompt["point_labels"], dtype=np.int32),
+                    multimask_output=multimask_output,
+                )
+                masks.append(prompt_masks[int(np.argmax(scores))] > 0)
+        return masks
+
+
+class Job:
+    """
+    One request waiting for a GPU: an image and the work to do once it is encoded.
+    """
+    def __init__(self, key: str, image: np.ndarray, kind: str, request):
+        self.key = key
+        self.image = image
+        self.kind = kind
+        self.request = request
+        self.future = asyncio.get_running_loop().create_future()
+
+    def run(self, model: SamModel, embedding: Embedding) -> List[np.ndarray]:
+        if self.kind == "automask":
+            return model.automask(embedding, self.image, self.request)
+        return model.prompts(embedding, self.request.prompts, self.request.multimask_output)
+
+
+class BatchQueue:
+    """
+    Micro-batches jobs through the image encoder of each model. Every model pulls from the same
+    queue, so an idle GPU picks up the next batch.
+    """
+    def __init__(self, models: List[SamModel], max_batch: int, max_wait: float,
+                 cache: EmbeddingCache):
+        self.models = models
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cache = cache
+        self.queue = asyncio.Queue()
+        self.workers = []
+
+    def start(self) -> None:
+        self.workers = [asyncio.create_task(self.serve(model)) for model in self.models]
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    async def submit(self, job: Job) -> List[np.ndarray]:
+        await self.queue.put(job)
+        return await job.future
+
+    async def next_batch(self) -> List[Job]:
+        """
+        Wait for a job, then for more until the batch is full or max_wait has passed.
+        """
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def embed(self, model: SamModel, batch: List[Job]) -> List[Embedding]:
+        """
+        The embedding of the image of each job. Known images are served from the cache, so only
+        new images, each encoded once however many jobs share it, go through the encoder.
+        """
+        loop = asyncio.get_running_loop()
+        embeddings = {}
+        for job in batch:
+            embedding = self.cache.get(job.key)
+            if embedding is not None:
+                # Moving an embedding between GPUs is much cheaper than encoding the image.
+                if embedding.device != torch.device(model.device):
+                    embedding = embedding.to(model.device)
+                embeddings[job.key] = embedding
+        misses = {job.key: job.image for job in batch if job.key not in embeddings}
+        if misses:
+            encoded = await loop.run_in_executor(
+                model.executor, model.embed, list(misses.values())
+            )
+            for key, embedding in zip(misses, encoded):
+                self.cache.put(key, embedding)
+                embeddings[key] = embedding
+        return [embeddings[job.key] for job in batch]
+
+    async def serve(self, model: SamModel) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                embeddings = await self.embed(model, batch)
+            except Exception as e:
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                continue
+            for job, embedding in zip(batch, embeddings):
+                try:
+                    job.future.set_result(
+                        await loop.run_in_executor(model.executor, job.run, model, embedding)
+                    )
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+
+
+def devices() -> List[str]:
+    """
+    The devices to load a model on, every GPU or else the CPU. SAM_DEVICES overrides them, as a
+    comma separated list such as "cuda:0,cuda:1".
+    """
+    if os.environ.get("SAM_DEVICES"):
+        return os.environ["SAM_DEVICES"].split(",")
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+
+def image_key(b64str_img: str) -> str:
+    """
+    The embedding cache key of an image, a hash of its encoding.
+    """
+    return hashlib.sha256(b64str_img.encode()).hexdigest()
+
+
+def decode_image(b64str_img: str) -> np.ndarray:
+    """
+    Decode a base64 encoded image into an RGB array.
+    """
+    data = np.frombuffer(base64.b64decode(b64str_img), dtype=np.uint8)
+    image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("The image could not be decoded.")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def mask_outlines(masks: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    Trace the outer outline of every part of every mask, as (n, 2) arrays of (u,v) pixels.
+    """
+    outlines = []
+    for mask in masks:
+        contours, _ = cv2.findContours(
+            mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+        )
+        outlines.extend(contour.reshape(-1, 2) for contour in contours if len(contour) >= 3)
+    return outlines
+
+
+def encode_outlines(outlines: List[np.ndarray], packed: bool) -> Tuple[bytes, str]:
+    """
+    Encode outlines as samapi GeoJSON, or in the compact polygon format.
+
+    Returns:
+        body, content_type: the response body and its Content-Type.
+    """
+    if packed:
+        offsets = np.zeros(len(outlines) + 1, dtype="<u4")
+        np.cumsum([len(outline) for outline in outlines], out=offsets[1:])
+        vertices = (
+            np.concatenate(outlines).astype("<f4") if outlines else np.zeros((0, 2), "<f4")
+        )
+        header = struct.pack("<5sII", PACKED_MAGIC, len(outlines), len(vertices))
+        body = header + zlib.compress(offsets.tobytes() + vertices.tobytes(), 6)
+        return body, PACKED_CONTENT_TYPE
+    features = [
+        {
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                # GeoJSON rings are closed.
+                "coordinates": [outline.tolist() + [outline[0].tolist()]],
+            },
+            "properties": {"object_type": "annotation"},
+        }
+        for outline in outlines
+    ]
+    return json.dumps(features).encode(), "application/json"
+
+
+app = FastAPI()
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+cpu_pool = ThreadPoolExecutor(max_workers=SAM_CPU_WORKERS, thread_name_prefix="sam-cpu")
+batch_queue: Optional[BatchQueue] = None
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    global batch_queue
+    models = [SamModel(device) for device in devices()]
+    cache = EmbeddingCache(SAM_EMBEDDING_CACHE_MB * 1024 * 1024)
+    batch_queue = BatchQueue(models, SAM_MAX_BATCH, SAM_MAX_WAIT_MS / 1000, cache)
+    batch_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await batch_queue.stop()
+
+
+async def segment(http_request: Request, kind: str, request) -> Response:
+    """
+    Queue a request for a GPU, and answer with the outlines of its masks.
+    """
+    loop = asyncio.get_running_loop()
+    key, image = await asyncio.gather(
+        loop.run_in_executor(cpu_pool, image_key, request.b64img),
+        loop.run_in_executor(cpu_pool, decode_image, request.b64img),
+    )
+    masks = await batch_queue.submit(Job(key, image, kind, request))
+    packed = PACKED_CONTENT_TYPE in http_request.headers.get("accept", "")
+    outlines = await loop.run_in_executor(cpu_pool, mask_outlines, masks)
+    body, content_type = await loop.run_in_executor(cpu_pool, encode_outlines, outlines, packed)
+    return Response(body, media_type=content_type)
+
+
+@app.get("/sam/version/")
+async def version() -> Response:
+    return Response(SERVER_VERSION, media_type="text/plain")
+
+
+@app.post("/sam/automask/")
+async def automask(request: AutomaskRequest, http_request: Request) -> Response:
+    return await segment(http_request, "automask", request)
+
+
+@app.post("/sam/prompts/")
+async def prompts(request: PromptsRequest, http_request: Request) -> Response:
+    return await segment(http_request, "prompts", request)
+
+
+@app.post("/sam/")
+async def prompt(request: PromptRequest, http_request: Request) -> Response:
+    prompts_request = PromptsRequest(
+        b64img=request.b64img,
+        type=request.type,
+        prompts=[{"point_coords": request.point_coords, "point_labels": request.point_labels}],
+        multimask_output=request.multimask_output,
+    )
+    return await segment(http_request, "prompts", prompts_request)
@@ -7,13 +7,19 @@ date: 2024-09-09
 
 import json
 import base64
+import hashlib
+import math
 import uuid
 import numpy as np
 import cv2
 import os
 import json
 import requests
-from typing import List, Dict, Tuple
+import tempfile
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Optional
 
 
 """
@@ -24,9 +30,124 @@ Our project modifies the server parameters to optimize golf map segmentation.
 """
 
 
-SAM_API_ADDR = "https://<fill-w-perm-ngrok-addr>.ngrok-free.app/sam/"
+SAM_API_ADDR = os.environ.get(
+    "SAM_API_ADDR", "https://<fill-w-perm-ngrok-addr>.ngrok-free.app/sam/"
+)
 TEST_FILE = "samapi/clickfiles/icreek1.json"
 
+# Seconds to wait for the tunnel to accept a connection, and for the server to answer.
+SAM_TIMEOUT = (10, 300)
+
+
+def make_sam_session(
+    pool_size: int = 4, retries: int = 3, backoff: float = 0.5
+) -> requests.Session:
+    """
+    Create a keep-alive session to the SAM server that retries connection resets and 5xx
+    responses with exponential backoff. Segmentation requests are idempotent, so POSTs are retried.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+sam_session = make_sam_session()
+
+# SAM parameters tuned for golf map segmentation.
+SAM_AUTOMASK_PARAMS = {
+    "type": "sam2_l",
+    "output_type": "Multi-mask (all)",
+    "pred_iou_thresh": 0.8, # Default 0.88
+    "points_per_side": 100, # Default 32
+    "points_per_batch": 128, # Default 64
+}
+
+# Decimals kept for the yards in the LLM input, and the characters per token assumed when tiktoken
+# is not installed. Same compact serialization as aigolfcaddie/prompt.py.
+PROMPT_DIGITS = 1
+CHARACTERS_PER_TOKEN = 4
+TOKEN_ENCODING = "o200k_base"
+_encoding = None
+
+# The pairs of feature types whose distances are given to the LLM, see feature_analysis.
+FEATURE_PAIRS = [
+    ("fairway", "bunker"),
+    ("fairway", "green"),
+    ("tee", "fairway"),
+    ("tee", "bunker"),
+]
+
+# Cache of SAM results keyed by the image and the SAM parameters. Recent results are kept in memory
+# and every result is written to disk, dropping the least recently used files past the size limit.
+SAM_CACHE_DIR = "samapi/cache/"
+SAM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+SAM_CACHE_ENTRIES = 8
+sam_memory_cache = OrderedDict()
+
+
+def sam_cache_get(key: str) -> Optional[str]:
+    """
+    Look up a cached SAM result, first in memory and then on disk.
+    """
+    if key in sam_memory_cache:
+        sam_memory_cache.move_to_end(key)
+        return sam_memory_cache[key]
+    path = os.path.join(SAM_CACHE_DIR, key)
+    try:
+        with open(path, "r") as file:
+            value = file.read()
+        os.utime(path)  # Mark as recently used.
+    except OSError:
+        return None
+    sam_cache_remember(key, value)
+    return value
+
+
+def sam_cache_remember(key: str, value: str) -> None:
+    """
+    Keep a SAM result in the in-memory tier, dropping the least recently used entry when full.
+    """
+    sam_memory_cache[key] = value
+    sam_memory_cache.move_to_end(key)
+    while len(sam_memory_cache) > SAM_CACHE_ENTRIES:
+        sam_memory_cache.popitem(last=False)
+
+
+def sam_cache_put(key: str, value: str) -> None:
+    """
+    Store a SAM result in memory and on disk, then evict old files past SAM_CACHE_MAX_BYTES.
+    """
+    sam_cache_remember(key, value)
+    try:
+        os.makedirs(SAM_CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so a reader never sees a partial value.
+        descriptor, temp_path = tempfile.mkstemp(dir=SAM_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(descriptor, "w") as file:
+            file.write(value)
+        os.replace(temp_path, os.path.join(SAM_CACHE_DIR, key))
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(SAM_CACHE_DIR)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        )
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= SAM_CACHE_MAX_BYTES:
+                break
+            os.remove(path)
+            total -= size
+    except OSError:
+        pass
+
 
 def get_samapi_version() -> str:
     """
@@ -35,17 +156,18 @@ def get_samapi_version() -> str:
     Returns:
         version_str: a string indiciating the SAM API version.
     """
-    result = requests.get(SAM_API_ADDR + "version/")
+    result = sam_session.get(SAM_API_ADDR + "version/", timeout=SAM_TIMEOUT)
     return result.text
 
 
-def call_sam(b64str_img: str) -> str:
+def call_sam(b64str_img: str, bbox = None) -> str:
     """
     Utility function to call the SAM server at the SAM_API_ADDR. The SAM server will inference the
     SAM model to generate GeoJSON edges to capture segmented regions within the image.
 
     This function tunes the SAM parameters to work best with golf map segmentation. Specifically,
-    this call makes a POST request to /sam/automask/ and waits for a response.
+    this call makes a POST request to /sam/automask/ and waits for a response. Successful responses
+    are cached by image and parameters, so repeat calls for the same image skip the server.
 
     The SAM parameters are described here:
         https://github.com/ksugar/samapi/tree/main?tab=readme-ov-file#endpoint-samautomask-post
@@ -58,17 +180,20 @@ def call_sam(b64str_img: str) -> str:
             contains a list of json objects with following keys: "geometry", "type", and
             "properties". 
     """
-    result = requests.post(
+    key = hashlib.sha256(
+        (b64str_img + json.dumps(SAM_AUTOMASK_PARAMS, sort_keys=True)).encode()
+    ).hexdigest()
+    cached = sam_cache_get(key)
+    if cached is not None:
+        return cached
+
+    result = sam_session.post(
         SAM_API_ADDR + "automask/",
-        json={
-            "type": "sam2_l",
-            "b64img": b64str_img,
-            "output_type": "Multi-mask (all)",
-            "pred_iou_thresh": 0.8, # Default 0.88
-            "points_per_side": 100, # Default 32
-            "points_per_batch": 128, # Default 64
-        }
+        json={"b64img": b64str_img, **SAM_AUTOMASK_PARAMS},
+        timeout=SAM_TIMEOUT
     )
+    if result.ok:
+        sam_cache_put(key, result.text)
     return result.text
 
 
@@ -143,6 +268,7 @@ def analyze_result(geojson_str: str, clicks: Dict) -> List[Dict]:
                         if minarea == -1 or abs(u1 - u0) * abs(v1-v0) < minarea:
                             minarea = abs(u1 - u0) * abs(v1-v0)
                             feature_info = {
+                                "feature_id" : len(all_metrics),
                                 "feature_name" : golf_feature,
                                 "feature_center_yards" : calculate_center_of_mass(verticies),
                                 "coordinates" : [u0,v0,u1,v1]
@@ -176,50 +302,103 @@ def contained(u0: float, v0: float, u1: float, v1: float, click: Dict) -> bool:
 
 def feature_analysis(metrics: Dict) -> List[Dict]:
     """
-    Given metrics about golf features analyze various characteristics of how they're related
-    """
-    # json.dumps 
-    # keep things more structured (keep the scale)
-    # go shot by shot instead of a whole plan at once
+    Given metrics about golf features analyze various characteristics of how they're related.
 
-    # calculate distance from tee to middle of fairway, tee to bunker
+    Returns:
+        distances: the distance between the "feature_center_yards" of every two features of the
+            FEATURE_PAIRS types, each with the "feature_id" of both features.
+    """
     print("Distance from fairway to bunkers and green")
-    fairway_bunker = []
-    fairway_green = []
-    tee_fairway = []
-    tee_bunker = []
-    for fairway in metrics["fairway"]:
-        for bunker in metrics["bunker"]:
-            distance = round(((fairway['feature_center_yards'][0] - bunker["feature_center_yards"][0]) ** 2 + (fairway['feature_center_yards'][1] - bunker["feature_center_yards"][1]) ** 2) ** 0.5,2)
-            fairway_bunker.append({
-                "distance" : distance,
-                "feature_1" : fairway,
-                "feature_2" : bunker
-            })
-        for green in metrics["green"]:
-            distance = round(((fairway['feature_center_yards'][0] - green["feature_center_yards"][0]) ** 2 + (fairway['feature_center_yards'][1] - green["feature_center_yards"][1]) ** 2) ** 0.5,2)
-            fairway_green.append({
-                "distance" : distance,
-                "feature_1" : fairway,
-                "feature_2" : green
-            })
-        for tee in metrics["tee"]:
-            distance = round(((fairway['feature_center_yards'][0] - tee["feature_center_yards"][0]) ** 2 + (fairway['feature_center_yards'][1] - tee["feature_center_yards"][1]) ** 2) ** 0.5,2)
-            fairway_green.append({
-                    "distance" : distance,
-                    "feature_1" : tee,
-                    "feature_2" : fairway
-                })
-    for tee in metrics["tee"]:
-        for bunker in metrics["bunker"]:
-            distance = round(((tee['feature_center_yards'][0] - bunker["feature_center_yards"][0]) ** 2 + (bunker['feature_center_yards'][1] - tee["feature_center_yards"][1]) ** 2) ** 0.5,2)
-            tee_bunker.append({
-                    "distance" : distance,
-                    "feature_1" : tee,
-                    "feature_2" : bunker
+    distances = []
+    for name_1, name_2 in FEATURE_PAIRS:
+        for feature_1 in metrics.get(name_1, []):
+            for feature_2 in metrics.get(name_2, []):
+                (u1, v1), (u2, v2) = \
+                    feature_1["feature_center_yards"], feature_2["feature_center_yards"]
+                distances.append({
+                    "distance" : round(math.hypot(u1 - u2, v1 - v2), 2),
+                    "feature_1" : feature_1["feature_id"],
+                    "feature_2" : feature_2["feature_id"]
                 })
-    
-    return fairway_bunker + fairway_green +tee_fairway + tee_bunker
+    return distances
+
+
+def round_numbers(value, digits: int = PROMPT_DIGITS):
+    """
+    Round every float nested in lists, tuples and dictionaries. Tuples become lists, as in JSON.
+    """
+    if isinstance(value, (float, np.floating)):
+        return round(float(value), digits)
+    if isinstance(value, dict):
+        return {key: round_numbers(item, digits) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [round_numbers(item, digits) for item in value]
+    return value
+
+
+def compact_json(value, digits: int = PROMPT_DIGITS) -> str:
+    """
+    Serialize a value as JSON without whitespace, with its floats rounded to digits decimals.
+    """
+    return json.dumps(round_numbers(value, digits), separators=(",", ":"), ensure_ascii=False)
+
+
+def distance_table(distances: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """
+    Index the distances of feature_analysis by feature id: {"id1": {"id2": distance}}.
+    """
+    table = {}
+    for distance in distances:
+        table.setdefault(str(distance["feature_1"]), {})[str(distance["feature_2"])] = \
+            distance["distance"]
+    return table
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    The number of tokens the LLM reads for the text, exactly with tiktoken or else approximately.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+        except ImportError:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+
+
+def compact_sections(setup: Dict, features: List[Dict], distances: List[Dict]) -> Dict[str, str]:
+    """
+    Serialize the three parts of the LLM input. Each feature is listed once with its
+    "feature_id", without the pixel "coordinates" only used to visualize it, and the distances
+    are a table indexed by those ids.
+
+    Returns:
+        sections: maps the title of each section to its text, in the order of the input.
+    """
+    features = [
+        {key: value for key, value in feature.items() if key != "coordinates"}
+        for feature in features
+    ]
+    return {
+        "Setup Information": compact_json(setup),
+        "Physical Features": compact_json(features),
+        "Inter-Feature Distance": compact_json(distance_table(distances)),
+    }
+
+
+def format_input(sections: Dict[str, str]) -> str:
+    """
+    Write the sections of compact_sections as the LLM input, printing the tokens of each.
+    """
+    for title, text in sections.items():
+        print(f"{title}: about {estimate_tokens(text)} tokens")
+    return "The following are the 3 input parts described previously:\n" + "".join(
+        f"## {title}\n{text}\n" for title, text in sections.items()
+    )
 
 
 def feature_organization(metrics: List[Dict]) -> Dict:
@@ -299,25 +478,16 @@ def form_llm_input_using_sam(clicks_data: Dict, debug: bool = False) -> str:
     sam_response: str = call_sam(b64str_img,[])
 
     # Form the input string.
-    input_str = ""
-    input_str += "The following are the 3 input parts described previously:\n"
-    input_str += "## Setup Information\n"
-    input_str += json.dumps(setup_info(), indent=4) + "\n"
-    metrics = analyze_result(sam_response, clicks_data)
-    input_str += "## Physical Features\n"
-    input_str += json.dumps(metrics, indent=4)
-    metrics = feature_organization(metrics) # Physical Features
+    features = analyze_result(sam_response, clicks_data)
+    metrics = feature_organization(features) # Physical Features
 
     # For debugging using visualizations.
     if debug:
         output_img = os.path.join(file_dir, str(uuid.uuid4()) + ".jpg")
         visualize_detections(metrics, input_img, output_img)
 
-    metrics = feature_analysis(metrics)
-    input_str += "## Inter-Feature Distance\n"
-    input_str += json.dumps(metrics, indent=4) + "\n"
-    
-    return input_str
+    distances = feature_analysis(metrics) # Inter-Feature Distance
+    return format_input(compact_sections(setup_info(), features, distances))
 
 
 def test_sam_service():
@@ -336,25 +506,16 @@ def test_sam_service():
     
     # Pass the test image.
     sam_response: str = call_sam(b64str_img,[])
-    
-    with open("input.txt","w") as file:
-        file.write("The following are the 3 input parts described previously:\n")
-    with open("input.txt","a") as file:
-        file.write("## Setup Information\n")
-        file.write(json.dumps(setup_info(),indent = 4) + "\n")
+
     # Compute analysis on the GeoJSON result.
-    metrics = analyze_result(sam_response, data) # Physical Features
-    with open("input.txt","a") as file:
-        file.write("## Physical Features\n")
-        file.write(json.dumps(metrics,indent = 4)+ "\n")
-    metrics = feature_organization(metrics) # Physical Features
-    print(json.dumps(metrics, indent=4))
+    features = analyze_result(sam_response, data) # Physical Features
+    metrics = feature_organization(features)
     visualize_detections(metrics, input_img, output_img)
-    metrics = feature_analysis(metrics) # Inter-Feature Distance
-    with open("input.txt","a") as file:
-        file.write("## Inter-Feature Distance\n")
-        file.write(json.dumps(metrics,indent = 4)+ "\n")
-    return metrics
+    distances = feature_analysis(metrics) # Inter-Feature Distance
+    # Written exactly as sent to the LLM, so its size is the size of the real input.
+    with open("input.txt","w") as file:
+        file.write(format_input(compact_sections(setup_info(), features, distances)))
+    return distances
 
 
 if __name__=="__main__":
@@ -12,4 +12,7 @@ ngrok config add-authtoken <ngrok authtoken>
 
 # Install SAMAPI
 conda install -c conda-forge -y cudatoolkit=11.8
-cd samapi; python -m pip install -e .
\ No newline at end of file
+cd samapi; python -m pip install -e .
+
+# Dependencies of the batching server (batch_server.py), on top of samapi and SAM2.
+python -m pip install fastapi uvicorn opencv-python-headless
@@ -3,5 +3,11 @@
 # Start the SAM API server.
 uvicorn samapi.main:app --workers 1 --port 3000
 
+# Or, for many concurrent users, start the batching server instead. It holds the model once per GPU
+# and micro-batches requests through the image encoder, caching image embeddings so follow-up
+# requests on a known map skip the encoder. It runs as a single uvicorn worker.
+# SAM_MAX_BATCH=4 SAM_MAX_WAIT_MS=20 SAM_CPU_WORKERS=4 SAM_EMBEDDING_CACHE_MB=2048 \
+#     uvicorn batch_server:app --workers 1 --port 3000
+
 # Start ngrok to tunnel local API on public network.
 ngrok http --url=<fill-w-perm-ngrok-addr>.ngrok-free.app 3000 --host-header="localhost:3000"
\ No newline at end of file